@@ -1,13 +1,51 @@
 from django.db import models
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.core.signals import request_started
 from django.db.models import Count
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 import json
+import datetime
+from bisect import bisect_left
 from django.utils.safestring import mark_safe
+from celery.signals import task_prerun
 
 from timezones.fields import TimeZoneField
 
+# Timelines of the details of profiles by profile id, loaded on first use
+# and dropped at the start of every request and task
+_timelines = {}
+
+class DetailTimeline(object):
+    ''' Values of one field of the details of a profile, by time '''
+
+    def __init__(self, rows):
+        ''' rows are (time, value) ordered by time '''
+        self.times = [time for time, value in rows]
+        self.values = [value for time, value in rows]
+
+    def at(self, date, default=None):
+        ''' The value of the last detail before date, or default '''
+        i = bisect_left(self.times, detail_time(date))
+        if i:
+            return self.values[i-1]
+        return default
+
+def detail_time(date):
+    ''' The date or datetime as a time comparable to UserProfileDetail.time,
+    the same way the database would compare them '''
+    if not isinstance(date, datetime.datetime):
+        date = datetime.datetime(date.year, date.month, date.day)
+    if settings.USE_TZ and timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.get_default_timezone())
+    return date
+
+def clear_timelines(**kwargs):
+    _timelines.clear()
+request_started.connect(clear_timelines)
+task_prerun.connect(clear_timelines)
+
 class Profile(AbstractUser):
     gender_choices = (
             ('M', _('Male')),
@@ -53,26 +91,29 @@ class Profile(AbstractUser):
         verbose_name_plural = _('profiles')
         ordering = ('user__username',)
 
+    def get_timeline(self, field):
+        ''' DetailTimeline of the weight or ftp of the user '''
+        timelines = _timelines.get(self.pk)
+        if timelines is None:
+            rows = list(self.userprofiledetail_set.order_by('time').values_list('time', 'weight', 'ftp'))
+            timelines = _timelines[self.pk] = {
+                'weight': DetailTimeline([(time, weight) for time, weight, ftp in rows if weight is not None]),
+                'ftp': DetailTimeline([(time, ftp) for time, weight, ftp in rows if ftp is not None]),
+            }
+        return timelines[field]
+
     def get_weight(self, date=None):
         ''' Returns weight of user, optionally given date, try to find weight close to date '''
         userweight = self.weight
         if date:
-            try:
-                userweight = self.userprofiledetail_set.filter(weight__isnull=False).filter(time__lt=date).order_by("-time")[0].weight
-            except IndexError:
-                # when no weight is found
-                pass
+            userweight = self.get_timeline('weight').at(date, userweight)
         return userweight
 
     def get_ftp(self, date=None):
         ''' Returns ftp of user, optionally given date, try to find ftp close to date '''
         userftp = self.ftp
         if date:
-            try:
-                userftp = self.userprofiledetail_set.filter(ftp__isnull=False).filter(time__lt=date).order_by("-time")[0].ftp
-            except IndexError:
-                # when no ftp is found
-                pass
+            userftp = self.get_timeline('ftp').at(date, userftp)
         return userftp
 
     def get_profile(self):
@@ -89,6 +130,7 @@ class UserProfileDetail(models.Model):
 
         ''' Overriden to update UserProfile with new data '''
         super(UserProfileDetail, self).save(force_insert, force_update)
+        _timelines.pop(self.userprofile_id, None)
         if self.weight:
             self.userprofile.weight = self.weight
         if self.resting_hr:
@@ -108,3 +150,6 @@ class UserProfileDetail(models.Model):
         # TODO: maybe have separate views for all the details in the future?
         return self.userprofile.get_absolute_url()
 
+def detail_deleted(sender, instance, **kwargs):
+    _timelines.pop(instance.userprofile_id, None)
+models.signals.post_delete.connect(detail_deleted, sender=UserProfileDetail)
@@ -24,7 +24,7 @@ from endless_pagination.decorators import page_template
 
 from avatar.models import Avatar
 
-from turan.models import BestPowerEffort, BestSpeedEffort, Exercise, Equipment, Component
+from turan.models import BestPowerEffort, BestSpeedEffort, Exercise, Equipment, Component, DailyLoad
 
 from django.views.decorators.vary import vary_on_cookie
 from groupcache.decorators import cache_page_against_model, cache_page_against_models
@@ -389,6 +389,15 @@ def profile_statistics(request, username, template_name="profiles/statistics.htm
 
     exerciseqs = other_user.exercise_set.filter(**tfilter).order_by('date')
 
+    ctldataseries = ""
+    atldataseries = ""
+    tsbdataseries = ""
+    for load in DailyLoad.objects.filter(user=other_user, **tfilter):
+        timestamp = datetime2jstimestamp(load.date)
+        ctldataseries += '[%s, %.1f],' % (timestamp, load.ctl)
+        atldataseries += '[%s, %.1f],' % (timestamp, load.atl)
+        tsbdataseries += '[%s, %.1f],' % (timestamp, load.tsb)
+
     for trip in exerciseqs:
         if trip.avg_speed and trip.exercise_type.name=="Cycling" and trip.route and trip.route.distance >= 10.0:
             # only increase counter if trip has speed
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+#
+''' Keys of the cached artifacts of exercises and segments.
+
+Every key includes a version of the exercise or segment it belongs to, kept
+in the cache. Bumping the version makes every variant of every artifact of
+it unreachable at once, and the stale copies expire on their own. '''
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# The artifacts by the kind of object they belong to
+ARTIFACTS = {
+    'exercise': ('json_trip_series', 'altitude_gradient', 'freqs'),
+    'segment': ('segment_geojson',),
+}
+
+def artifact_ttl():
+    ''' Seconds to keep artifacts, they are never stale under a version so
+    this only bounds the space taken by unused ones '''
+    return getattr(settings, 'CACHE_ARTIFACT_TTL', 86400*30)
+
+def get_version(key):
+    ''' The version stored under key, a new one if the cache has none '''
+    version = cache.get(key)
+    if version is None:
+        # A new version, the cache may have lost one we have already seen
+        cache.add(key, int(time.time()*1000), None)
+        version = cache.get(key)
+    return version
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time()*1000), None)
+
+def version_key(kind, object_id):
+    return '%s_version_%s' %(kind, object_id)
+
+def artifact_key(kind, object_id, artifact, *variant):
+    ''' Key of a variant of an artifact of an exercise or segment '''
+    if artifact not in ARTIFACTS[kind]:
+        raise ValueError('Unknown %s artifact %s' %(kind, artifact))
+    key = '%s_%s_v%s' %(artifact, object_id, get_version(version_key(kind, object_id)))
+    for value in variant:
+        key += '_%s' %int(value)
+    return key
+
+def exercise_key(exercise_id, artifact, *variant):
+    return artifact_key('exercise', exercise_id, artifact, *variant)
+
+def segment_key(segment_id, artifact, *variant):
+    return artifact_key('segment', segment_id, artifact, *variant)
+
+def bump_exercise(exercise_id):
+    ''' Invalidate every cached artifact of the exercise, must be called when
+    its samples, fields or permissions change '''
+    bump_version(version_key('exercise', exercise_id))
+
+def bump_segment(segment_id):
+    ''' Invalidate every cached artifact of the segment '''
+    bump_version(version_key('segment', segment_id))
@@ -135,12 +135,15 @@ fit_base_types = {
     5:  {'number':  5, 'endian': 1, 'field': int('0x85' ,16), 'type': 'sint32',  'invalid': int('0x7FFFFFFF' ,16),         'size': 4},
     6:  {'number':  6, 'endian': 1, 'field': int('0x86' ,16), 'type': 'uint32',  'invalid': int('0xFFFFFFFF' ,16),         'size': 4},
     7:  {'number':  7, 'endian': 0, 'field': int('0x07' ,16), 'type': 'string',  'invalid': int('0x00' ,16),               'size': 1},
-    8:  {'number':  8, 'endian': 1, 'field': int('0x88' ,16), 'type': 'float32', 'invalid': int('0xFFFFFFFF' ,16),         'size': 2},
-    9:  {'number':  9, 'endian': 1, 'field': int('0x89' ,16), 'type': 'float64', 'invalid': int('0xFFFFFFFFFFFFFFFF' ,16), 'size': 4},
+    8:  {'number':  8, 'endian': 1, 'field': int('0x88' ,16), 'type': 'float32', 'invalid': int('0xFFFFFFFF' ,16),         'size': 4},
+    9:  {'number':  9, 'endian': 1, 'field': int('0x89' ,16), 'type': 'float64', 'invalid': int('0xFFFFFFFFFFFFFFFF' ,16), 'size': 8},
     10: {'number': 10, 'endian': 0, 'field': int('0x0A' ,16), 'type': 'uint8z',  'invalid': int('0x00' ,16),               'size': 1},
     11: {'number': 11, 'endian': 1, 'field': int('0x8B' ,16), 'type': 'uint16z', 'invalid': int('0x0000' ,16),             'size': 2},
     12: {'number': 12, 'endian': 1, 'field': int('0x8C' ,16), 'type': 'uint32z', 'invalid': int('0x00000000' ,16),         'size': 4},
-    13: {'number': 13, 'endian': 0, 'field': int('0x0D' ,16), 'type': 'byte',    'invalid': int('0xFF' ,16),               'size': 1}}
+    13: {'number': 13, 'endian': 0, 'field': int('0x0D' ,16), 'type': 'byte',    'invalid': int('0xFF' ,16),               'size': 1},
+    14: {'number': 14, 'endian': 1, 'field': int('0x8E' ,16), 'type': 'sint64',  'invalid': int('0x7FFFFFFFFFFFFFFF' ,16), 'size': 8},
+    15: {'number': 15, 'endian': 1, 'field': int('0x8F' ,16), 'type': 'uint64',  'invalid': int('0xFFFFFFFFFFFFFFFF' ,16), 'size': 8},
+    16: {'number': 16, 'endian': 1, 'field': int('0x90' ,16), 'type': 'uint64z', 'invalid': int('0x0000000000000000' ,16), 'size': 8}}
 
 fit_type_unpack = {
     'enum':    'B',
@@ -156,7 +159,10 @@ fit_type_unpack = {
     'uint8z':  'B',
     'uint16z': 'H',
     'uint32z': 'I',
-    'byte':    'c'}
+    'byte':    'c',
+    'sint64':  'q',
+    'uint64':  'Q',
+    'uint64z': 'Q'}
 
 '''Timestamps are referenced from 1989-12-31 00:00 UTC,
    so we have to add the bit missing from where 0 timestamp normally is.'''
@@ -165,15 +171,117 @@ timestamp_offset = datetime(1989,12,31,00,00,00)-datetime.utcfromtimestamp(0)
    this is the appropriate conversion factor to get degrees.'''
 semicircle_deg = 180./(2**31)
 
+fit_header = struct.Struct('<BBHI4s')
+fit_field_definition = struct.Struct('BBB')
+
+# Field number of the timestamp in every message that has one
+fit_timestamp_field = 253
+
+class FITDefinition(object):
+    ''' A local message definition, compiled to one struct.Struct unpacking
+    all fields of a data message in one go.
+
+    Strings, arrays and fields of unknown base type are unpacked as raw
+    strings, developer fields are skipped. '''
+
+    def __init__(self, global_msg_number, endian, fields, dev_size=0):
+        self.global_msg_number = global_msg_number
+        self.def_nums = []
+        self.invalids = []
+        codes = [endian]
+        for def_num, size, base_type in fields:
+            base_type = fit_base_types.get(base_type & int('11111', 2))
+            if base_type and base_type['size'] == size and base_type['type'] != 'string':
+                codes.append(fit_type_unpack[base_type['type']])
+                self.invalids.append(base_type['invalid'])
+            else:
+                codes.append('%ds' % size)
+                self.invalids.append(None)
+            self.def_nums.append(def_num)
+        if dev_size:
+            codes.append('%dx' % dev_size)
+        self.struct = struct.Struct(''.join(codes))
+        self.size = self.struct.size
+
+    def unpack_from(self, data, offset):
+        ''' Return the fields of the data message at offset as a dict of
+        field number and value, invalid values as None '''
+        fields = {}
+        for def_num, invalid, value in zip(self.def_nums, self.invalids, self.struct.unpack_from(data, offset)):
+            if value == invalid:
+                value = None
+            fields[def_num] = value
+        return fields
+
+def read_fit_messages(data):
+    ''' Generator decoding the data messages of the FIT file in the string
+    data, yielding tuples of global message number and fields as returned by
+    FITDefinition.unpack_from.
+
+    Messages with a compressed timestamp header get their timestamp field
+    filled in from the last full timestamp. '''
+
+    if len(data) < 12:
+        return
+    (hdr_size, proto_ver, prof_ver, data_size, data_type) = fit_header.unpack_from(data, 0)
+    if data_type != '.FIT':
+        return
+
+    definitions = {}
+    last_timestamp = None
+    pos = hdr_size
+    end = min(hdr_size + data_size, len(data))
+    while pos < end:
+        hdr = ord(data[pos])
+        pos += 1
+        compressed = hdr & int('10000000', 2)
+        if compressed:
+            local_msg_type = (hdr >> 5) & int('11', 2)
+        else:
+            local_msg_type = hdr & int('1111', 2)
+
+        if not compressed and hdr & int('01000000', 2):
+            # Definition message
+            arch = ord(data[pos + 1])
+            endian = arch and '>' or '<'
+            (global_msg_number, n_fields) = struct.unpack_from(endian + 'HB', data, pos + 2)
+            pos += 5
+            fields = []
+            for i in range(n_fields):
+                fields.append(fit_field_definition.unpack_from(data, pos))
+                pos += fit_field_definition.size
+            dev_size = 0
+            if hdr & int('00100000', 2):
+                n_dev_fields = ord(data[pos])
+                pos += 1
+                for i in range(n_dev_fields):
+                    dev_size += ord(data[pos + 1])
+                    pos += 3
+            definitions[local_msg_type] = FITDefinition(global_msg_number, endian, fields, dev_size)
+            continue
+
+        definition = definitions.get(local_msg_type)
+        if definition is None or pos + definition.size > end:
+            '''
+            Data without a definition, we can not know its size so
+            there is no way to carry on from here.
+            '''
+            return
+        fields = definition.unpack_from(data, pos)
+        pos += definition.size
+
+        if compressed:
+            if last_timestamp is not None:
+                time_offset = hdr & int('11111', 2)
+                last_timestamp += (time_offset - last_timestamp) & int('11111', 2)
+                fields[fit_timestamp_field] = last_timestamp
+        elif fields.get(fit_timestamp_field) is not None:
+            last_timestamp = fields[fit_timestamp_field]
+
+        yield definition.global_msg_number, fields
+
 def get_field_value(fields, field_def, field_name):
-    try:
-        field = fields[field_def[field_name]]
-        value = field['value']
-        if value == field['base_type']['invalid']:
-            value = None
-    except KeyError:
-        value = None
-    return value
+    return fields.get(field_def[field_name])
 
 class FITEntry(object):
     def __init__(self, time, hr, speed, cadence, power, temp, altitude, lat, lon, distance):
@@ -251,222 +359,137 @@ class FITParser(object):
         self.laps = []
 
     def parse_uploaded_file(self, f):
-        local_msg_types = {}
-        hdr = f.read(12)
-        (hdr_size,proto_ver,prof_ver,data_size) = struct.unpack('BBHI',hdr[0:8])
-        if hdr_size > 12:
-            # XXX: Maybe do something sensible with this. Ensures we
-            # handle FIT files with optional CRC at least.
-            f.read(hdr_size - 12)
-        data_type = hdr[8:12]
-
-        if data_type != '.FIT':
-            return
-
         record_last_time = 0
-        records = 0
-        while f.tell() < data_size + hdr_size:
-            (hdr,) = struct.unpack('B',f.read(1))
-            hdr_type = (hdr >> 7) & 1
-
-            if hdr_type == 0:
-                msg_type = (hdr >> 6) & 1
-                local_msg_type = (hdr) & int('1111',2)
-            elif hdr_type == 1:
-                '''
-                TODO
-                Compressed timestamp headers are not invalid,
-                but not really handled properly either.
-                '''
-                continue
-                local_msg_type = (hdr >> 5) & int('11',2)
-            else:
-                print hdr_type
-                '''
-                Invalid header type.
-                '''
-                return
-
-            if msg_type == 0:
-                fields = {}
-                if local_msg_type not in local_msg_types:
-                    continue
-                global_msg_type = local_msg_types[local_msg_type]['global_msg_number']
-
-                for field in local_msg_types[local_msg_type]['fields']:
-                    base_type = fit_base_types[field['base_type']]
-                    endian = local_msg_types[local_msg_type]['endian']
-                    unpack_string = fit_type_unpack[base_type['type']]
-                    field_data = f.read(base_type['size'])
-                    if field['endian']:
-                        unpack_string = endian + unpack_string
-                    (field_value,) = struct.unpack(unpack_string, field_data)
-                    fields[field['def_num']] = {'value': field_value, 'base_type': base_type}
-                if global_msg_type == 0:
-                    if get_field_value(fields, fit_file_id, 'type') != 4:
-                        '''
-                        Will only parse activity files.
-                        '''
-                        return
-                elif global_msg_type == 18:
-                    self.distance_sum = get_field_value(fields, fit_session, 'distance')
-                    if self.distance_sum != None:
-                        self.distance_sum = self.distance_sum / 100.
-                    self.duration = ('%ss') % (int(round(get_field_value(fields, fit_session, 'timer_time')/1000.)))
-                    self.start_lat = get_field_value(fields, fit_session, 'start_lat')
-                    self.start_lon = get_field_value(fields, fit_session, 'start_lon')
-                    if self.start_lat != None and self.start_lon != None:
-                        self.start_lat = self.start_lat * semicircle_deg
-                        self.start_lon = self.start_lon * semicircle_deg
-                    self.avg_hr = get_field_value(fields, fit_session, 'avg_hr')
-                    self.max_hr = get_field_value(fields, fit_session, 'max_hr')
-                    self.avg_speed = get_field_value(fields, fit_session, 'avg_speed')
-                    self.max_speed = get_field_value(fields, fit_session, 'max_speed')
-                    if self.avg_speed != None and self.max_speed != None:
-                        self.avg_speed = self.avg_speed/1000.*3.6
-                        self.max_speed = self.max_speed/1000.*3.6
-                    self.avg_cadence = get_field_value(fields, fit_session, 'avg_cad')
-                    self.max_cadence = get_field_value(fields, fit_session, 'max_cad')
-                    self.avg_power = get_field_value(fields, fit_session, 'avg_power')
-                    self.max_power = get_field_value(fields, fit_session, 'max_power')
-                    self.kcal_sum = get_field_value(fields, fit_session, 'calories')
-                elif global_msg_type == 19:
+        for global_msg_type, fields in read_fit_messages(f.read()):
+            if global_msg_type == 0:
+                if get_field_value(fields, fit_file_id, 'type') != 4:
                     '''
-                    print '%i: %s %s %s' % (global_msg_type, fit_msg_type[global_msg_type],
-                                            get_field_value(fields, fit_lap, 'event'),
-                                            get_field_value(fields, fit_lap, 'event_type'))
+                    Will only parse activity files.
                     '''
+                    return
+            elif global_msg_type == 18:
+                self.distance_sum = get_field_value(fields, fit_session, 'distance')
+                if self.distance_sum != None:
+                    self.distance_sum = self.distance_sum / 100.
+                timer_time = get_field_value(fields, fit_session, 'timer_time')
+                if timer_time != None:
+                    self.duration = ('%ss') % (int(round(timer_time/1000.)))
+                self.start_lat = get_field_value(fields, fit_session, 'start_lat')
+                self.start_lon = get_field_value(fields, fit_session, 'start_lon')
+                if self.start_lat != None and self.start_lon != None:
+                    self.start_lat = self.start_lat * semicircle_deg
+                    self.start_lon = self.start_lon * semicircle_deg
+                self.avg_hr = get_field_value(fields, fit_session, 'avg_hr')
+                self.max_hr = get_field_value(fields, fit_session, 'max_hr')
+                self.avg_speed = get_field_value(fields, fit_session, 'avg_speed')
+                self.max_speed = get_field_value(fields, fit_session, 'max_speed')
+                if self.avg_speed != None and self.max_speed != None:
+                    self.avg_speed = self.avg_speed/1000.*3.6
+                    self.max_speed = self.max_speed/1000.*3.6
+                self.avg_cadence = get_field_value(fields, fit_session, 'avg_cad')
+                self.max_cadence = get_field_value(fields, fit_session, 'max_cad')
+                self.avg_power = get_field_value(fields, fit_session, 'avg_power')
+                self.max_power = get_field_value(fields, fit_session, 'max_power')
+                self.kcal_sum = get_field_value(fields, fit_session, 'calories')
+            elif global_msg_type == 19:
+                timer_time = get_field_value(fields, fit_lap, 'timer_time')
+                if timer_time == None or int(round(timer_time/1000.)) <= 1:
+                    '''
+                    Lets not bother with intervals of 1s or less. They tend to have
+                    no sensible values anyways.
+                    '''
+                    continue
 
-                    if (int(round(get_field_value(fields, fit_lap, 'timer_time')/1000.)) <= 1):
-                        '''
-                        Lets not bother with intervals of 1s or less. They tend to have
-                        no sensible values anyways.
-                        '''
-                        continue
-
-                    time = datetime.fromtimestamp(get_field_value(fields, fit_lap, 'timestamp'))
-                    time = time + timestamp_offset
-                    start_time = get_field_value(fields, fit_lap, 'start_time')
-                    if start_time != None:
-                        start_time = datetime.fromtimestamp(start_time)
-                        start_time = start_time + timestamp_offset
-                    distance = get_field_value(fields, fit_lap, 'distance')
-                    if distance != None:
-                        distance = distance / 100.
-                    duration = ('%s') % (int(round(get_field_value(fields, fit_lap, 'timer_time')/1000.)))
-                    start_lat = get_field_value(fields, fit_lap, 'start_lat')
-                    start_lon = get_field_value(fields, fit_lap, 'start_lon')
-                    if start_lat != None and start_lon != None:
-                        start_lat = start_lat * semicircle_deg
-                        start_lon = start_lon * semicircle_deg
-                    end_lat = get_field_value(fields, fit_lap, 'end_lat')
-                    end_lon = get_field_value(fields, fit_lap, 'end_lon')
-                    if end_lat != None and end_lon != None:
-                        end_lat = end_lat * semicircle_deg
-                        end_lon = end_lon * semicircle_deg
-                    avg_hr = get_field_value(fields, fit_lap, 'avg_hr')
-                    max_hr = get_field_value(fields, fit_lap, 'max_hr')
-                    avg_speed = get_field_value(fields, fit_lap, 'avg_speed')
-                    max_speed = get_field_value(fields, fit_lap, 'max_speed')
-                    if avg_speed != None and max_speed != None:
-                        avg_speed = avg_speed/1000.*3.6
-                        max_speed = max_speed/1000.*3.6
-                    avg_cadence = get_field_value(fields, fit_lap, 'avg_cad')
-                    max_cadence = get_field_value(fields, fit_lap, 'max_cad')
-                    avg_power = get_field_value(fields, fit_lap, 'avg_power')
-                    max_power = get_field_value(fields, fit_lap, 'max_power')
-                    calories = get_field_value(fields, fit_lap, 'calories')
-                    ascent = get_field_value(fields, fit_lap, 'ascent')
-                    descent = get_field_value(fields, fit_lap, 'descent')
-                    avg_temp = get_field_value(fields, fit_lap, 'avg_temp')
-                    max_temp = get_field_value(fields, fit_lap, 'max_temp')
-                    min_temp = get_field_value(fields, fit_lap, 'min_temp')
-
-                    if start_time != None: # Do not add invalid intervals
-                        self.laps.append(FITLap(start_time, start_lon, start_lat,
-                                            end_lon, end_lat, distance, duration, ascent,
-                                            descent, max_speed, avg_speed, max_hr,
-                                            avg_hr, avg_cadence, max_cadence,
-                                            avg_power, max_power, avg_temp, max_temp,
-                                            min_temp, calories))
-                elif global_msg_type == 20:
-                    time = datetime.fromtimestamp(get_field_value(fields, fit_record, 'timestamp'))
-                    if time == None:
-                        '''
-                        Samples without timestamp are broken
-                        '''
-                        continue
-                    if time == record_last_time:
-                        '''
-                        Samples with duplicate timestamps are equally broken.
-                        We make a crude attempt at fixing this by bumping the
-                        previous sample 1s back.
-                        If there is already a sample at 1s back, this usually
-                        has the wrong time as well and there will be a larger
-                        gap somewhere earlier, but as of now we just give up
-                        and drop the current sample if that is the case.
-                        '''
-                        if (len(self.entries) == 1 or len(self.entries)>1 and (self.entries[-1].time - self.entries[-2].time).seconds != 1):
-                            self.entries[-1].time = self.entries[-1].time - timedelta(seconds=1)
-                        else:
-                            continue
-
-                    record_last_time = time
-                    time = time + timestamp_offset
-                    hr = get_field_value(fields, fit_record, 'hr')
-                    pwr = get_field_value(fields, fit_record, 'power')
-                    alt = get_field_value(fields, fit_record, 'alt')
-                    if alt != None:
-                        alt = alt/5. - 500
-                    lat = get_field_value(fields, fit_record, 'lat')
-                    lon = get_field_value(fields, fit_record, 'lon')
-                    if lat != None and lon != None:
-                        lat = lat*semicircle_deg
-                        lon = lon*semicircle_deg
-                    spd = get_field_value(fields, fit_record, 'speed')
-                    if spd != None:
-                        spd = spd/1000.*3.6
-                    grade = get_field_value(fields, fit_record, 'grade')
-                    temp = get_field_value(fields, fit_record, 'temperature')
-                    cad = get_field_value(fields, fit_record, 'cadence')
-                    distance = get_field_value(fields, fit_record, 'distance')
-                    if distance != None:
-                        distance = distance / 100.
-
-                    #if distance == None or spd == None:
-                        # Do not export samples like this
-                        # Observed in site_media/turan/sensor/2011-06-18-12-55-11.fit
-                    #    continue
-
-                    self.entries.append(FITEntry(time,hr,spd,cad,pwr,temp,alt, lat, lon, distance))
-                elif global_msg_type == 21:
+                start_time = get_field_value(fields, fit_lap, 'start_time')
+                if start_time != None:
+                    start_time = datetime.fromtimestamp(start_time)
+                    start_time = start_time + timestamp_offset
+                distance = get_field_value(fields, fit_lap, 'distance')
+                if distance != None:
+                    distance = distance / 100.
+                duration = ('%s') % (int(round(timer_time/1000.)))
+                start_lat = get_field_value(fields, fit_lap, 'start_lat')
+                start_lon = get_field_value(fields, fit_lap, 'start_lon')
+                if start_lat != None and start_lon != None:
+                    start_lat = start_lat * semicircle_deg
+                    start_lon = start_lon * semicircle_deg
+                end_lat = get_field_value(fields, fit_lap, 'end_lat')
+                end_lon = get_field_value(fields, fit_lap, 'end_lon')
+                if end_lat != None and end_lon != None:
+                    end_lat = end_lat * semicircle_deg
+                    end_lon = end_lon * semicircle_deg
+                avg_hr = get_field_value(fields, fit_lap, 'avg_hr')
+                max_hr = get_field_value(fields, fit_lap, 'max_hr')
+                avg_speed = get_field_value(fields, fit_lap, 'avg_speed')
+                max_speed = get_field_value(fields, fit_lap, 'max_speed')
+                if avg_speed != None and max_speed != None:
+                    avg_speed = avg_speed/1000.*3.6
+                    max_speed = max_speed/1000.*3.6
+                avg_cadence = get_field_value(fields, fit_lap, 'avg_cadence')
+                max_cadence = get_field_value(fields, fit_lap, 'max_cadence')
+                avg_power = get_field_value(fields, fit_lap, 'avg_power')
+                max_power = get_field_value(fields, fit_lap, 'max_power')
+                calories = get_field_value(fields, fit_lap, 'calories')
+                ascent = get_field_value(fields, fit_lap, 'ascent')
+                descent = get_field_value(fields, fit_lap, 'descent')
+
+                if start_time != None: # Do not add invalid intervals
+                    self.laps.append(FITLap(start_time, start_lon, start_lat,
+                                        end_lon, end_lat, distance, duration, ascent,
+                                        descent, max_speed, avg_speed, max_hr,
+                                        avg_hr, avg_cadence, max_cadence,
+                                        avg_power, max_power, None, None,
+                                        None, calories))
+            elif global_msg_type == 20:
+                timestamp = get_field_value(fields, fit_record, 'timestamp')
+                if timestamp == None:
                     '''
-                    print '%i: %s' % (global_msg_type, fit_msg_type[global_msg_type])
-                    for field in fields:
-                        print '%i: %s' % (field, fields[field])
+                    Samples without timestamp are broken
                     '''
-                    pass
-                '''
-                else:
-                    print '%i: %s' % (global_msg_type, fit_msg_type[global_msg_type])
-                '''
-            elif msg_type == 1:
-                def_hdr = f.read(5)
-                (arch,) = struct.unpack('B',def_hdr[1:2])
-                if arch == 0:
-                    endian = '<'
-                elif arch == 1:
-                    endian = '>'
-
-                (global_msg_number,n_fields) = struct.unpack(endian + 'HB',def_hdr[2:5])
-
-                fields = []
-                for i in range(n_fields):
-                    (field_def_num,field_size,base_type) = struct.unpack('BBB',f.read(3))
-                    field_endian = (base_type >> 7) & 1
-                    field_base_type = (base_type) & int('11111', 2)
-                    fields.append({'def_num': field_def_num, 'size': field_size, 'endian': field_endian, 'base_type': field_base_type})
-                local_msg_types[local_msg_type] = {'arch': arch, 'endian': endian, 'global_msg_number': global_msg_number, 'fields': fields}
+                    continue
+                time = datetime.fromtimestamp(timestamp)
+                if time == record_last_time:
+                    '''
+                    Samples with duplicate timestamps are equally broken.
+                    We make a crude attempt at fixing this by bumping the
+                    previous sample 1s back.
+                    If there is already a sample at 1s back, this usually
+                    has the wrong time as well and there will be a larger
+                    gap somewhere earlier, but as of now we just give up
+                    and drop the current sample if that is the case.
+                    '''
+                    if (len(self.entries) == 1 or len(self.entries)>1 and (self.entries[-1].time - self.entries[-2].time).seconds != 1):
+                        self.entries[-1].time = self.entries[-1].time - timedelta(seconds=1)
+                    else:
+                        continue
+
+                record_last_time = time
+                time = time + timestamp_offset
+                hr = get_field_value(fields, fit_record, 'hr')
+                pwr = get_field_value(fields, fit_record, 'power')
+                alt = get_field_value(fields, fit_record, 'alt')
+                if alt != None:
+                    alt = alt/5. - 500
+                lat = get_field_value(fields, fit_record, 'lat')
+                lon = get_field_value(fields, fit_record, 'lon')
+                if lat != None and lon != None:
+                    lat = lat*semicircle_deg
+                    lon = lon*semicircle_deg
+                spd = get_field_value(fields, fit_record, 'speed')
+                if spd != None:
+                    spd = spd/1000.*3.6
+                temp = get_field_value(fields, fit_record, 'temperature')
+                cad = get_field_value(fields, fit_record, 'cadence')
+                distance = get_field_value(fields, fit_record, 'distance')
+                if distance != None:
+                    distance = distance / 100.
+
+                #if distance == None or spd == None:
+                    # Do not export samples like this
+                    # Observed in site_media/turan/sensor/2011-06-18-12-55-11.fit
+                #    continue
+
+                self.entries.append(FITEntry(time,hr,spd,cad,pwr,temp,alt, lat, lon, distance))
 
         if self.entries:
             self.start_time = self.entries[0].time.time()
@@ -2,6 +2,11 @@
 # -*- coding: UTF-8
 #
 import json
+from math import cos, radians, hypot
+
+import numpy
+
+from spatial import METRES_PER_DEGREE
 
 
 class GeoJSONFeatureCollection(object):
@@ -45,3 +50,66 @@ class GeoJSONFeature(object):
             # Do not return empty feature
             return ''
         return json.dumps(self.res, separators=(',',':'))
+
+    def addPoints(self, lons, lats):
+        ''' Extend the line through the points '''
+        self.lines.extend(zip(lons, lats))
+
+def simplify(xs, ys, tolerance):
+    ''' Indexes of the points of the line xs, ys kept by Douglas-Peucker
+    simplification, tolerance being in the unit of xs and ys '''
+
+    n = len(xs)
+    if n < 3:
+        return numpy.arange(n)
+    keep = numpy.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = xs[last] - xs[first], ys[last] - ys[first]
+        px, py = xs[first+1:last] - xs[first], ys[first+1:last] - ys[first]
+        length = hypot(dx, dy)
+        if length:
+            distances = numpy.abs(px*dy - py*dx)/length
+        else:
+            distances = numpy.hypot(px, py)
+        i = distances.argmax()
+        if distances[i] > tolerance:
+            i += first + 1
+            keep[i] = True
+            stack.append((first, i))
+            stack.append((i, last))
+    return numpy.flatnonzero(keep)
+
+def zone_collection(lons, lats, zones, tolerance=0):
+    ''' Feature collection of the track with a feature for every run of
+    points in the same zone, joined to the run before it. With a tolerance
+    in metres the lines are simplified, keeping the ends of every run. '''
+
+    features = []
+    if len(lons) < 2:
+        return GeoJSONFeatureCollection(features)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    # Close enough to metres for simplifying
+    xs = lons*cos(radians(lats.mean()))*METRES_PER_DEGREE
+    ys = lats*METRES_PER_DEGREE
+
+    changes = numpy.flatnonzero(numpy.diff(zones)) + 1
+    starts = [0] + changes.tolist()
+    stops = changes.tolist() + [len(lons)]
+    for start, stop in zip(starts, stops):
+        first = max(start - 1, 0)
+        if stop - first < 2:
+            continue
+        if tolerance:
+            points = first + simplify(xs[first:stop], ys[first:stop], tolerance)
+        else:
+            points = numpy.arange(first, stop)
+        feature = GeoJSONFeature(int(zones[start]))
+        feature.addPoints(lons[points].tolist(), lats[points].tolist())
+        features.append(feature)
+    return GeoJSONFeatureCollection(features)
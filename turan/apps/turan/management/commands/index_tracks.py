@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from turan.apps.turan.tasks import index_tracks, unindexed_exercises
+
+class Command(BaseCommand):
+    help = 'Store the track bounding box and grid cells of exercises parsed before they were indexed'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk', type='int', default=100,
+            help='Exercises to index at a time'),
+        make_option('--queue', action='store_true', default=False,
+            help='Queue the chunks for the celery workers instead of indexing them here'),
+    )
+
+    def handle(self, *args, **options):
+        exercise_ids = unindexed_exercises()
+        chunk = options['chunk']
+        failed = 0
+        for i in range(0, len(exercise_ids), chunk):
+            if options['queue']:
+                index_tracks.delay(exercise_ids[i:i+chunk])
+            else:
+                failed += index_tracks(exercise_ids[i:i+chunk])
+                self.stdout.write('Indexed %d of %d exercises' %(min(i + chunk, len(exercise_ids)), len(exercise_ids)))
+        if options['queue']:
+            self.stdout.write('Queued %d exercises' %len(exercise_ids))
+        elif failed:
+            self.stdout.write('Indexing failed for %d exercises' %failed)
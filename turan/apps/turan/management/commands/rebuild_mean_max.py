@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+from django.db.models import get_model
+
+from turan.apps.turan.tasks import calculate_mean_max
+
+class Command(BaseCommand):
+    args = '[username ...]'
+    help = 'Store the mean maximal curves of exercises that have none, of the given users or of everyone'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', default=False,
+            help='Recalculate the curves of exercises that have one too'),
+    )
+
+    def handle(self, *usernames, **options):
+        Exercise = get_model('turan', 'Exercise')
+
+        exercises = Exercise.objects.filter(avg_speed__isnull=False).exclude(sensor_file='')
+        if not options['all']:
+            exercises = exercises.filter(meanmaxcurve__isnull=True)
+        if usernames:
+            User = get_user_model()
+            missing = set(usernames) - set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+            if missing:
+                raise CommandError('No users %s' %', '.join(sorted(missing)))
+            exercises = exercises.filter(user__username__in=usernames)
+        # One at a time, the series of every exercise would not fit in memory
+        exercise_ids = list(exercises.order_by('id').values_list('id', flat=True))
+        for i, exercise_id in enumerate(exercise_ids):
+            try:
+                calculate_mean_max(Exercise.objects.get(pk=exercise_id))
+            except Exception, e:
+                self.stderr.write('Mean max of exercise %s failed: %s' %(exercise_id, e))
+            if (i + 1) % 100 == 0 or i + 1 == len(exercise_ids):
+                self.stdout.write('Stored mean max of %d of %d exercises' %(i + 1, len(exercise_ids)))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+from django.db.models import get_model
+
+from turan.apps.turan.tasks import rebuild_power_records
+
+class Command(BaseCommand):
+    args = '[username ...]'
+    help = 'Recalculate the all time and season power records, of the given users or of everyone'
+
+    def handle(self, *usernames, **options):
+        User = get_user_model()
+        Exercise = get_model('turan', 'Exercise')
+
+        users = User.objects.filter(exercise__bestpowereffort__isnull=False).distinct().order_by('username')
+        if usernames:
+            users = users.filter(username__in=usernames)
+            missing = set(usernames) - set(users.values_list('username', flat=True))
+            if missing:
+                raise CommandError('No power efforts by %s' %', '.join(sorted(missing)))
+        for user in users:
+            dates = Exercise.objects.filter(user=user, date__isnull=False, bestpowereffort__isnull=False).dates('date', 'year')
+            for season in [0] + [date.year for date in dates]:
+                rebuild_power_records(user.id, season)
+            self.stdout.write('Rebuilt power records of %s' %user.username)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+
+from turan.apps.turan.tasks import rebuild_statistics
+
+class Command(BaseCommand):
+    args = '[username ...]'
+    help = 'Recalculate the PeriodStatistics of the statistics page, of the given users or of everyone'
+
+    def handle(self, *usernames, **options):
+        User = get_user_model()
+        users = User.objects.filter(exercise__isnull=False).distinct().order_by('username')
+        if usernames:
+            users = users.filter(username__in=usernames)
+            missing = set(usernames) - set(users.values_list('username', flat=True))
+            if missing:
+                raise CommandError('No exercises by %s' %', '.join(sorted(missing)))
+        for user in users:
+            rebuild_statistics(user.id)
+            self.stdout.write('Rebuilt statistics of %s' %user.username)
@@ -20,8 +20,8 @@ import types
 from os.path import join
 import re
 
-import urllib
 import json
+import numpy
 
 from celery.task.sets import subtask
 from datetime import datetime
@@ -29,13 +29,18 @@ import datetime
 
 from durationfield import DurationField
 
-from gpxparser import GPXParser, proj_distance
+from gpxparser import GPXParser, proj_distances
 from gpxwriter import GPXWriter
 
 from tasks import create_simplified_gpx, create_png_from_gpx, create_gpx_from_details, \
         merge_sensordata, calculate_ascent_descent_gaussian, calculate_best_efforts, \
         parse_and_calculate, filldistance, hr2zone, watt2zone, \
-        getgradients
+        getgradients, store_series, store_histograms, bulk_replace, rebuild_power_records, start_segment_backfill, \
+        lookup_route_name, schedule_day_update, rebuild_daily_load, \
+        delete_track_geojson, invalidate_track_geojson
+from series import Series, unpack_arrays
+from spatial import bump_segment_index, get_location_index, bump_location_index
+from cachekeys import bump_exercise, bump_segment
 
 if "notification" in settings.INSTALLED_APPS:
     from notification import models as notification
@@ -44,7 +49,6 @@ else:
 
 gpxstore = FileSystemStorage(location=settings.GPX_STORAGE)
 AUTOROUTE_DESCRIPTION = "Autoroute"
-GEOURL = "http://api.geonames.org/findNearbyPlaceNameJSON?formatted=true&username=turan&style=full&lng=%f&lat=%f"
 
 class ExerciseType(models.Model):
 
@@ -206,14 +210,18 @@ class Route(models.Model):
                         self.ascent = g.ascent
                         self.descent = g.descent
         # No name, possibly autogenerated route, try and set name
+        lookup_name = False
         if not self.name:
             self.set_geo_title()
+            lookup_name = self.description == AUTOROUTE_DESCRIPTION and self.start_lat and self.start_lon
         # Check for single serving that really are not
         if self.single_serving and self.exercise_set.count() > 1:
             self.single_serving = False
         elif not self.single_serving and self.description == AUTOROUTE_DESCRIPTION and self.exercise_set.count() < 2:
             self.single_serving = True
         super(Route, self).save(force_insert, force_update)
+        if lookup_name and getattr(settings, 'GEONAMES_ROUTE_NAMES', True):
+            lookup_route_name.delay(self.id, self.name)
         if self.gpx_file:
             # generate svg if it doesn't exist (after save, it uses id for filename)
             filename = 'svg/%s.png' %self.id
@@ -284,54 +292,27 @@ class Route(models.Model):
         return len(self.get_trips())
 
     def get_start_location_name(self):
+        ''' Nearest saved town to the start, see tasks.lookup_route_name for
+        the geonames lookup '''
         lon1, lat1 = self.start_lon, self.start_lat
         start_town = ''
         if lon1 and lat1:
-            try:
-                f = urllib.urlopen(GEOURL % (self.start_lon, self.start_lat,))
-                start = json.load(f)["geonames"][0]
-                if start["countryCode"] != "NO":
-                    return start["toponymName"]
-            except:
-                pass
-            s_distance = 99999999
-            for loc in find_close_locations(lon1, lat1):
-                this_distance = proj_distance(lat1, lon1, loc.lat, loc.lon)
-                if this_distance < s_distance:
-                    start_town = loc.town
-                    s_distance = this_distance
+            start_town = find_nearest_town(lon1, lat1)
         return start_town
 
     def get_geo_title(self):
         lon1, lat1 = self.start_lon, self.start_lat
         lon2, lat2 = self.end_lon, self.end_lat
         if lon1 and lat1 and lat2 and lon2:
-            s_distance = 99999999
             farthest = self.find_farthest_pos_from_start()
             if not farthest: return None # FIXME later why does this happen /garmin_connect_66078400.tcx
             farthest_lon, farthest_lat = farthest
-            f_distance = 99999999
-            e_distance = 99999999
-            start_town = ''
             farthest_town = ''
-            end_town = ''
-
-            for loc in find_close_locations(lon1, lat1):
-                this_distance = proj_distance(lat1, lon1, loc.lat, loc.lon)
-                if this_distance < s_distance:
-                    start_town = loc.town
-                    s_distance = this_distance
-            for loc in find_close_locations(farthest_lon, farthest_lat):
-                if farthest_lon and farthest_lat:
-                    this_distance = proj_distance(farthest_lat, farthest_lon, loc.lat, loc.lon)
-                    if this_distance < f_distance:
-                        farthest_town = loc.town
-                        f_distance = this_distance
-            for loc in find_close_locations(lon2, lat2):
-                this_distance = proj_distance(lat2, lon2, loc.lat, loc.lon)
-                if this_distance < e_distance:
-                    end_town = loc.town
-                    e_distance = this_distance
+
+            start_town = find_nearest_town(lon1, lat1)
+            if farthest_lon and farthest_lat:
+                farthest_town = find_nearest_town(farthest_lon, farthest_lat)
+            end_town = find_nearest_town(lon2, lat2)
             if farthest_town:
                 if start_town == end_town and farthest_town != end_town:
                     return '%s %s %s' %(start_town, farthest_town, end_town)
@@ -354,17 +335,15 @@ class Route(models.Model):
         if self.gpx_file:
             details = GPXParser(self.gpx_file).entries
             if details:
-                lon, lat = details[0].lon, details[0].lat
-                distance = 0
-                max_lon, max_lat = 0, 0
-                for d in details:
-                    this_lon, this_lat = d.lon, d.lat
-                    if this_lon and this_lat:
-                        this_distance = proj_distance(lat, lon, this_lat, this_lon)
-                        if this_distance > distance:
-                            distance = this_distance
-                            max_lon, max_lat = this_lon, this_lat
-                return max_lon, max_lat
+                lons = numpy.array([d.lon or 0 for d in details], dtype=numpy.float64)
+                lats = numpy.array([d.lat or 0 for d in details], dtype=numpy.float64)
+                distances = proj_distances(lats[0], lons[0], lats, lons)
+                with numpy.errstate(invalid='ignore'):
+                    distances[(lons == 0) | (lats == 0) | ~(distances > 0)] = 0
+                i = distances.argmax()
+                if distances[i] > 0:
+                    return lons[i], lats[i]
+                return 0, 0
 
     def gpx_valid(self):
         if self.gpx_file and \
@@ -455,6 +434,44 @@ class Exercise(models.Model):
     def get_details(self):
         return self.exercisedetail_set
 
+    def get_series(self):
+        ''' Return the details as a Series of NumPy arrays. Read from the
+        packed copy, which is created on first use for exercises parsed
+        before it existed. '''
+        if not hasattr(self, '_series'):
+            try:
+                self._series = Series.unpack(ExerciseSeries.objects.get(exercise=self).data)
+            except ExerciseSeries.DoesNotExist:
+                self._series = store_series(self)
+        return self._series
+
+    def get_graph_series(self, points):
+        ''' Return the Series, or the finest downsampled level of it with at
+        most points samples, or the coarsest level if none is that small.
+        The levels have the index of their samples in the Series as
+        extra['index'] '''
+        levels = list(ExerciseSeriesLevel.objects.filter(exercise=self).order_by('factor').values_list('factor', 'length'))
+        if not levels or levels[0][0]*levels[0][1] <= points:
+            return self.get_series()
+        factors = [factor for factor, length in levels if length <= points] or [levels[-1][0]]
+        return Series.unpack(ExerciseSeriesLevel.objects.get(exercise=self, factor=factors[0]).data)
+
+    def get_mean_max(self):
+        ''' Return the mean maximal curves keyed on speed and power, with
+        their durations as durations, empty if the exercise has none '''
+        try:
+            return MeanMaxCurve.objects.get(exercise=self).get_curves()
+        except MeanMaxCurve.DoesNotExist:
+            return {}
+
+    def get_histograms(self):
+        ''' Return the time histograms of tasks.store_histograms, which are
+        created on first use for exercises analyzed before they existed '''
+        try:
+            return ExerciseHistograms.objects.get(exercise=self).get_histograms()
+        except ExerciseHistograms.DoesNotExist:
+            return store_histograms(self)
+
     def save(self, *args, **kwargs):
         super(Exercise, self).save(*args, **kwargs)
         if self.sensor_file:
@@ -500,9 +517,8 @@ class Exercise(models.Model):
     def is_smart_sampled(self):
         filename = self.sensor_file.name
         if filename.lower().endswith('.tcx'):
-            exercise_details = self.get_details().all()[1:3]
-            delta_t = (exercise_details[1].time - exercise_details[0].time).seconds
-            if delta_t > 1:
+            seconds = self.get_series().seconds()
+            if len(seconds) > 2 and seconds[2] - seconds[1] > 1:
                 return True
         elif filename.lower().endswith('.fit'):
             if not self.avg_power: # Edges smart sample if no power meter
@@ -536,9 +552,15 @@ class Exercise(models.Model):
                     self.route.delete()
         super(Exercise, self).delete(*args, **kwargs)
 
+    def get_ftp(self):
+        ''' FTP of the user at the date of the exercise '''
+        if not hasattr(self, '_ftp'):
+            self._ftp = self.user.get_profile().get_ftp(self.date)
+        return self._ftp
+
     def get_intensityfactor(self):
         ''' Find IF for exercise '''
-        userftp = self.user.get_profile().get_ftp(self.date)
+        userftp = self.get_ftp()
         try:
             return round(float(self.normalized_power)/userftp, 3)
         except ZeroDivisionError:
@@ -547,18 +569,18 @@ class Exercise(models.Model):
     def get_tss(self):
         ''' Estimating TSS
         http://home.trainingpeaks.com/articles/cycling/estimating-training-stress-score-(tss)-by-joe-friel.aspx '''
-        userftp = self.user.get_profile().get_ftp(self.date)
+        userftp = self.get_ftp()
         tss = int(round(float(self.duration.total_seconds() * self.normalized_power * self.get_intensityfactor() ) / ( userftp * 3600 ) * 100))
         return tss
 
     def get_ri(self):
-        userftp = self.user.get_profile().get_ftp(self.date)
+        userftp = self.get_ftp()
         # TODO write memoize function attr for self.userftp
         return float(self.xPower) / userftp
 
     def get_bikescore(self):
         ''' Find bikescore for exercise '''
-        userftp = self.user.get_profile().get_ftp(self.date)
+        userftp = self.get_ftp()
         if not self.duration:
             return
         if not self.xPower:
@@ -651,6 +673,65 @@ class ExerciseDetail(models.Model):
     class Meta:
         ordering = ('time',)
 
+class ExerciseSeries(models.Model):
+    ''' Packed copy of the details of an exercise, see series.Series '''
+    exercise = models.OneToOneField(Exercise, primary_key=True)
+    data = models.BinaryField()
+
+class ExerciseSeriesLevel(models.Model):
+    ''' Downsampled copy of the series of an exercise for graphs, see
+    series.Series.downsample '''
+    exercise = models.ForeignKey(Exercise)
+    factor = models.IntegerField()
+    length = models.IntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = ('exercise', 'factor')
+
+class ExerciseTrackZones(models.Model):
+    ''' Packed positions and HR zones of the track of an exercise, see
+    tasks.store_track_geojson '''
+    exercise = models.OneToOneField(Exercise, primary_key=True)
+    data = models.BinaryField()
+
+class ExerciseExtent(models.Model):
+    ''' Bounding box of the track of an exercise, see tasks.store_track_index '''
+    exercise = models.OneToOneField(Exercise, primary_key=True, related_name='extent')
+    min_lat = models.FloatField(db_index=True)
+    min_lon = models.FloatField(db_index=True)
+    max_lat = models.FloatField(db_index=True)
+    max_lon = models.FloatField(db_index=True)
+
+    def get_bbox(self):
+        return self.min_lat, self.min_lon, self.max_lat, self.max_lon
+
+class ExerciseCell(models.Model):
+    ''' Grid cell the track of an exercise passes through, keyed by
+    spatial.track_cells '''
+    exercise = models.ForeignKey(Exercise, related_name='cells')
+    cell = models.IntegerField(db_index=True)
+
+
+class MeanMaxCurve(models.Model):
+    ''' Best average speed and power of an exercise at the durations of
+    tasks.mean_max_durations, packed with series.pack_arrays along with
+    those durations '''
+    exercise = models.OneToOneField(Exercise, primary_key=True)
+    data = models.BinaryField()
+
+    def get_curves(self):
+        return unpack_arrays(self.data)
+
+class ExerciseHistograms(models.Model):
+    ''' Seconds of an exercise in every HR and power zone and at every value
+    of its fields, packed with series.pack_arrays, see
+    tasks.store_histograms '''
+    exercise = models.OneToOneField(Exercise, primary_key=True)
+    data = models.BinaryField()
+
+    def get_histograms(self):
+        return unpack_arrays(self.data)
 
 class BestPowerEffort(models.Model):
     exercise = models.ForeignKey(Exercise)
@@ -664,6 +745,19 @@ class BestPowerEffort(models.Model):
     class Meta:
         ordering = ('duration',)
 
+class PowerRecord(models.Model):
+    ''' Best power of a user for a duration, all time (season 0) or for one
+    season (year). Kept up to date from the best power efforts. '''
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    season = models.IntegerField(default=0)
+    duration = models.IntegerField()
+    power = models.IntegerField()
+    exercise = models.ForeignKey(Exercise, blank=True, null=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        ordering = ('duration',)
+        unique_together = ('user', 'season', 'duration')
+
 class HRZoneSummary(models.Model):
     exercise = models.ForeignKey(Exercise)
     zone = models.IntegerField()
@@ -693,6 +787,102 @@ class BestSpeedEffort(models.Model):
     class Meta:
         ordering = ('duration',)
 
+statistics_periods = (
+            ('D', _('Day')),
+            ('W', _('Week')),
+            ('M', _('Month')),
+            ('Y', _('Year')),
+            ('A', _('All time')),
+                    )
+
+class PeriodStatistics(models.Model):
+    ''' Totals and records of the exercises of a user in a period starting
+    at start, of one exercise type or of all when exercise_type is null.
+    Kept up to date by tasks.update_statistics for the statistics page. '''
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    period = models.CharField(max_length=1, choices=statistics_periods)
+    start = models.DateField()
+    exercise_type = models.ForeignKey(ExerciseType, blank=True, null=True)
+
+    num_trips = models.IntegerField(default=0)
+    sum_distance = models.FloatField(default=0) # km
+    sum_duration = models.BigIntegerField(default=0) # microseconds, like DurationField
+    sum_energy = models.IntegerField(default=0) # kcal
+    sum_ascent = models.IntegerField(default=0) # m
+
+    avg_avg_speed = models.FloatField(blank=True, null=True)
+    max_avg_speed = models.FloatField(blank=True, null=True)
+    max_speed = models.FloatField(blank=True, null=True)
+    avg_avg_hr = models.FloatField(blank=True, null=True)
+    avg_normalized_power = models.FloatField(blank=True, null=True)
+    max_normalized_power = models.IntegerField(blank=True, null=True)
+    avg_avg_pedaling_power = models.FloatField(blank=True, null=True)
+    max_avg_pedaling_power = models.IntegerField(blank=True, null=True)
+    max_max_power = models.IntegerField(blank=True, null=True)
+
+    # Of the exercises on routes with ascent and distance
+    avgclimb = models.FloatField(blank=True, null=True) # m/km
+    avgclimbperhour = models.FloatField(blank=True, null=True) # m/h
+    avglen = models.FloatField(blank=True, null=True) # km
+
+    class Meta:
+        unique_together = ('user', 'period', 'start', 'exercise_type')
+        index_together = [('period', 'start', 'exercise_type')]
+
+    def __unicode__(self):
+        return unicode(self.user)
+
+    @property
+    def max_hr(self):
+        return self.user.max_hr
+
+class PeriodZone(models.Model):
+    ''' Time in HR zone of PeriodStatistics '''
+    statistics = models.ForeignKey(PeriodStatistics, related_name='zones')
+    zone = models.IntegerField()
+    duration = models.IntegerField()
+
+    class Meta:
+        ordering = ('zone',)
+
+    def __unicode__(self):
+        return unicode(self.statistics.user)
+
+class PeriodBestPower(models.Model):
+    ''' Best power effort of PeriodStatistics for a duration '''
+    statistics = models.ForeignKey(PeriodStatistics, related_name='best_powers')
+    duration = models.IntegerField()
+    power = models.IntegerField()
+
+    class Meta:
+        ordering = ('duration',)
+
+    def __unicode__(self):
+        return unicode(self.statistics.user)
+
+    @property
+    def max_power(self):
+        return self.power
+
+class DailyLoad(models.Model):
+    ''' Training load of a user on a day with exercises, kept up to date by
+    tasks.update_daily_load. ctl and atl are the chronic and acute training
+    load after the day, tsb their balance going into it. '''
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    date = models.DateField()
+    tss = models.IntegerField(default=0)
+    bikescore = models.IntegerField(default=0)
+    duration = models.IntegerField(default=0) # s
+    distance = models.FloatField(default=0) # km
+    kcal = models.IntegerField(default=0)
+    ctl = models.FloatField(default=0)
+    atl = models.FloatField(default=0)
+    tsb = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ('date',)
+        unique_together = ('user', 'date')
+
 merge_choices = (
             ('M', _('Merge')),
             ('P', _('Prepend')),
@@ -726,6 +916,57 @@ class MergeSensorFile(models.Model):
 
         return result
 
+job_states = (
+            ('P', _('Pending')),
+            ('R', _('Running')),
+            ('D', _('Done')),
+            ('F', _('Failed')),
+                    )
+
+class BulkImport(models.Model):
+    ''' A zip archive of exercise files uploaded for import. Every file in
+    the archive gets a BulkImportItem, which are parsed by a bounded number
+    of workers, see tasks.run_bulk_import '''
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    created = models.DateTimeField(auto_now_add=True)
+    archive = models.FileField(upload_to='bulk', storage=gpxstore)
+    state = models.CharField(max_length=1, choices=job_states, default='P')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.user, self.created)
+
+    def get_absolute_url(self):
+        return reverse('bulk_import_progress', kwargs={ 'object_id': self.id })
+
+    def get_progress(self):
+        ''' Number of items done, failed and remaining '''
+        counts = dict(self.items.values_list('state').annotate(Count('id')))
+        return {
+            'total': sum(counts.values()),
+            'done': counts.get('D', 0),
+            'failed': counts.get('F', 0),
+            'remaining': counts.get('P', 0) + counts.get('R', 0),
+            'state': self.state,
+        }
+
+class BulkImportItem(models.Model):
+    ''' One file in a BulkImport '''
+
+    job = models.ForeignKey(BulkImport, related_name='items')
+    filename = models.CharField(max_length=255)
+    state = models.CharField(max_length=1, choices=job_states, default='P')
+    exercise = models.ForeignKey(Exercise, blank=True, null=True, on_delete=models.SET_NULL)
+    error = models.TextField(blank=True)
+    # When a worker started on it, see tasks.claim_bulk_import_item
+    claimed = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return self.filename
+
 class Interval(models.Model):
     ''' Interval / Lap model '''
 
@@ -911,7 +1152,7 @@ class Segment(models.Model):
                         break
         #gradobj = SegmentAltitudeGradient.objects.filter(segment=self.id).exists()
         #if not gradobj:
-        SegmentAltitudeGradient.objects.filter(segment=self.id).delete()
+        segment_gradients = []
         if True: # TODO somehow figure out a way to get the sanest result
             # No Gradient Found, try and generate
             for slope in self.get_slopes():
@@ -941,8 +1182,9 @@ class Segment(models.Model):
                         sag.altitude = altitudes[i]
                         sag.lon = lons[i]
                         sag.lat = lats[i]
-                        sag.save()
+                        segment_gradients.append(sag)
                     break # only break if we found exercise with distances
+        bulk_replace(SegmentAltitudeGradient.objects.filter(segment=self.id), segment_gradients)
 
         # generate png if it doesn't exist (after save, it uses id for filename)
         if self.gpx_file:
@@ -1102,6 +1344,34 @@ class SegmentDetail(models.Model):
 
         return self.start + self.length/1000
 
+class SegmentBackfill(models.Model):
+    ''' Search of the exercise history for passes of a segment, run in
+    chunks by tasks.run_segment_backfill '''
+
+    segment = models.ForeignKey(Segment)
+    created = models.DateTimeField(auto_now_add=True)
+    state = models.CharField(max_length=1, choices=job_states, default='P')
+    total = models.IntegerField(default=0)
+    done = models.IntegerField(default=0)
+    found = models.IntegerField(default=0)
+    # Exercises counted in done that the search failed in
+    failed = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ('-created',)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.segment, self.created)
+
+    def get_progress(self):
+        return {
+            'total': self.total,
+            'done': self.done,
+            'found': self.found,
+            'failed': self.failed,
+            'remaining': max(self.total - self.done, 0),
+            'state': self.state,
+        }
 
 
 class CommonAltitudeGradient(models.Model):
@@ -1110,6 +1380,7 @@ class CommonAltitudeGradient(models.Model):
     gradient   = models.FloatField()
 
     class Meta:
+        abstract = True
         ordering = ('xaxis',)
 
 class ExerciseAltitudeGradient(CommonAltitudeGradient):
@@ -1136,23 +1407,9 @@ class Location(models.Model):
         verbose_name = _("Location")
         verbose_name_plural = _("Locations")
 
-def find_close_locations(lon, lat):
-    """ Find any locations that are deemed close to lon/lat"""
-    return Location.objects.filter(lon__gt=lon-1).filter(lon__lt=lon+1).filter(lat__gt=lat-1).filter(lat__lt=lat+1)
-
 def find_nearest_town(lon, lat):
-    ''' Iterate saved locations and find nearest town '''
-
-    distance = 99999999
-    town = ''
-
-    for loc in find_close_locations(lon, lat):
-        this_distance = proj_distance(lat, lon, loc.lat, loc.lon)
-        if this_distance < distance:
-            town = loc.town
-            distance = this_distance
-
-    return town
+    ''' Find the town of the nearest saved location '''
+    return get_location_index().nearest_town(lat, lon)
 
 # handle notification of new comments
 from threadedcomments.models import ThreadedComment
@@ -1170,6 +1427,102 @@ def delete_segmentdetail(sender, instance, **kwargs):
     instance.segment.save()
 models.signals.post_delete.connect(delete_segmentdetail, sender=SegmentDetail)
 
+def delete_exercise_power_records(sender, instance, **kwargs):
+    ''' Find new holders for the power records of a deleted exercise '''
+    orphans = PowerRecord.objects.filter(user=instance.user_id, exercise__isnull=True)
+    for season in set(orphans.values_list('season', flat=True)):
+        rebuild_power_records(instance.user_id, season, list(orphans.filter(season=season).values_list('duration', flat=True)))
+models.signals.post_delete.connect(delete_exercise_power_records, sender=Exercise)
+
+def delete_exercise_track(sender, instance, **kwargs):
+    ''' The stored GeoJSON files of the track are served without a query '''
+    delete_track_geojson(instance)
+models.signals.post_delete.connect(delete_exercise_track, sender=Exercise)
+
+def segment_changed(sender, instance, **kwargs):
+    ''' Segments are looked up by position through the segment index '''
+    bump_segment_index()
+    bump_segment(instance.id)
+models.signals.post_save.connect(segment_changed, sender=Segment)
+models.signals.post_delete.connect(segment_changed, sender=Segment)
+
+def segment_located(sender, instance, **kwargs):
+    ''' Search the history for passes of a segment once it has a position '''
+    if instance.start_lat and instance.start_lon and instance.end_lat and instance.end_lon \
+            and not SegmentBackfill.objects.filter(segment=instance).exists():
+        start_segment_backfill(instance)
+models.signals.post_save.connect(segment_located, sender=Segment)
+
+def exercise_changed(sender, instance, **kwargs):
+    ''' Drop the cached artifacts of an exercise when it or its permissions
+    are edited, or it is deleted '''
+    bump_exercise(instance.pk)
+models.signals.post_save.connect(exercise_changed, sender=Exercise)
+models.signals.post_delete.connect(exercise_changed, sender=Exercise)
+models.signals.post_save.connect(exercise_changed, sender=ExercisePermission)
+models.signals.post_delete.connect(exercise_changed, sender=ExercisePermission)
+
+def exercise_moving(sender, instance, **kwargs):
+    ''' Remember the user and date of an exercise before it is edited, the
+    statistics of its old periods must be updated too '''
+    instance._statistics_key = None
+    if instance.pk:
+        instance._statistics_key = sender.objects.filter(pk=instance.pk).values_list('user', 'date').first()
+models.signals.pre_save.connect(exercise_moving, sender=Exercise)
+
+def exercise_statistics_changed(sender, instance, **kwargs):
+    ''' Update the statistics and training load of the periods the
+    exercise is or was in '''
+    keys = set([(instance.user_id, instance.date)])
+    if getattr(instance, '_statistics_key', None):
+        keys.add(instance._statistics_key)
+    for user_id, date in keys:
+        if user_id and date:
+            schedule_day_update(user_id, date)
+models.signals.post_save.connect(exercise_statistics_changed, sender=Exercise)
+models.signals.post_delete.connect(exercise_statistics_changed, sender=Exercise)
+
+def route_statistics_changed(sender, instance, **kwargs):
+    ''' Distance and ascent of the exercises come from their route '''
+    for user_id, date in instance.exercise_set.order_by().values_list('user', 'date').distinct():
+        if date:
+            schedule_day_update(user_id, date)
+models.signals.post_save.connect(route_statistics_changed, sender=Route)
+
+from turan.apps.profiles.models import UserProfileDetail, Profile
+def ftp_changed(sender, instance, **kwargs):
+    ''' The load of the exercises after a new FTP depends on it '''
+    if instance.ftp:
+        rebuild_daily_load.delay(instance.userprofile_id, instance.time.date())
+models.signals.post_save.connect(ftp_changed, sender=UserProfileDetail)
+models.signals.post_delete.connect(ftp_changed, sender=UserProfileDetail)
+
+def max_hr_changing(sender, instance, **kwargs):
+    ''' Remember the max HR of a profile before it is edited '''
+    instance._old_max_hr = None
+    if instance.pk:
+        instance._old_max_hr = sender.objects.filter(pk=instance.pk).values_list('max_hr', flat=True).first()
+models.signals.pre_save.connect(max_hr_changing, sender=Profile)
+
+def max_hr_changed(sender, instance, created, **kwargs):
+    ''' The stored tracks are coloured by the HR zones of the max HR '''
+    if not created and instance._old_max_hr != instance.max_hr:
+        invalidate_track_geojson.delay(instance.pk)
+models.signals.post_save.connect(max_hr_changed, sender=Profile)
+
+def segmentdetail_changed(sender, instance, **kwargs):
+    ''' The segment is drawn from its details '''
+    if instance.segment_id:
+        bump_segment(instance.segment_id)
+models.signals.post_save.connect(segmentdetail_changed, sender=SegmentDetail)
+models.signals.post_delete.connect(segmentdetail_changed, sender=SegmentDetail)
+
+def location_changed(sender, instance, **kwargs):
+    ''' Towns are looked up by position through the location index '''
+    bump_location_index()
+models.signals.post_save.connect(location_changed, sender=Location)
+models.signals.post_delete.connect(location_changed, sender=Location)
+
 
 
 
@@ -1210,15 +1563,3 @@ class GetOrNoneManager(models.Manager):
         except self.model.DoesNotExist:
             return None
 
-class Freq(models.Model):
-    freq_choices = (
-        ('H', _('Heart rate')),
-        ('C', _('Cadence')),
-        ('P', _('Power')),
-        ('S', _('Speed')),
-    )
-    exercise     = models.ForeignKey(Exercise)
-    json         = models.TextField()
-    freq_type    = models.CharField(max_length=1, choices=freq_choices)
-
-    objects = GetOrNoneManager()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+#
+''' Columnar storage of exercise samples.
+
+The samples of an exercise are kept as one NumPy array per field and packed
+into a single compressed blob, so readers get every value with one read and
+one decode instead of instantiating an ExerciseDetail per sample. '''
+
+import calendar
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+
+import numpy
+from django.conf import settings
+from django.utils import timezone
+
+# Fields in ExerciseDetail order, time first
+SERIES_FIELDS = ('time', 'distance', 'speed', 'hr', 'altitude', 'lat', 'lon', 'cadence', 'power', 'temp')
+
+# Fields that are integers in ExerciseDetail
+SERIES_INT_FIELDS = ('hr', 'cadence', 'power')
+
+# Fields that are not downsampled by extremes, see Series.downsample
+SERIES_POSITION_FIELDS = ('time', 'distance', 'lat', 'lon')
+
+# Downsampling factors of the levels stored for graphs of long exercises
+SERIES_LEVELS = (4, 16)
+
+# Exercises with fewer samples get no downsampled levels
+SERIES_LEVEL_MIN_SAMPLES = 2000
+
+# Positions and distances need the precision, the rest fits in float32
+SERIES_DTYPES = {
+    'time': numpy.float64,
+    'distance': numpy.float64,
+    'lat': numpy.float64,
+    'lon': numpy.float64,
+}
+
+class SeriesRow(object):
+    ''' One sample of a Series with the attributes of an ExerciseDetail, for
+    code that works on the samples one by one '''
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class Series(object):
+    ''' The samples of one exercise as NumPy arrays.
+
+    time is seconds since start, start being the datetime of the first
+    sample. Missing values are NaN. '''
+
+    def __init__(self, start=None, columns=None):
+        self.start = start
+        self.columns = {}
+        for name in SERIES_FIELDS:
+            values = None
+            if columns:
+                values = columns.get(name)
+            if values is None:
+                values = []
+            self.columns[name] = numpy.asarray(values, dtype=SERIES_DTYPES.get(name, numpy.float32))
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def has(self, name):
+        ''' True if the field has at least one sample with a value '''
+        values = self.columns[name]
+        return bool(len(values)) and not numpy.isnan(values).all()
+
+    def datetimes(self):
+        ''' The sample times as datetimes '''
+        return [self.start + timedelta(seconds=t) for t in self.columns['time']]
+
+    def seconds(self):
+        ''' Whole seconds since start of each sample '''
+        return numpy.floor(self.columns['time']).astype(numpy.int64)
+
+    def per_second(self, name, max_gap=60):
+        ''' Resample a field to one value per second of the exercise.
+
+        The seconds between two samples get the value of the latter sample,
+        missing values count as 0. Seconds in a pause of max_gap or more are
+        not valid. Returns the values and the valid mask, index k being the
+        second from k to k+1. '''
+
+        seconds = self.seconds()
+        if len(seconds) < 2:
+            return numpy.zeros(0), numpy.zeros(0, dtype=bool)
+        deltas = numpy.diff(seconds).clip(0)
+        values = numpy.nan_to_num(self.columns[name][1:].astype(numpy.float64))
+        return numpy.repeat(values, deltas), numpy.repeat(deltas < max_gap, deltas)
+
+    def sample_index(self, second, side='right'):
+        ''' Index of the sample at the second, or the last one before it
+        (side='right') or the first one after it (side='left') if there is no
+        sample at exactly that second '''
+        seconds = self.seconds()
+        if side == 'right':
+            return max(0, int(numpy.searchsorted(seconds, second, 'right')) - 1)
+        return min(len(seconds) - 1, int(numpy.searchsorted(seconds, second, 'left')))
+
+    def rows(self):
+        ''' Return the samples as a list of SeriesRows, missing values as None.
+        Built once per Series. '''
+        if not hasattr(self, '_rows'):
+            columns = [self.datetimes()]
+            for name in SERIES_FIELDS[1:]:
+                cast = name in SERIES_INT_FIELDS and int or float
+                columns.append([None if v != v else cast(v) for v in self.columns[name].tolist()])
+            self._rows = [SeriesRow(**dict(zip(SERIES_FIELDS, values))) for values in zip(*columns)]
+        return self._rows
+
+    def downsample(self, factor):
+        ''' Return a Series of about len/factor samples for graphs, with the
+        index of each of its samples in this one as index.
+
+        Every bucket of 2*factor samples becomes two samples, at the time,
+        distance and position of the first and the middle sample of the
+        bucket. The other fields get the smallest and the largest value of
+        the bucket, in the order they came, so peaks are kept. '''
+
+        n = len(self)
+        size = 2*factor
+        starts = numpy.arange(0, n, size)
+        buckets = len(starts)
+        index = numpy.empty(2*buckets, dtype=numpy.int64)
+        index[0::2] = starts
+        index[1::2] = numpy.minimum(starts + factor, n - 1)
+        # A last bucket of one sample gives one
+        length = 2*buckets - int(bool(n) and n - starts[-1] == 1)
+        rows = numpy.arange(buckets)
+
+        columns = {}
+        for name in SERIES_FIELDS:
+            values = self.columns[name]
+            if name in SERIES_POSITION_FIELDS:
+                columns[name] = values[index[:length]]
+                continue
+            padded = numpy.empty(buckets*size, dtype=values.dtype)
+            padded.fill(numpy.nan)
+            padded[:n] = values
+            padded = padded.reshape(buckets, size)
+            missing = numpy.isnan(padded)
+            lowest = numpy.where(missing, numpy.inf, padded).argmin(axis=1)
+            highest = numpy.where(missing, -numpy.inf, padded).argmax(axis=1)
+            extremes = numpy.empty(2*buckets, dtype=values.dtype)
+            extremes[0::2] = padded[rows, numpy.minimum(lowest, highest)]
+            extremes[1::2] = padded[rows, numpy.maximum(lowest, highest)]
+            columns[name] = extremes[:length]
+
+        series = Series(self.start, columns)
+        series.index = index[:length]
+        return series
+
+    def slice(self, start, stop):
+        ''' Return a new Series with the samples in [start:stop] '''
+        columns = dict((name, values[start:stop]) for name, values in self.columns.items())
+        return Series(self.start, columns)
+
+    @classmethod
+    def from_values(cls, rows):
+        ''' Build from tuples in SERIES_FIELDS order, i.e. the output of
+        values_list(*SERIES_FIELDS) '''
+
+        rows = list(rows)
+        if not rows:
+            return cls()
+        start = rows[0][0]
+        columns = {}
+        for index, name in enumerate(SERIES_FIELDS):
+            if name == 'time':
+                values = [(row[0] - start).total_seconds() for row in rows]
+            else:
+                values = [row[index] for row in rows]
+                values = [numpy.nan if v is None else v for v in values]
+            columns[name] = values
+        # Parsers give naive times, make it aware like the database would
+        if settings.USE_TZ and timezone.is_naive(start):
+            start = timezone.make_aware(start, timezone.get_default_timezone())
+        return cls(start, columns)
+
+    @classmethod
+    def from_entries(cls, entries):
+        ''' Build from objects with the fields as attributes, like parser
+        entries or ExerciseDetails '''
+
+        return cls.from_values([tuple(getattr(e, name, None) for name in SERIES_FIELDS) for e in entries])
+
+    def pack(self, **extra):
+        ''' Return the series, and any extra named arrays, as a compressed
+        string '''
+
+        aware = 0
+        epoch = 0.0
+        if self.start:
+            aware = int(timezone.is_aware(self.start))
+            epoch = calendar.timegm(self.start.utctimetuple()) + self.start.microsecond/1000000.0
+        arrays = dict(self.columns, **extra)
+        return pack_arrays(start=numpy.array([epoch, aware]), **arrays)
+
+    @classmethod
+    def unpack(cls, data):
+        ''' Inverse of pack, the extra arrays are set as extra '''
+
+        archive = unpack_arrays(data)
+        epoch, aware = archive['start']
+        columns = dict((name, archive[name]) for name in SERIES_FIELDS)
+        start = None
+        if len(columns['time']):
+            start = datetime.utcfromtimestamp(epoch)
+            if aware:
+                start = start.replace(tzinfo=timezone.utc)
+        series = cls(start, columns)
+        series.extra = dict((name, values) for name, values in archive.items() if name not in columns and name != 'start')
+        return series
+
+def pack_arrays(**arrays):
+    ''' Pack named NumPy arrays into a compressed string '''
+    buf = StringIO()
+    numpy.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+def unpack_arrays(data):
+    ''' Inverse of pack_arrays, returns a dict of arrays '''
+    archive = numpy.load(StringIO(str(data)))
+    return dict((name, archive[name]) for name in archive.files)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+#
+''' Spatial lookups.
+
+GridIndex buckets points in cells of a fixed size in degrees, so finding
+the points near a bounding box only looks at the cells it covers instead of
+every point. The segment and location indexes are built once per process
+and rebuilt when their version in the cache changes, see VersionedIndex.
+
+The tracks of exercises are indexed in the database instead, by their
+bounding box and the keys of the TRACK_CELL grid cells they pass through. '''
+
+from math import cos, radians, floor, ceil, hypot
+
+import numpy
+from django.db.models import get_model
+
+from gpxparser import proj_distances
+from cachekeys import get_version, bump_version
+
+# Metres per degree of latitude
+METRES_PER_DEGREE = 111320.0
+
+# Cell size of the segment index in degrees, about 5.5 km north-south
+SEGMENT_INDEX_CELL = 0.05
+
+SEGMENT_INDEX_VERSION_KEY = 'segment_index_version'
+
+# Cell size of the location index in degrees
+LOCATION_INDEX_CELL = 0.1
+
+# Relative error of the distance used to rank locations, over one degree
+NEAREST_TOLERANCE = 1.01
+
+LOCATION_INDEX_VERSION_KEY = 'location_index_version'
+
+# Cell size of the stored exercise track cells in degrees, about 11 km
+# north-south. Changing it requires indexing all tracks again.
+TRACK_CELL = 0.1
+
+class GridIndex(object):
+    ''' Points bucketed on a lat/lon grid '''
+
+    def __init__(self, cell=SEGMENT_INDEX_CELL):
+        self.cell = cell
+        self.cells = {}
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.cells.values())
+
+    def cell_of(self, lat, lon):
+        return int(floor(lat/self.cell)), int(floor(lon/self.cell))
+
+    def insert(self, key, lat, lon):
+        self.cells.setdefault(self.cell_of(lat, lon), []).append((key, lat, lon))
+
+    def query(self, min_lat, min_lon, max_lat, max_lon, margin=0):
+        ''' Return the set of keys of the points inside the bounding box
+        grown by margin metres on every side '''
+
+        dlat, dlon = margin_degrees(margin, max(abs(min_lat), abs(max_lat)))
+        min_lat, max_lat = min_lat - dlat, max_lat + dlat
+        min_lon, max_lon = min_lon - dlon, max_lon + dlon
+        min_y, min_x = self.cell_of(min_lat, min_lon)
+        max_y, max_x = self.cell_of(max_lat, max_lon)
+
+        found = set()
+        if (max_y - min_y + 1) * (max_x - min_x + 1) > len(self.cells):
+            # Box covers more cells than there are filled, walk those instead
+            cells = [points for (y, x), points in self.cells.iteritems() if min_y <= y <= max_y and min_x <= x <= max_x]
+        else:
+            cells = [self.cells.get((y, x), ()) for y in xrange(min_y, max_y + 1) for x in xrange(min_x, max_x + 1)]
+        for points in cells:
+            for key, lat, lon in points:
+                if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                    found.add(key)
+        return found
+
+def margin_degrees(margin, lat):
+    ''' Degrees of latitude and longitude covering at least margin metres at
+    latitude lat '''
+
+    dlat = margin / METRES_PER_DEGREE
+    dlon = margin / (METRES_PER_DEGREE * max(cos(radians(min(abs(lat) + dlat, 89.9))), 0.001))
+    return dlat, dlon
+
+def valid_positions(lats, lons):
+    ''' The positions as float arrays, without NaN and 0 '''
+
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    with numpy.errstate(invalid='ignore'):
+        mask = (lats == lats) & (lons == lons) & (lats != 0) & (lons != 0)
+    return lats[mask], lons[mask]
+
+def track_bbox(lats, lons):
+    ''' Bounding box (min_lat, min_lon, max_lat, max_lon) of the positions,
+    ignoring NaN and 0, or None if there are none '''
+
+    lats, lons = valid_positions(lats, lons)
+    if not len(lats):
+        return None
+    return lats.min(), lons.min(), lats.max(), lons.max()
+
+def bbox_contains(bbox, lat, lon, margin=0):
+    ''' True if the position is inside bbox grown by margin metres '''
+
+    if lat is None or lon is None:
+        return False
+    min_lat, min_lon, max_lat, max_lon = bbox
+    dlat, dlon = margin_degrees(margin, max(abs(min_lat), abs(max_lat)))
+    return min_lat - dlat <= lat <= max_lat + dlat and min_lon - dlon <= lon <= max_lon + dlon
+
+def cell_keys(ys, xs, cell=TRACK_CELL):
+    ''' Integer keys of grid cells by row and column, see track_cells '''
+    rows = int(round(90/cell))
+    columns = int(round(180/cell))
+    return (numpy.asarray(ys) + rows) * (2*columns + 1) + (numpy.asarray(xs) + columns)
+
+def track_cells(lats, lons, cell=TRACK_CELL):
+    ''' Sorted keys of the grid cells the positions are in, ignoring NaN
+    and 0 '''
+
+    lats, lons = valid_positions(lats, lons)
+    ys = numpy.floor(lats/cell).astype(numpy.int64)
+    xs = numpy.floor(lons/cell).astype(numpy.int64)
+    return numpy.unique(cell_keys(ys, xs, cell)).tolist()
+
+def bbox_cells(bbox, margin=0, cell=TRACK_CELL):
+    ''' Keys of the grid cells covering bbox grown by margin metres '''
+
+    min_lat, min_lon, max_lat, max_lon = bbox
+    dlat, dlon = margin_degrees(margin, max(abs(min_lat), abs(max_lat)))
+    ys = numpy.arange(int(floor((min_lat - dlat)/cell)), int(floor((max_lat + dlat)/cell)) + 1)
+    xs = numpy.arange(int(floor((min_lon - dlon)/cell)), int(floor((max_lon + dlon)/cell)) + 1)
+    return cell_keys(ys[:, None], xs[None, :], cell).ravel().tolist()
+
+class SegmentIndex(object):
+    ''' Grid indexes of segment start and end positions '''
+
+    def __init__(self, segments, cell=SEGMENT_INDEX_CELL):
+        ''' segments is an iterable of (id, start_lat, start_lon, end_lat, end_lon) '''
+        self.starts = GridIndex(cell)
+        self.ends = GridIndex(cell)
+        for segment_id, start_lat, start_lon, end_lat, end_lon in segments:
+            if None in (start_lat, start_lon, end_lat, end_lon):
+                continue
+            self.starts.insert(segment_id, start_lat, start_lon)
+            self.ends.insert(segment_id, end_lat, end_lon)
+
+    def query(self, bbox, margin=0):
+        ''' Ids of segments with both start and end inside bbox grown by
+        margin metres '''
+        return self.starts.query(*bbox, margin=margin) & self.ends.query(*bbox, margin=margin)
+
+class LocationIndex(object):
+    ''' Grid index of the towns of locations '''
+
+    def __init__(self, locations, cell=LOCATION_INDEX_CELL):
+        ''' locations is an iterable of (town, lat, lon) '''
+        self.grid = GridIndex(cell)
+        self.towns = []
+        for town, lat, lon in locations:
+            if lat is None or lon is None:
+                continue
+            self.grid.insert(len(self.towns), lat, lon)
+            self.towns.append((town, lat, lon))
+
+    def nearest_town(self, lat, lon, within=1.0):
+        ''' Town of the location nearest to the position, of those less than
+        within degrees away in latitude and longitude, or '' if none is.
+
+        Cells are searched in rings around the position until no location
+        further out can be nearer. The locations are ranked by an
+        equirectangular approximation, and the geodesic only decides between
+        those too close to tell apart by it. '''
+
+        cell = self.grid.cell
+        cy, cx = self.grid.cell_of(lat, lon)
+        candidates = []
+        for ring in xrange(int(ceil(within/cell)) + 1):
+            for y in xrange(cy - ring, cy + ring + 1):
+                step = 1 if abs(y - cy) == ring else 2*ring
+                for x in xrange(cx - ring, cx + ring + 1, step or 1):
+                    for key, l_lat, l_lon in self.grid.cells.get((y, x), ()):
+                        if abs(l_lat - lat) < within and abs(l_lon - lon) < within:
+                            scale = cos(radians((lat + l_lat)/2))
+                            candidates.append((hypot(l_lat - lat, (l_lon - lon)*scale), key))
+            # Locations outside this ring are at least ring cells away in
+            # latitude, or in longitude less than ring cells from lat
+            reach = ring*cell
+            if candidates and min(candidates)[0]*NEAREST_TOLERANCE < reach*cos(radians(min(abs(lat) + reach, 89.9))):
+                break
+        if not candidates:
+            return ''
+
+        nearest = min(candidates)[0]
+        keys = [key for distance, key in candidates if distance <= nearest*NEAREST_TOLERANCE]
+        if len(keys) > 1:
+            distances = proj_distances(lat, lon, [self.towns[key][1] for key in keys], [self.towns[key][2] for key in keys])
+            if not numpy.isnan(distances).all():
+                keys = [keys[numpy.nanargmin(distances)]]
+        return self.towns[keys[0]][0]
+
+class VersionedIndex(object):
+    ''' An index built once per process by build, and built again when
+    another process has bumped the version in the cache '''
+
+    def __init__(self, key, build):
+        self.key = key
+        self.build = build
+        self.index = None
+        self.version = None
+
+    def get(self):
+        version = get_version(self.key)
+        if self.index is None or version != self.version:
+            self.index = self.build()
+            self.version = version
+        return self.index
+
+    def bump(self):
+        ''' Make every process build the index again on next use '''
+        self.index = None
+        bump_version(self.key)
+
+def build_segment_index():
+    Segment = get_model('turan', 'Segment')
+    return SegmentIndex(Segment.objects.values_list('id', 'start_lat', 'start_lon', 'end_lat', 'end_lon'))
+
+def build_location_index():
+    Location = get_model('turan', 'Location')
+    return LocationIndex(Location.objects.values_list('town', 'lat', 'lon'))
+
+segment_index = VersionedIndex(SEGMENT_INDEX_VERSION_KEY, build_segment_index)
+location_index = VersionedIndex(LOCATION_INDEX_VERSION_KEY, build_location_index)
+
+def get_segment_index():
+    ''' The SegmentIndex of all segments '''
+    return segment_index.get()
+
+def bump_segment_index():
+    ''' Must be called when segments are added, moved or deleted '''
+    segment_index.bump()
+
+def get_location_index():
+    ''' The LocationIndex of all locations '''
+    return location_index.get()
+
+def bump_location_index():
+    ''' Must be called when locations are added, moved or deleted '''
+    location_index.bump()
@@ -1,29 +1,38 @@
 from celery.decorators import task
 from celery.task.sets import subtask
+from celery import chord
 
 from subprocess import call
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import FileSystemStorage
 from django.core.cache import cache
 from django.conf import settings
 from django.db.models import get_model
-from django.db import connection, transaction
-from django.db.models import Avg, Max, Min, Count, Variance, StdDev, Sum
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Avg, Max, Min, Count, Variance, StdDev, Sum, F, Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils.datastructures import SortedDict
+from django.utils.text import compress_string
+from django.utils import timezone
 
 from copy import deepcopy
+from math import cos, radians
+from contextlib import contextmanager
 import numpy
-from collections import deque
-from datetime import timedelta
+import time
+import os
+import zipfile
+import tempfile
+import urllib
+from datetime import timedelta, date as datetimedate
 import json
 
 from svg import GPX2SVG
 from gpx2png import GPX2PNG
 from gpxwriter import GPXWriter
 from tcxwriter import TCXWriter
-from gpxparser import GPXParser, proj_distance
+from gpxparser import GPXParser, proj_distances, proj_distances_near
 from hrmparser import HRMParser
 from gmdparser import GMDParser
 from tcxparser import TCXParser
@@ -32,11 +41,16 @@ from pwxparser import PWXParser
 from fitparser import FITParser
 from stravastreamparser import StravaStreamParser
 from polaronlineparser import POLParser
+from series import Series, SERIES_FIELDS, SERIES_INT_FIELDS, SERIES_LEVELS, SERIES_LEVEL_MIN_SAMPLES, pack_arrays, unpack_arrays
+from geojson import zone_collection
+from cachekeys import bump_exercise
+from spatial import track_bbox, track_cells, bbox_cells, bbox_contains, get_segment_index
 from django.utils.translation import ugettext_lazy as _
 
 import socket
 
 gpxstore = FileSystemStorage(location=settings.GPX_STORAGE)
+GEOURL = "http://api.geonames.org/findNearbyPlaceNameJSON?formatted=true&username=turan&style=full&lng=%f&lat=%f"
 
 from celery.signals import task_failure
 
@@ -60,6 +74,40 @@ if 'sentry' in settings.INSTALLED_APPS:
           })
 
 logger = logging.getLogger('task')
+
+# Durations in seconds that get BestSpeedEffort and BestPowerEffort rows
+EFFORT_DURATIONS = [5, 10, 30, 60, 240, 300, 600, 1200, 1800, 3600]
+
+# mean_max_curve computes every duration up to MEAN_MAX_EXACT seconds, and
+# longer ones in steps of MEAN_MAX_STEP, see mean_max_durations
+MEAN_MAX_EXACT = 600
+MEAN_MAX_STEP = 1.01
+
+class StageTimer(object):
+    ''' Collect the wall clock time of the named stages of a task
+
+        timer = StageTimer('Exercise 1')
+        with timer('parse'):
+            ...
+        timer.report()
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages.append((stage, time.time() - start))
+
+    def report(self):
+        total = sum(elapsed for stage, elapsed in self.stages)
+        print "%s: %s, total %.2fs" %(self.name, ', '.join('%s %.2fs' %s for s in self.stages), total)
+
 def find_parser(sensorfile):
     ''' Returns correctly initianted parser-class given a filename '''
     filename = sensorfile.name
@@ -144,23 +192,23 @@ def calcpower(userweight, eqweight, gradient, speed,
     return (gforce + frictionforce + windforce)*speed
 
 @task
-def getslopes(values, userweight, eqweight):
+def getslopes(exercise, values, userweight, eqweight):
     ''' Given values and weight at the time of exercise, find
     and calculate stats for slopes in exercise and save to db, returning
     the slopes found. Deletes any existing slopes for exercise '''
     Slope = get_model('turan', 'Slope')
 
-    if not values.exists():
+    if not values:
         return []
 
     # Make sure we don't create duplicate slopes
-    values[0].exercise.slope_set.all().delete()
+    exercise.slope_set.all().delete()
 
     # Make sure exercise type is cycling, this only makes sense for cycling
-    exercise_type = values[0].exercise.exercise_type
+    exercise_type = exercise.exercise_type
     #if not str(exercise_type) == 'Cycling':
     #    return []
-    if not values[0].exercise.avg_speed:
+    if not exercise.avg_speed:
         return []
 
     slopes = []
@@ -201,7 +249,7 @@ def getslopes(values, userweight, eqweight):
                 if hdelta >= min_slope:
                     distance = values[cur_end].distance - values[cur_start].distance
                     if distance > 10:
-                        slope = Slope(exercise=values[cur_start].exercise,
+                        slope = Slope(exercise=exercise,
                                     start=values[cur_start].distance/1000,
                                     length = distance,
                                     ascent = hdelta,
@@ -232,20 +280,22 @@ def getslopes(values, userweight, eqweight):
 
 def match_slopes(se, offset=70):
     Slope = get_model('turan', 'Slope')
-    slopes = Slope.objects.filter(start_lon__gt=0)
-    for s in slopes:
-        start_distance = proj_distance(se.start_lat, se.start_lon, s.start_lat, s.start_lon)
-        if start_distance and start_distance < offset:
-            end_distance = proj_distance(se.end_lat, se.end_lon, s.end_lat, s.end_lon)
-            if end_distance and end_distance < offset:
-                print start_distance, end_distance
-                if not s.segment:
-                    s.segment = se
-                    s.save()
+    slopes = Slope.objects.filter(start_lon__gt=0, segment__isnull=True)
+    values = numpy.array(slopes.values_list('id', 'start_lat', 'start_lon', 'end_lat', 'end_lon'), dtype=numpy.float64).reshape(-1, 5)
+    ids, start_lats, start_lons, end_lats, end_lons = values.T
+    start_distances = proj_distances(se.start_lat, se.start_lon, start_lats, start_lons)
+    end_distances = proj_distances(se.end_lat, se.end_lon, end_lats, end_lons)
+    with numpy.errstate(invalid='ignore'):
+        matches = (start_distances > 0) & (start_distances < offset) & (end_distances > 0) & (end_distances < offset)
+    for s, start_distance, end_distance in zip(ids[matches].astype(int).tolist(), start_distances[matches], end_distances[matches]):
+        print start_distance, end_distance
+        s = Slope.objects.get(pk=s)
+        s.segment = se
+        s.save()
 
 def slice_to_segmentdetail(exercise, segment, start, stop):
     SegmentDetail = get_model('turan', 'SegmentDetail')
-    ret = detailslice_info(exercise.get_details().all()[start:stop+1])
+    ret = detailslice_info(exercise.get_series().rows()[start:stop+1], exercise)
     data = {}
     data['exercise'] = exercise
     data['start'] = ret['start']
@@ -275,50 +325,78 @@ def search_trip_for_possible_segments_matches(exercise, start_offset=50, end_off
             then find match for end pos if distance elapsed does not exceed segment distance
                 finally save the segment found if start and stop pos found '''
     Segment = get_model('turan', 'Segment')
+    ExerciseExtent = get_model('turan', 'ExerciseExtent')
+
+    # Only segments starting and ending near the track can match, use the
+    # stored bounding box to find out without reading the samples
+    bbox = None
+    extents = ExerciseExtent.objects.filter(exercise=exercise.id)[:1]
+    if extents:
+        bbox = extents[0].get_bbox()
+    if search_in_segments and bbox is not None:
+        search_in_segments = [se for se in search_in_segments
+                if bbox_contains(bbox, se.start_lat, se.start_lon, start_offset)
+                and bbox_contains(bbox, se.end_lat, se.end_lon, end_offset)]
+        if not search_in_segments:
+            return []
 
-    if not search_in_segments:
-        search_in_segments = Segment.objects.all()
     # Only works for exercises with distance
-    details = exercise.get_details().exclude(lon=0).exclude(lat=0).filter(distance__gt=0).values('distance', 'lon', 'lat')
-    i_len = len(details)
+    series = exercise.get_series()
+    with numpy.errstate(invalid='ignore'): # NaN compares false, that is fine
+        mask = (series.lon != 0) & (series.lat != 0) & (series.distance > 0)
+    if not search_in_segments:
+        if bbox is None:
+            bbox = track_bbox(series.lat[mask], series.lon[mask])
+            if bbox is None:
+                return []
+        segment_ids = get_segment_index().query(bbox, margin=max(start_offset, end_offset))
+        if not segment_ids:
+            return []
+        search_in_segments = Segment.objects.filter(id__in=segment_ids)
+    lats = series.lat[mask]
+    lons = series.lon[mask]
+    distances = series.distance[mask].tolist()
+    i_len = len(distances)
     segments = [] #'[(segment, start, stop)...'
     #old_segmentdetails = exercise.segmentdetail_set.all()
     for se in search_in_segments:
+        if None in (se.start_lat, se.start_lon, se.end_lat, se.end_lon):
+            # If any segment has faulty lon/lat-data, just continue here instead of breaking
+            print "Skipped segment %s, missing start or end position" %se
+            continue
+        # Distance from every sample to the start and end of the segment,
+        # geodesic where they are close enough to be compared to the offsets
+        start_distances = proj_distances_near(se.start_lat, se.start_lon, lats, lons, start_offset).tolist()
+        end_distances = proj_distances_near(se.end_lat, se.end_lon, lats, lons, end_offset).tolist()
         previous_start = -1
         started_at_distance = 0
         found_start = -1
         previous_end = 0
         found_end = 0
-        for i, d in enumerate(details):
+        for i in xrange(i_len):
             if found_start < 0:
-                try:
-                    start_distance = proj_distance(se.start_lat, se.start_lon, d['lat'], d['lon'])
-                except Exception, e:
-                    # If any segment has faulty lon/lat-data, this call will fail and segment parsing stop
-                    # just continue here instead of breaking
-                    print "Skipped segment, start distance call failed, error was: %s" %e
-                    continue
+                start_distance = start_distances[i]
                 if start_distance < start_offset:
                     print i, start_distance
                     if previous_start >= 0:
                         if start_distance > previous_start:
                             found_start = i-1
-                            started_at_distance = d['distance']
+                            started_at_distance = distances[i]
                             print "Start of %s at index %s" %(se, found_start)
                     previous_start = start_distance
                 elif start_distance > 300000: # If start distance is further away than 300km we stop searching
                     print "Skipped segment, start was %s m away" %start_distance
                     break
             elif not found_end:
-                end_distance = proj_distance(se.end_lat, se.end_lon, d['lat'], d['lon'])
+                end_distance = end_distances[i]
                 #Check if distance from start is longer than segment plus some, means we didnt' find stop
                 search_distance = se.distance*1000 + 1000 + end_offset*2
                 search_distance_min = se.distance*1000 - 1000 - end_offset*2
-                found_distance = d['distance'] - started_at_distance
+                found_distance = distances[i] - started_at_distance
                 if found_distance < search_distance_min:
                     continue
                 if found_distance > search_distance:
-                    print started_at_distance, d['distance'], search_distance
+                    print started_at_distance, distances[i], search_distance
                     print "Didn't find end, resetting state"
                     # reset start
                     found_start, found_end, previous_start, started_at_distance, previous_end = -1, 0, -1, 0, 0
@@ -362,6 +440,98 @@ def search_trip_for_possible_segments_matches(exercise, start_offset=50, end_off
 
     return segments
 
+def segment_backfill_cells(segment, start_offset=50, end_offset=90):
+    ''' The grid cells around the start and around the end of the segment '''
+    start_cells = bbox_cells((segment.start_lat, segment.start_lon, segment.start_lat, segment.start_lon), start_offset)
+    end_cells = bbox_cells((segment.end_lat, segment.end_lon, segment.end_lat, segment.end_lon), end_offset)
+    return start_cells, end_cells
+
+def segment_backfill_candidates(segment):
+    ''' Ids of the exercises with a track passing the grid cells of both the
+    start and the end of the segment, and of the ones with a track that is
+    not indexed yet, see segment_backfill_chunk '''
+    Exercise = get_model('turan', 'Exercise')
+
+    start_cells, end_cells = segment_backfill_cells(segment)
+    passing = Exercise.objects.filter(cells__cell__in=start_cells).filter(cells__cell__in=end_cells)
+    unindexed = Exercise.objects.filter(extent__isnull=True, route__isnull=False).exclude(sensor_file='').exclude(route__start_lat=0)
+    return sorted(set(passing.values_list('id', flat=True)) | set(unindexed.values_list('id', flat=True)))
+
+def start_segment_backfill(segment):
+    ''' Create a SegmentBackfill for the segment and queue it '''
+    SegmentBackfill = get_model('turan', 'SegmentBackfill')
+
+    job = SegmentBackfill.objects.create(segment=segment)
+    run_segment_backfill.delay(job.id)
+    return job
+
+@task
+def run_segment_backfill(job_id):
+    ''' Split the candidate exercises of a SegmentBackfill in chunks of
+    SEGMENT_BACKFILL_CHUNK and queue them, so they are searched in parallel
+    by the workers '''
+    SegmentBackfill = get_model('turan', 'SegmentBackfill')
+
+    job = SegmentBackfill.objects.select_related('segment').get(pk=job_id)
+    exercise_ids = segment_backfill_candidates(job.segment)
+    SegmentBackfill.objects.filter(pk=job_id).update(state='R', total=len(exercise_ids))
+    if not exercise_ids:
+        SegmentBackfill.objects.filter(pk=job_id).update(state='D')
+        return
+
+    chunk = getattr(settings, 'SEGMENT_BACKFILL_CHUNK', 50)
+    for i in range(0, len(exercise_ids), chunk):
+        segment_backfill_chunk.delay(job_id, exercise_ids[i:i+chunk])
+
+@task
+def segment_backfill_chunk(job_id, exercise_ids):
+    ''' Add SegmentDetails for passes of the segment of a SegmentBackfill in
+    the exercises, and count them as done, or as failed if the search
+    raised. Exercises parsed before tracks were indexed are indexed first,
+    and skipped if they do not pass the segment. '''
+    SegmentBackfill = get_model('turan', 'SegmentBackfill')
+    Exercise = get_model('turan', 'Exercise')
+    ExerciseExtent = get_model('turan', 'ExerciseExtent')
+    ExerciseCell = get_model('turan', 'ExerciseCell')
+
+    segment = SegmentBackfill.objects.select_related('segment').get(pk=job_id).segment
+    start_cells, end_cells = segment_backfill_cells(segment)
+    indexed = set(ExerciseExtent.objects.filter(exercise__in=exercise_ids).values_list('exercise', flat=True))
+    found = 0
+    failed = 0
+    for exercise in Exercise.objects.filter(id__in=exercise_ids):
+        try:
+            if exercise.id not in indexed:
+                store_track_index(exercise)
+                cells = ExerciseCell.objects.filter(exercise=exercise)
+                if not cells.filter(cell__in=start_cells).exists() or not cells.filter(cell__in=end_cells).exists():
+                    continue
+            for match in search_trip_for_possible_segments_matches(exercise, search_in_segments=[segment]):
+                slice_to_segmentdetail(exercise, match[0], match[1], match[2])
+                found += 1
+        except Exception, e:
+            print "Segment search in exercise %s failed: %s" %(exercise.id, e)
+            failed += 1
+
+    SegmentBackfill.objects.filter(pk=job_id).update(done=F('done') + len(exercise_ids), found=F('found') + found, failed=F('failed') + failed)
+    SegmentBackfill.objects.filter(pk=job_id, done__gte=F('total')).update(state='D')
+
+@task
+def lookup_route_name(route_id, name):
+    ''' Name an autogenerated route outside Norway after the nearest place
+    geonames knows of, unless it has been renamed since it got name '''
+    Route = get_model('turan', 'Route')
+
+    route = Route.objects.get(pk=route_id)
+    try:
+        f = urllib.urlopen(GEOURL % (route.start_lon, route.start_lat,))
+        start = json.load(f)["geonames"][0]
+    except Exception, e:
+        print "Geonames lookup for route %s failed: %s" %(route_id, e)
+        return
+    if start["countryCode"] != "NO":
+        Route.objects.filter(pk=route_id, name=name).update(name=start["toponymName"])
+
 @task
 def create_simplified_gpx(gpx_path, filename):
     cmd = 'gpsbabel -i gpx -f %s -x duplicate,location -x position,distance=1m -x simplify,crosstrack,error=0.005k -o gpx -F %s' % (\
@@ -396,8 +566,9 @@ def create_gpx_from_details(exercise, callback=None):
         if not exercise.route.gpx_file:
 
             # Check if the details have lon, some parsers doesn't provide position
-            if exercise.get_details().filter(lon__gt=0).count() > 0 or exercise.get_details().filter(lon__lt=0).count():
-                g = GPXWriter(exercise.get_details().all())
+            series = exercise.get_series()
+            if numpy.nan_to_num(series.lon).any():
+                g = GPXWriter(series.rows())
                 filename = 'gpx/%s.gpx' %exercise.id
 
                 # tie the created file to the route object
@@ -416,7 +587,8 @@ def merge_sensordata(exercise, callback=None):
 
     ExerciseDetail = get_model('turan', 'ExerciseDetail')
 
-    for merger in exercise.mergesensorfile_set.all():
+    mergers = exercise.mergesensorfile_set.all()
+    for merger in mergers:
 
         # TODO, merge_types, this is only the merge kind.
 
@@ -439,28 +611,40 @@ def merge_sensordata(exercise, callback=None):
             except Exception:
                 print "No match: %s" % val.time
                 # Did not find match, continue
+    if mergers:
+        invalidate_series(exercise)
     if not callback is None:
         subtask(callback).delay(exercise)
 #    create_gpx_from_details.delay(exercise)
 
+# Smoothing weights per degree, see smoothing_weights
+_smoothing_weights = {}
+
+def smoothing_weights(kind, degree):
+    ''' Return the normalized weights of the gaussian or flat smoothing
+    window of degree, built once per process '''
+
+    key = (kind, degree)
+    if not key in _smoothing_weights:
+        if kind == 'gaussian':
+            window = degree*2-1
+            frac = (numpy.arange(window) - degree + 1)/float(window)
+            weight = 1/numpy.exp((4*frac)**2)
+        else:
+            weight = numpy.ones(degree)
+        _smoothing_weights[key] = weight/weight.sum()
+    return _smoothing_weights[key]
+
 def smoothListGaussian(list, degree=5):
     list = [x if x else 0 for x in list] # Change None into 0
     if not list:
         return list
-    list = [list[0]]*(degree-1) + list + [list[-1]]*degree
-    window = degree*2-1
-    weight = numpy.array([1.0]*window)
-    weightGauss = []
-    for i in range(window):
-        i = i-degree+1
-        frac = i/float(window)
-        gauss = 1/(numpy.exp((4*(frac))**2))
-        weightGauss.append(gauss)
-    weight = numpy.array(weightGauss)*weight
-    smoothed = [0.0]*(len(list)-window)
-    for i in range(len(smoothed)):
-        smoothed[i] = sum(numpy.array(list[i:i+window])*weight)/sum(weight)
-    return smoothed
+    values = numpy.array(list, dtype=numpy.float64)
+    # Pad with degree-1 copies of the first value and degree copies of the last
+    values = numpy.concatenate((values[:1].repeat(degree-1), values, values[-1:].repeat(degree)))
+    # The window is symmetric, so the convolution is the weighted sliding sum
+    smoothed = numpy.convolve(values, smoothing_weights('gaussian', degree), 'valid')
+    return smoothed[:len(list)].tolist()
 
 def calculate_ascent_descent_gaussian(details, degree=5):
     ''' Calculate ascent and descent for an exercise. Use guassian filter to smooth '''
@@ -490,243 +674,203 @@ def altvals_to_ascent_descent(altvals):
         previous = a
     return round(ascent), round(descent)
 
-def best_x_sec(details, length, altvals, speed=True, power=False):
-
-    best_speed = 0.0
-    best_power = 0.0
-    best_power = 0.0
-    sum_q_power = 0.0
-    sum_q_speed = 0.0
-    best_start_km_speed = 0.0
-    best_start_km_power = 0.0
-    best_speed_start_end = 0
-    best_power_start_end = 0
-    q_speed = deque()
-    q_power = deque()
-    best_length_speed = 0.0
-    best_length_power = 0.0
-
-    if speed:
-        q_speed.appendleft(details[0].speed)
-    j = 1
-    if power and details[j].power:
-        q_power.appendleft(details[j].power)
-    j = 2
-    len_i = len(details)
-    for i in xrange(2, len_i):
-        #try:
-        delta_t = (details[i].time - details[i-1].time).seconds
-        if speed:
-            # Break if exerciser is on a break as well
-            if delta_t < 60:
-                q_speed.appendleft(details[i].speed * delta_t)
-            else:
-                q_speed = deque()
-                q_speed.appendleft(details[i].speed)
-            delta_t_total = (details[i].time - details[i-len(q_speed)].time).seconds
-        if power:
-            if delta_t < 60 and details[i].power:
-                q_power.appendleft(details[i].power * delta_t)
-            elif delta_t < 60 and not details[i].power:
-                q_power.appendleft(0)
-            else:
-                q_power = deque()
-                if details[i].power:
-                    q_power.appendleft(details[i].power)
-            if not speed:
-                delta_t_total = (details[i].time - details[i-len(q_power)].time).seconds
-        if delta_t_total >= length:
-            break
-        j += 1
-        #except Exception as e:
-        #    #print "%s %s %s %s %s" % (e, i, j, delta_t, len(q_speed))
-        #    #j += 1
-        #    continue
-    j += 1
-
-    for i in xrange(j, len(details)):
+def best_efforts(series, durations, altvals, fields=('speed', 'power')):
+    ''' Find the best average of the fields over each duration.
+
+    The fields are resampled to 1 Hz, so the average over any window is a
+    difference of two prefix sums. Windows can not span a pause of 60 seconds
+    or more. Averages of integer fields like power are floored, as the old
+    integer division did. Returns a dict keyed on field with a dict keyed on
+    duration holding (best, pos, length, ascent, descent) for durations with
+    an effort '''
+
+    distances = numpy.nan_to_num(series.distance)
+    efforts = {}
+    for field in fields:
+        efforts[field] = {}
+        values, valid = series.per_second(field)
+        sums = numpy.concatenate(([0.0], numpy.cumsum(values)))
+        pauses = numpy.concatenate(([0], numpy.cumsum(~valid)))
+        for seconds in durations:
+            if seconds > len(values):
+                continue
+            averages = (sums[seconds:] - sums[:-seconds]) / seconds
+            if field in SERIES_INT_FIELDS:
+                averages = numpy.floor(averages)
+            averages[pauses[seconds:] - pauses[:-seconds] > 0] = 0
+            start_second = int(averages.argmax())
+            best = averages[start_second]
+            if not best > 0:
+                continue
+            start = series.sample_index(start_second)
+            end = series.sample_index(start_second + seconds, side='left')
+            ascent, descent = altvals_to_ascent_descent(altvals[start:end])
+            efforts[field][seconds] = (float(best), distances[start]/1000, distances[end] - distances[start], ascent, descent)
+    return efforts
+
+def mean_max_durations(length):
+    ''' The durations of up to length seconds that mean_max_curve computes:
+    every second up to MEAN_MAX_EXACT, longer ones in steps of
+    MEAN_MAX_STEP, and the EFFORT_DURATIONS '''
+
+    steps = 0
+    if length > MEAN_MAX_EXACT:
+        steps = int(numpy.ceil(numpy.log(float(length)/MEAN_MAX_EXACT)/numpy.log(MEAN_MAX_STEP)))
+    grid = numpy.round(MEAN_MAX_EXACT*MEAN_MAX_STEP**numpy.arange(1, steps + 1)).astype(numpy.int64)
+    durations = numpy.union1d(numpy.union1d(numpy.arange(1, MEAN_MAX_EXACT + 1), grid), EFFORT_DURATIONS)
+    return durations[durations <= length]
+
+def mean_max_curve(values, valid):
+    ''' Return the durations of mean_max_durations up to the longest run of
+    valid seconds, and that run, and the best average of the 1 Hz values
+    over each of them. Windows can not cover invalid seconds.
+
+    Each duration is one vectorised pass over prefix sums. With a fixed
+    number of durations per decade a ride of n seconds costs O(n log n),
+    where every second up to n would be O(n^2). '''
+
+    # Find the longest run of valid seconds, no window is longer
+    edges = numpy.diff(numpy.concatenate(([0], valid.astype(numpy.int8), [0])))
+    runs = numpy.flatnonzero(edges == -1) - numpy.flatnonzero(edges == 1)
+    longest = runs.max() if len(runs) else 0
+    durations = mean_max_durations(longest)
+    if longest:
+        durations = numpy.union1d(durations, [longest])
+    sums = numpy.concatenate(([0.0], numpy.cumsum(values)))
+    pauses = numpy.concatenate(([0], numpy.cumsum(~valid)))
+    best = numpy.zeros(len(durations))
+    for i, seconds in enumerate(durations):
+        totals = sums[seconds:] - sums[:-seconds]
+        totals[pauses[seconds:] - pauses[:-seconds] > 0] = 0
+        best[i] = totals.max()/seconds
+    return durations, best
 
-        try:
-            if len(q_speed):
-                if speed:
-                    sum_q_speed_tmp = sum(q_speed)
-                    delta_t_total = (details[i].time - details[i-len(q_speed)].time).seconds
+@task
+def calculate_mean_max(exercise):
+    ''' Store the mean maximal speed and power curves of the exercise '''
 
-                    if delta_t_total != 0 and delta_t_total == length:
-                        sum_q_speed = sum_q_speed_tmp / (details[i].time - details[i-len(q_speed)].time).seconds
-                    else:
-                        # What can one do?
-                        sum_q_speed = 0
-            if len(q_power):
-                if power:
-                    sum_q_power_tmp = sum(q_power)
-                    delta_t_total_power = (details[i].time - details[i-len(q_power)].time).seconds
-                    if delta_t_total_power != 0 and delta_t_total_power == length:
-                        sum_q_power = sum_q_power_tmp / delta_t_total_power
-                    else:
-                        sum_q_power = 0
-            if sum_q_speed > best_speed:
-                best_speed = sum_q_speed
-                best_start_km_speed = details[i-len(q_speed)].distance / 1000
-                best_speed_start_end = (i, i-len(q_speed))
-                best_length_speed = (details[i].distance) - best_start_km_speed * 1000
-            if sum_q_power > best_power:
-                best_power = sum_q_power
-                best_start_km_power = details[i-len(q_power)].distance / 1000
-                best_power_start_end = (i, i-len(q_speed))
-                best_length_power = (details[i].distance) - best_start_km_power * 1000
-
-            delta_t = (details[i].time - details[i-1].time).seconds
-            if speed:
-                if delta_t < 60:
-                    q_speed.appendleft(details[i].speed*delta_t)
-                else:
-                    q_speed = deque()
-            if power:
-                if delta_t < 60 and details[i].power:
-                    q_power.appendleft(details[i].power*delta_t)
-                elif delta_t < 60 and not details[i].power:
-                    q_power.appendleft(0)
-                else:
-                    q_power = deque()
-            while ((details[i].time - details[i-len(q_speed)].time).seconds) > length:
-                q_speed.pop()
-            while (power and (details[i].time - details[i-len(q_power)].time).seconds > length):
-                q_power.pop()
-        except Exception as e:
-            print "something wrong %s, %s, %s, %s" % (e, len(q_speed), i, j)
-            #raise
-            continue
+    MeanMaxCurve = get_model('turan', 'MeanMaxCurve')
+    MeanMaxCurve.objects.filter(exercise=exercise).delete()
 
-    if power and speed:
-        best_speed_ascent = 0
-        best_speed_descent = 0
-        best_power_ascent = 0
-        best_power_descent = 0
-        if best_speed_start_end:
-            c, d = best_speed_start_end
-            best_speed_ascent, best_speed_descent = altvals_to_ascent_descent(altvals[d:c])
-        if best_power_start_end:
-            a, b = best_power_start_end
-            best_power_ascent, best_power_descent = altvals_to_ascent_descent(altvals[b:a])
-
-        return best_speed, best_start_km_speed, best_length_speed, best_speed_ascent, best_speed_descent, best_power, best_start_km_power, best_length_power, best_power_ascent, best_power_descent
-    elif speed and not power:
-        best_speed_ascent = 0
-        best_speed_descent = 0
-        if best_speed_start_end:
-            a, b = best_speed_start_end
-            best_speed_ascent, best_speed_descent = altvals_to_ascent_descent(altvals[b:a])
-        return best_speed, best_start_km_speed, best_length_speed, best_speed_ascent, best_speed_descent
-    elif power and not speed:
-        best_power_ascent = 0
-        best_power_descent = 0
-        if best_power_start_end:
-            a, b = best_power_start_end
-            best_power_ascent, best_power_descent = altvals_to_ascent_descent(altvals[b:a])
-
-        return best_power, best_start_km_power, best_length_power, best_power_ascent, best_power_descent
+    series = exercise.get_series()
+    if not len(series) or not exercise.avg_speed:
+        return
 
+    curves = {}
+    durations, speeds = mean_max_curve(*series.per_second('speed'))
+    curves['durations'] = durations.astype(numpy.uint32)
+    curves['speed'] = speeds.astype(numpy.float32)
+    if exercise.avg_power and not exercise.is_smart_sampled():
+        curves['power'] = mean_max_curve(*series.per_second('power'))[1].astype(numpy.uint16)
+    MeanMaxCurve.objects.create(exercise=exercise, data=pack_arrays(**curves))
 
 @task
-def calculate_freqs(exercise):
-    ''' Calculate the freq charts and save to db '''
-    # Delete any existing 
-    exercise.freq_set.all().delete()
-
-
-    details = exercise.get_details().all()
-    Freq = get_model('turan', 'Freq')
-
-    if exercise.avg_cadence:
-        freqs = getfreqs(details, 'cadence', min=1)
-        freqs = json.dumps(freqs.items())
-        freq = Freq()
-        freq.freq_type = 'C'
-        freq.json = freqs
-        freq.exercise = exercise
-        freq.save()
-    if exercise.avg_speed:
-        freqs = getfreqs(details, 'speed', min=1, max=150) # FIXME why is this 150 ?
-        freqs = json.dumps(freqs.items())
-        freq = Freq()
-        freq.freq_type = 'S'
-        freq.json = freqs
-        freq.exercise = exercise
-        freq.save()
-    if exercise.avg_power:
-        freqs = getfreqs(details, 'power', min=1, val_cutoff=5)
-        freqs = json.dumps(freqs.items())
-        freq = Freq()
-        freq.freq_type = 'P'
-        freq.json = freqs
-        freq.exercise = exercise
-        freq.save()
-
-    profile = exercise.user.get_profile()
-    max_hr = int(profile.max_hr)
-    if not max_hr:
-        max_hr = 190 # FIXME, maybe demand from user ?
-    if exercise.avg_hr:
-        hrhzones = gethrhzones(exercise, details, max_hr)
-        # tis is a bit ugly, maybe fork out in a template?
-        js = '['
-        for i, zone in enumerate(hrhzones):
-            if zone.items():
-                js += '''{
-                data: %s,
-                bars: { show: true},
-                color: colors[%s]
-             },''' %(json.dumps(zone.items()), i)
-        js = js.rstrip(',') + ']'
-        freq = Freq()
-        freq.freq_type = 'H'
-        freq.json = js
-        freq.exercise = exercise
-        freq.save()
+def extend_best_efforts(seconds):
+    ''' Add best efforts of a new duration to every exercise with a sensor
+    file, without reparsing it. The samples are read from the packed
+    series, which get_series creates from the details for exercises parsed
+    before it existed. '''
 
-@task
-def calculate_time_in_zones(exercise, callback=None):
+    Exercise = get_model('turan', 'Exercise')
+    BestSpeedEffort = get_model('turan', 'BestSpeedEffort')
+    BestPowerEffort = get_model('turan', 'BestPowerEffort')
+
+    exercises = Exercise.objects.filter(avg_speed__isnull=False).exclude(sensor_file='')
+    exercises = exercises.exclude(bestspeedeffort__duration=seconds)
+    for exercise in exercises.iterator():
+        series = exercise.get_series()
+        fields = ['speed']
+        if exercise.avg_power and not exercise.is_smart_sampled():
+            fields.append('power')
+        altvals = smoothListGaussian(numpy.nan_to_num(series.altitude).tolist())
+        efforts = best_efforts(series, [seconds], altvals, fields)
+        if seconds in efforts['speed']:
+            speed, pos, length, ascent, descent = efforts['speed'][seconds]
+            BestSpeedEffort.objects.create(exercise=exercise, speed=speed, pos=pos, length=length, duration=seconds, ascent=ascent, descent=descent)
+        if seconds in efforts.get('power', {}):
+            power, pos, length, ascent, descent = efforts['power'][seconds]
+            BestPowerEffort.objects.create(exercise=exercise, power=int(power), pos=pos, length=length, duration=seconds, ascent=ascent, descent=descent)
+            update_power_records(exercise)
 
-    # First: Delete any existing in case of reparse
-    exercise.hrzonesummary_set.all().delete()
-    exercise.wzonesummary_set.all().delete()
+@task
+def calculate_histograms(exercise):
+    ''' Store the time histograms of the exercise, and its time in HR and
+    power zones as HRZoneSummary and WZoneSummary '''
 
     HRZoneSummary = get_model('turan', 'HRZoneSummary')
     WZoneSummary = get_model('turan', 'WZoneSummary')
 
-    zones = getzones(exercise)
-    for zone, val in zones.items():
-        hrz = HRZoneSummary()
-        hrz.exercise_id = exercise.id
-        hrz.zone = zone
-        hrz.duration = val
-        hrz.save()
-    wzones = getwzones(exercise)
-    for zone, val in wzones.items():
-        wz = WZoneSummary()
-        wz.exercise_id = exercise.id
-        wz.zone = zone
-        wz.duration = val
-        wz.save()
+    histograms = store_histograms(exercise)
+    with transaction.atomic():
+        bulk_replace(exercise.hrzonesummary_set.all(), [HRZoneSummary(exercise=exercise, zone=zone, duration=int(duration))
+            for zone, duration in enumerate(histograms['hr_zones'])])
+        bulk_replace(exercise.wzonesummary_set.all(), [WZoneSummary(exercise=exercise, zone=zone+1, duration=int(duration))
+            for zone, duration in enumerate(histograms.get('power_zones', ()))])
+
+def store_histograms(exercise):
+    ''' Calculate and store the time histograms of the exercise, replacing
+    any previous ones, and return them as a dict of arrays of seconds:
+
+    hr_zones: in each zone of hr2zone
+    power_zones: in each zone of watt2zone from 1, if the user has FTP
+    cadence, speed, power, hr_percent: at every integer value of the field,
+    and of the percentage of max HR, if the exercise has an average of it '''
+
+    ExerciseHistograms = get_model('turan', 'ExerciseHistograms')
+
+    series = exercise.get_series()
+    max_hr = exercise.user.get_profile().max_hr
+    histograms = {}
+    if len(series):
+        seconds = sample_seconds(series)
+        histograms['hr_zones'] = numpy.bincount(hr2zones(series.hr[1:]*100.0/(max_hr or 200)), weights=seconds, minlength=7)
+        ftp = exercise.get_ftp()
+        if ftp and exercise.avg_power:
+            histograms['power_zones'] = numpy.bincount(watt2zones(series.power[1:]*100.0/ftp), weights=seconds, minlength=8)[1:]
+        if exercise.avg_cadence:
+            histograms['cadence'] = time_histogram(series.cadence[1:], seconds)
+        if exercise.avg_speed:
+            histograms['speed'] = time_histogram(series.speed[1:], seconds)
+        if exercise.avg_power:
+            histograms['power'] = time_histogram(series.power[1:], seconds)
+        if exercise.avg_hr:
+            histograms['hr_percent'] = time_histogram(series.hr[1:]*100.0/(max_hr or 190), seconds)
+    else:
+        histograms['hr_zones'] = numpy.zeros(7)
+        if exercise.duration:
+            histograms['hr_zones'][0] = exercise.duration.total_seconds()
+    histograms = dict((name, histogram.astype(numpy.uint32)) for name, histogram in histograms.items())
+
+    with transaction.atomic():
+        ExerciseHistograms.objects.filter(exercise=exercise).delete()
+        ExerciseHistograms.objects.create(exercise=exercise, data=pack_arrays(**histograms))
+    return histograms
+
+def sample_seconds(series):
+    ''' Whole seconds since the previous sample of every sample but the
+    first, 0 after pauses of more than 60 seconds '''
+    seconds = numpy.floor(numpy.diff(series.time))
+    seconds[(seconds > 60) | (seconds < 0)] = 0
+    return seconds
+
+def time_histogram(values, seconds):
+    ''' Seconds spent at every integer value, indexed by the value, leaving
+    out NaN and negative values '''
+    with numpy.errstate(invalid='ignore'):
+        keep = values >= 0
+    values = numpy.floor(values[keep] + 0.5).astype(numpy.int64)
+    return numpy.bincount(values, weights=seconds[keep])
 
 @task
 def calculate_gradients(exercise, callback=None):
 
-    # First: Delete any existing in case of reparse
-    exercise.exercisealtitudegradient_set.all().delete()
-    id = exercise.id
-
     ExerciseAltitudeGradient = get_model('turan', 'ExerciseAltitudeGradient')
 
-    distances, gradients, altitudes = getgradients(exercise.get_details().all())
-    for i in xrange(0, len(distances)):
-        eag = ExerciseAltitudeGradient()
-        eag.exercise_id = id
-        eag.xaxis = distances[i]
-        eag.gradient = gradients[i]
-        eag.altitude = altitudes[i]
-        eag.save()
+    distances, gradients, altitudes = getgradients(exercise.get_series().rows())
+    # Replace any existing in case of reparse
+    bulk_replace(exercise.exercisealtitudegradient_set.all(),
+        [ExerciseAltitudeGradient(exercise_id=exercise.id, xaxis=distance, gradient=gradient, altitude=altitude)
+            for distance, gradient, altitude in zip(distances, gradients, altitudes)])
 
 def getgradients(values):
     ''' Copy of function from view..this one used to save into db for
@@ -769,205 +913,412 @@ def getgradients(values):
 
     return distances, gradients, altitudes
 
-def gethrhzones(exercise, values, max_hr):
-    ''' Calculate time in different sport zones given trip details '''
-
-    #max_hr = values[0].exercise.user.get_profile().max_hr
-    #resting_hr = values[0].exercise.user.get_profile().resting_hr
-    if not max_hr:
-        return []
-
-    zones = SortedDict()
-    previous_time = False
-    for i, d in enumerate(values):
-        if not previous_time:
-            previous_time = d.time
-            continue
-        time = d.time - previous_time
-        previous_time = d.time
-        if time.seconds > 60:
-            continue
-        hr_percent = 0
-        if d.hr:
-            hr_percent = int(round(float(d.hr)*100/max_hr))
-        #hr_percent = (float(d.hr)-resting_hr)*100/(max_hr-resting_hr)
-        if not hr_percent in zones:
-            zones[hr_percent] = 0
-        zones[hr_percent] += time.seconds
-
-    filtered_zones = [SortedDict(),SortedDict(),SortedDict(),SortedDict(),SortedDict(),SortedDict(),SortedDict()]
-    #for i in range(40,100):
-    #    filtered_zones[i] = 0
-
-    if exercise.duration:
-        total_seconds = exercise.duration.total_seconds()
-        for hr in sorted(zones):
-            #if 100*float(zones[hr])/total_seconds > 0:
-            if hr > 40 and hr < 101:
-                percentage = float(zones[hr])*100/total_seconds
-                if percentage > 0.5:
-
-                    zone = hr2zone(hr)
-                    filtered_zones[zone][hr] = percentage
-
-    return filtered_zones
-
-def getfreqs(values, val_type, min=0, max=0, val_cutoff=0):
-    ''' given values, create freqency structure for display in flot '''
-
-    freqs = SortedDict()
-    previous_time = False
-    for d in values:
-        if not previous_time:
-            previous_time = d.time
-            continue
-        time = d.time - previous_time
-        previous_time = d.time
-        if time.seconds > 60: # Skip samples with pause ?
-            continue
-        val = getattr(d, val_type)
-        if val == None: # Drop nonesamples
-            continue
-        val = int(round(val))
-        if not val in freqs:
-            freqs[val] = 0
-        freqs[val] += time.seconds
-
-    for freq, val in freqs.iteritems():
-        if min and freq < min:
-            del freqs[freq]
-        elif max and freq > max:
-            del freqs[freq]
-        elif val_cutoff and val < val_cutoff:
-            del freqs[freq]
+@task
+def calculate_best_efforts(exercise, effort_range=EFFORT_DURATIONS, calc_only_power=False, callback=None):
+    ''' Find best speed and power efforts for the different effort ranges '''
 
-    return freqs
+    BestSpeedEffort = get_model('turan', 'BestSpeedEffort')
+    BestPowerEffort = get_model('turan', 'BestPowerEffort')
 
-def getzones(exercise):
-    ''' Calculate time in different sport zones given trip details '''
+    series = exercise.get_series()
+    calc_power = exercise.avg_power and not exercise.is_smart_sampled()
 
-    values = exercise.get_details().all()
-    max_hr = exercise.user.get_profile().max_hr
-    if not max_hr:
-        max_hr = 200 # FIXME warning to user etc
-
-    zones = SortedDict({
-            0: 0,
-            1: 0,
-            2: 0,
-            3: 0,
-            4: 0,
-            5: 0,
-            6: 0,
-        })
-    previous_time = False
-    if values:
-        for d in values:
-            if not previous_time:
-                previous_time = d.time
-                continue
-            time = d.time - previous_time
-            previous_time = d.time
-            if time.seconds > 60:
-                continue
-            hr_percent = 0
-            if d.hr:
-                hr_percent = float(d.hr)*100/max_hr
-            zone = hr2zone(hr_percent)
-            zones[zone] += time.seconds
-    else:
-        if exercise.duration:
-            zones[0] = exercise.duration.total_seconds()
+    efforts = {}
+    if len(series) and exercise.avg_speed:
+        fields = ['speed']
+        if calc_power:
+            fields.append('power')
+        if calc_only_power:
+            fields.remove('speed')
+        altvals = smoothListGaussian(numpy.nan_to_num(series.altitude).tolist())
+
+        efforts = best_efforts(series, effort_range, altvals, fields)
+    # Replace any existing best efforts
+    with transaction.atomic():
+        if not calc_only_power:
+            bulk_replace(exercise.bestspeedeffort_set.all(),
+                [BestSpeedEffort(exercise=exercise, speed=speed, pos=pos, length=length, duration=seconds, ascent=ascent, descent=descent)
+                    for seconds, (speed, pos, length, ascent, descent) in sorted(efforts.get('speed', {}).items())])
+        bulk_replace(exercise.bestpowereffort_set.all(),
+            [BestPowerEffort(exercise=exercise, power=int(power), pos=pos, length=length, duration=seconds, ascent=ascent, descent=descent)
+                for seconds, (power, pos, length, ascent, descent) in sorted(efforts.get('power', {}).items())])
+    update_power_records(exercise)
+    if not callback is None:
+        subtask(callback).delay(exercise)
 
-    return zones
+def update_power_records(exercise):
+    ''' Update the all time and season power records of the user with the
+    best power efforts of the exercise. Records held by the exercise that
+    it no longer has the efforts for are rebuilt from the effort history. '''
+
+    PowerRecord = get_model('turan', 'PowerRecord')
+
+    # Parses and imports of the same user update the records concurrently
+    with transaction.atomic():
+        lock_user(exercise.user_id)
+        efforts = dict(exercise.bestpowereffort_set.values_list('duration', 'power'))
+        seasons = [0]
+        if exercise.date:
+            seasons.append(exercise.date.year)
+
+        stale = {}
+        for record in PowerRecord.objects.filter(exercise=exercise):
+            if record.season not in seasons or efforts.get(record.duration, 0) < record.power:
+                stale.setdefault(record.season, []).append(record.duration)
+
+        for season in seasons:
+            records = dict((r.duration, r) for r in PowerRecord.objects.filter(user=exercise.user_id, season=season))
+            for duration, power in efforts.items():
+                record = records.get(duration)
+                if record is None:
+                    PowerRecord.objects.create(user_id=exercise.user_id, season=season, duration=duration, power=power, exercise=exercise)
+                elif power > record.power:
+                    record.power = power
+                    record.exercise = exercise
+                    record.save()
+                    if duration in stale.get(season, []):
+                        stale[season].remove(duration)
+
+        for season, durations in stale.items():
+            rebuild_power_records(exercise.user_id, season, durations)
+
+def rebuild_power_records(user_id, season=0, durations=None):
+    ''' Recalculate the power records of a user for a season (0 for all
+    time) from the best power efforts, for all or only the given durations '''
 
-def getwzones(exercise):
-    ''' Get time in watt zones '''
+    BestPowerEffort = get_model('turan', 'BestPowerEffort')
+    PowerRecord = get_model('turan', 'PowerRecord')
+
+    efforts = BestPowerEffort.objects.filter(exercise__user=user_id)
+    records = PowerRecord.objects.filter(user=user_id, season=season)
+    if season:
+        efforts = efforts.filter(exercise__date__year=season)
+    if durations is not None:
+        efforts = efforts.filter(duration__in=durations)
+        records = records.filter(duration__in=durations)
+
+    with transaction.atomic():
+        lock_user(user_id)
+        best = SortedDict()
+        for effort in efforts.order_by('duration', '-power').values('duration', 'power', 'exercise'):
+            if not effort['duration'] in best:
+                best[effort['duration']] = PowerRecord(user_id=user_id, season=season, duration=effort['duration'], power=effort['power'], exercise_id=effort['exercise'])
+        records.delete()
+        PowerRecord.objects.bulk_create(best.values())
+
+# Key of the all time PeriodStatistics
+ALLTIME_START = datetimedate(1970, 1, 1)
+
+# Sums over the exercises of a period, the averages of PeriodStatistics are
+# kept as a sum and a count of the values so the exercise types can be added
+STATISTICS_SUMS = {
+    'num_trips': Count('id'),
+    'sum_distance': Sum('route__distance'),
+    'sum_duration': Sum('duration'),
+    'sum_energy': Sum('kcal'),
+    'sum_ascent': Sum('route__ascent'),
+    'avg_avg_speed_sum': Sum('avg_speed'),
+    'avg_avg_speed_count': Count('avg_speed'),
+    'avg_avg_hr_sum': Sum('avg_hr'),
+    'avg_avg_hr_count': Count('avg_hr'),
+    'avg_normalized_power_sum': Sum('normalized_power'),
+    'avg_normalized_power_count': Count('normalized_power'),
+    'avg_avg_pedaling_power_sum': Sum('avg_pedaling_power'),
+    'avg_avg_pedaling_power_count': Count('avg_pedaling_power'),
+}
+
+STATISTICS_MAXES = {
+    'max_avg_speed': Max('avg_speed'),
+    'max_speed': Max('max_speed'),
+    'max_normalized_power': Max('normalized_power'),
+    'max_avg_pedaling_power': Max('avg_pedaling_power'),
+    'max_max_power': Max('max_power'),
+}
+
+# Sums over the exercises of a period on routes with ascent and distance
+STATISTICS_CLIMB_SUMS = {
+    'climb_distance': Sum('route__distance'),
+    'climb_ascent': Sum('route__ascent'),
+    'climb_duration': Sum('duration'),
+    'climb_trips': Count('id'),
+}
+
+STATISTICS_AVERAGES = ('avg_avg_speed', 'avg_avg_hr', 'avg_normalized_power', 'avg_avg_pedaling_power')
+
+def period_range(period, day):
+    ''' First day of the period of statistics_periods the day is in and the
+    first day after it, or ALLTIME_START and None for all time '''
+
+    if period == 'D':
+        return day, day + timedelta(days=1)
+    if period == 'W':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    if period == 'M':
+        start = day.replace(day=1)
+        return start, (start + timedelta(days=32)).replace(day=1)
+    if period == 'Y':
+        start = day.replace(month=1, day=1)
+        return start, start.replace(year=start.year + 1)
+    return ALLTIME_START, None
+
+def lock_user(user_id):
+    ''' Lock the user until the end of the transaction, so only one task at
+    a time replaces the rows derived from the exercises of the user '''
+    Profile = get_model('profiles', 'Profile')
+    list(Profile.objects.select_for_update().filter(pk=user_id).values_list('pk'))
+
+def schedule_day_update(user_id, day):
+    ''' Queue update_day for the user and day, once for all the saves of
+    exercises on the day in the next USER_DAY_UPDATE_DELAY seconds. A parse
+    or an edit saves the exercise and its route several times. '''
+    delay = getattr(settings, 'USER_DAY_UPDATE_DELAY', 30)
+    if cache.add(day_update_key(user_id, day), True, delay + 60):
+        update_day.apply_async((user_id, day), countdown=delay)
+
+def day_update_key(user_id, day):
+    return 'day_update_%s_%s' %(user_id, day.isoformat())
 
-    values = exercise.get_details().all()
-    # Check for FTP, can't calculate zones if not
-    userftp = exercise.user.get_profile().get_ftp(exercise.date)
-    if not userftp:
-        return {}
-    # Check object for watt
-    if not exercise.avg_power:
-        return {}
+@task
+def update_day(user_id, day):
+    ''' Update everything derived from the exercises of the user on the
+    day, see schedule_day_update '''
+    # Saves from now on need another update
+    cache.delete(day_update_key(user_id, day))
+    update_statistics(user_id, day)
+    update_daily_load(user_id, day)
 
-    zones = SortedDict({
-            1: 0,
-            2: 0,
-            3: 0,
-            4: 0,
-            5: 0,
-            6: 0,
-            7: 0,
-        })
-    previous_time = False
-    for d in values:
-        if not previous_time:
-            previous_time = d.time
+@task
+def update_statistics(user_id, day):
+    ''' Update the PeriodStatistics of the user for every period the day
+    is in, must be called when an exercise on that day changes '''
+
+    PeriodStatistics = get_model('turan', 'PeriodStatistics')
+
+    for period, name in PeriodStatistics._meta.get_field('period').choices:
+        update_period_statistics(user_id, period, period_range(period, day)[0])
+
+def update_period_statistics(user_id, period, start):
+    ''' Replace the PeriodStatistics of the user for the period starting at
+    start with new ones from the exercises in it '''
+
+    with transaction.atomic():
+        # The rows of the period are replaced, overlapping runs would leave
+        # duplicates of the one for all exercise types
+        lock_user(user_id)
+        store_period_statistics(user_id, period, start)
+
+def store_period_statistics(user_id, period, start):
+    Exercise = get_model('turan', 'Exercise')
+    PeriodStatistics = get_model('turan', 'PeriodStatistics')
+    PeriodZone = get_model('turan', 'PeriodZone')
+    PeriodBestPower = get_model('turan', 'PeriodBestPower')
+
+    start, stop = period_range(period, start)
+    # Without the default ordering, which would be grouped by too
+    exercises = Exercise.objects.filter(user=user_id, date__isnull=False).order_by()
+    if stop:
+        exercises = exercises.filter(date__gte=start, date__lt=stop)
+
+    # By exercise type, and the totals of all of them under None
+    totals = {}
+    zones = {}
+    powers = {}
+    def add(exercise_type, row):
+        for key in (exercise_type, None):
+            total = totals.setdefault(key, {})
+            for name, value in row.items():
+                if name in STATISTICS_MAXES:
+                    if value is not None and (total.get(name) is None or value > total[name]):
+                        total[name] = value
+                    else:
+                        total.setdefault(name, None)
+                elif name != 'exercise_type':
+                    total[name] = total.get(name, 0) + (value or 0)
+
+    aggregates = dict(STATISTICS_SUMS, **STATISTICS_MAXES)
+    for row in exercises.values('exercise_type').annotate(**aggregates):
+        add(row['exercise_type'], row)
+    for row in exercises.filter(route__ascent__gt=0, route__distance__gt=0).values('exercise_type').annotate(**STATISTICS_CLIMB_SUMS):
+        add(row['exercise_type'], row)
+    for exercise_type, zone, duration in exercises.values_list('exercise_type', 'hrzonesummary__zone').annotate(Sum('hrzonesummary__duration')):
+        if zone is None:
+            continue
+        for key in (exercise_type, None):
+            zones.setdefault(key, {})
+            zones[key][zone] = zones[key].get(zone, 0) + (duration or 0)
+    for exercise_type, duration, power in exercises.values_list('exercise_type', 'bestpowereffort__duration').annotate(Max('bestpowereffort__power')):
+        if duration not in EFFORT_DURATIONS:
             continue
-        time = d.time - previous_time
-        previous_time = d.time
-        if time.seconds > 60:
+        for key in (exercise_type, None):
+            powers.setdefault(key, {})
+            powers[key][duration] = max(powers[key].get(duration, 0), power)
+
+    PeriodStatistics.objects.filter(user=user_id, period=period, start=start).delete()
+    for exercise_type, total in totals.items():
+        if not total.get('num_trips'):
             continue
-        w_percent = 0
-        if d.power:
-            w_percent = float(d.power)*100/userftp
-        zone = watt2zone(w_percent)
-        zones[zone] += time.seconds
-    return zones
+        statistics = PeriodStatistics(user_id=user_id, period=period, start=start, exercise_type_id=exercise_type)
+        for name in ('num_trips', 'sum_distance', 'sum_energy', 'sum_ascent') + tuple(STATISTICS_MAXES):
+            setattr(statistics, name, total[name])
+        statistics.sum_duration = int(total['sum_duration'])
+        for name in STATISTICS_AVERAGES:
+            if total[name + '_count']:
+                setattr(statistics, name, float(total[name + '_sum'])/total[name + '_count'])
+        if total.get('climb_trips') and total['climb_duration']:
+            statistics.avgclimb = float(total['climb_ascent'])/total['climb_distance']
+            statistics.avgclimbperhour = total['climb_ascent']/(float(total['climb_duration'])/10**6/3600)
+            statistics.avglen = float(total['climb_distance'])/total['climb_trips']
+        statistics.save()
+        PeriodZone.objects.bulk_create([PeriodZone(statistics=statistics, zone=zone, duration=duration)
+            for zone, duration in sorted(zones.get(exercise_type, {}).items())])
+        PeriodBestPower.objects.bulk_create([PeriodBestPower(statistics=statistics, duration=duration, power=power)
+            for duration, power in sorted(powers.get(exercise_type, {}).items())])
 
 @task
-def calculate_best_efforts(exercise, effort_range=[5, 10, 30, 60, 240, 300, 600, 1200, 1800, 3600], calc_only_power=False, callback=None):
-    ''' Iterate over details for different effort ranges finding best
-    speed and power efforts '''
-
-    # First: Delete any existing best efforts
-    if not calc_only_power:
-        exercise.bestspeedeffort_set.all().delete()
-    exercise.bestpowereffort_set.all().delete()
-    BestSpeedEffort = get_model('turan', 'BestSpeedEffort')
-    BestPowerEffort = get_model('turan', 'BestPowerEffort')
+def rebuild_statistics(user_id=None):
+    ''' Recalculate all PeriodStatistics, of one user or of everyone '''
+
+    Exercise = get_model('turan', 'Exercise')
+    PeriodStatistics = get_model('turan', 'PeriodStatistics')
+
+    exercises = Exercise.objects.filter(date__isnull=False)
+    if user_id is not None:
+        exercises = exercises.filter(user=user_id)
+    keys = set()
+    for user, day in exercises.order_by().values_list('user', 'date').distinct():
+        for period, name in PeriodStatistics._meta.get_field('period').choices:
+            keys.add((user, period, period_range(period, day)[0]))
+    for user, period, start in sorted(keys):
+        update_period_statistics(user, period, start)
+
+# Time constants in days of the chronic and acute training load
+CTL_DAYS = 42
+ATL_DAYS = 7
+
+def exercise_load(exercise):
+    ''' TSS and BikeScore of the exercise, 0 without power or FTP '''
+    tss, bikescore = 0, 0
+    if exercise.get_ftp() and exercise.duration:
+        if exercise.normalized_power:
+            tss = exercise.get_tss()
+        bikescore = exercise.get_bikescore() or 0
+    return tss, bikescore
+
+def decay_load(load, days, time_constant):
+    ''' Training load after days without exercise '''
+    return load*(1 - 1.0/time_constant)**days
 
-    details = exercise.get_details().all()
-    calc_power = exercise.avg_power and not exercise.is_smart_sampled()
+@task
+def update_daily_load(user_id, day):
+    ''' Replace the DailyLoad of the user for the day with one from the
+    exercises on it, and update the training load of the days after it '''
 
-    if details:
-        if exercise.avg_speed:
-            altvals = []
-            for a in details:
-                altvals.append(a.altitude)
-
-            altvals = smoothListGaussian(altvals)
-            for seconds in effort_range:
-                if calc_power and not calc_only_power:
-                    speed, pos, length, speed_ascent, speed_descent, power, power_pos, power_length, power_ascent, power_descent = best_x_sec(details, seconds, altvals, power=True)
-                    if power:
-                        be = BestPowerEffort(exercise=exercise, power=power, pos=power_pos, length=power_length, duration=seconds, ascent=power_ascent, descent=power_descent)
-                        be.save()
-                    if speed:
-                        be = BestSpeedEffort(exercise=exercise, speed=speed, pos=pos, length=length, duration=seconds, ascent=speed_ascent, descent=speed_descent)
-                        be.save()
-                elif not calc_power:
-                    speed, pos, length, speed_ascent, speed_descent = best_x_sec(details, seconds, altvals, power=False)
-                    if speed:
-                        be = BestSpeedEffort(exercise=exercise, speed=speed, pos=pos, length=length, duration=seconds, ascent=speed_ascent, descent=speed_descent)
-                        be.save()
-                elif calc_power and calc_only_power:
-                    power, power_pos, power_length, power_ascent, power_descent = best_x_sec(details, seconds, altvals, power=True, speed=False)
-                    if power:
-                        be = BestPowerEffort(exercise=exercise, power=power, pos=power_pos, length=power_length, duration=seconds, ascent=power_ascent, descent=power_descent)
-                        be.save()
-    if not callback is None:
-        subtask(callback).delay(exercise)
+    with transaction.atomic():
+        lock_user(user_id)
+        store_daily_load(user_id, day)
+        roll_daily_load(user_id, day)
+
+@task
+def rebuild_daily_load(user_id, start=None):
+    ''' Recalculate the DailyLoad of the user from the day start, or for
+    all days '''
+
+    Exercise = get_model('turan', 'Exercise')
+    DailyLoad = get_model('turan', 'DailyLoad')
+
+    days = Exercise.objects.filter(user=user_id, date__isnull=False).order_by().values_list('date', flat=True).distinct()
+    loads = DailyLoad.objects.filter(user=user_id)
+    if start:
+        days = days.filter(date__gte=start)
+        loads = loads.filter(date__gte=start)
+    with transaction.atomic():
+        lock_user(user_id)
+        loads.delete()
+        for day in days:
+            store_daily_load(user_id, day)
+        roll_daily_load(user_id, start or ALLTIME_START)
+
+def store_daily_load(user_id, day):
+    ''' Sum the exercises of the user on the day into its DailyLoad,
+    leaving the training load to roll_daily_load '''
+
+    Exercise = get_model('turan', 'Exercise')
+    DailyLoad = get_model('turan', 'DailyLoad')
+
+    DailyLoad.objects.filter(user=user_id, date=day).delete()
+    exercises = Exercise.objects.filter(user=user_id, date=day)
+    if not exercises.exists():
+        return
+    load = DailyLoad(user_id=user_id, date=day)
+    for exercise in exercises.select_related('user'):
+        tss, bikescore = exercise_load(exercise)
+        load.tss += tss
+        load.bikescore += bikescore
+    sums = exercises.order_by().aggregate(Sum('duration'), Sum('route__distance'), Sum('kcal'))
+    load.duration = int((sums['duration__sum'] or 0)/10**6)
+    load.distance = sums['route__distance__sum'] or 0
+    load.kcal = sums['kcal__sum'] or 0
+    load.save()
+
+def roll_daily_load(user_id, start):
+    ''' Carry the chronic and acute training load of the user through the
+    DailyLoad from the day start. The load decays exponentially towards the
+    TSS of every day, days without a DailyLoad have no TSS. '''
+
+    DailyLoad = get_model('turan', 'DailyLoad')
+
+    ctl, atl, previous = 0, 0, None
+    before = DailyLoad.objects.filter(user=user_id, date__lt=start).order_by('-date')[:1]
+    if before:
+        ctl, atl, previous = before[0].ctl, before[0].atl, before[0].date
+    for load in DailyLoad.objects.filter(user=user_id, date__gte=start).order_by('date'):
+        if previous:
+            rest = (load.date - previous).days - 1
+            ctl, atl = decay_load(ctl, rest, CTL_DAYS), decay_load(atl, rest, ATL_DAYS)
+        load.tsb = ctl - atl
+        load.ctl = ctl + (load.tss - ctl)/float(CTL_DAYS)
+        load.atl = atl + (load.tss - atl)/float(ATL_DAYS)
+        load.save()
+        ctl, atl, previous = load.ctl, load.atl, load.date
+
+def training_load(user_id, start, stop):
+    ''' Dicts of the load of the user for every day from start to stop,
+    including the days without exercise '''
+
+    DailyLoad = get_model('turan', 'DailyLoad')
+
+    loads = dict((load.date, load) for load in DailyLoad.objects.filter(user=user_id, date__gte=start, date__lte=stop))
+    ctl, atl = 0, 0
+    before = DailyLoad.objects.filter(user=user_id, date__lt=start).order_by('-date')[:1]
+    if before:
+        rest = (start - before[0].date).days - 1
+        ctl, atl = decay_load(before[0].ctl, rest, CTL_DAYS), decay_load(before[0].atl, rest, ATL_DAYS)
+
+    days = []
+    day = start
+    while day <= stop:
+        load = loads.get(day)
+        if load:
+            ctl, atl = load.ctl, load.atl
+            days.append({'date': day, 'tss': load.tss, 'bikescore': load.bikescore, 'ctl': ctl, 'atl': atl, 'tsb': load.tsb})
+        else:
+            tsb = ctl - atl
+            ctl, atl = decay_load(ctl, 1, CTL_DAYS), decay_load(atl, 1, ATL_DAYS)
+            days.append({'date': day, 'tss': 0, 'bikescore': 0, 'ctl': ctl, 'atl': atl, 'tsb': tsb})
+        day += timedelta(days=1)
+    return days
 
 @task
 def normalize_altitude(exercise):
     ''' Normalize altitude, that is, if it's below zero scale every value up.
     Also set max and min altitude on route'''
 
-    altitude_min = exercise.get_details().aggregate(Min('altitude'))['altitude__min']
+    series = exercise.get_series()
+    altitude_min, altitude_max = None, None
+    if series.has('altitude'):
+        altitude_min = float(numpy.nanmin(series.altitude))
+        altitude_max = float(numpy.nanmax(series.altitude))
     if altitude_min and altitude_min < 0:
         # Find new value
         altitude_min = 0 - altitude_min
@@ -977,11 +1328,12 @@ def normalize_altitude(exercise):
         # Data modifying operation - commit required
         cursor.execute("UPDATE turan_exercisedetail set altitude = altitude + %s WHERE exercise_id = %s", [altitude_min, exercise.id])
         transaction.commit_unless_managed()
+        # Keep the series in step with the details
+        series.altitude += altitude_min
+        altitude_max += altitude_min
+        altitude_min = 0.0
 
     # Find min and max and populate route object
-    # fetch new values from db after normalize
-    altitude_min = exercise.get_details().aggregate(Min('altitude'))['altitude__min']
-    altitude_max = exercise.get_details().aggregate(Max('altitude'))['altitude__max']
     r = exercise.route
     if r:
         if not r.min_altitude:
@@ -1164,75 +1516,386 @@ def sanitize_entries(parser):
     return entries # Not really used.
 
 @task
-def parse_and_calculate(exercise, callback=None):
-    ''' Helper function that calls all the functions required for a full parse of an exercise '''
-
-    parse_sensordata(exercise)
-    merge_sensordata(exercise)
-    if exercise.avg_power:
-        #exercise.normalized_power = power_30s_average(exercise.get_details().all())
-        exercise.normalized_power = normalized_attr(exercise, 'power')
-        exercise.xPower = calculate_exercise_xPower(exercise)
-        exercise.save()
-    #exercise.normalized_hr = normalized_attr(exercise, 'hr')
-    normalize_altitude(exercise)
-    create_gpx_from_details(exercise)
-    calculate_best_efforts(exercise)
-    calculate_time_in_zones(exercise)
-    calculate_gradients(exercise)
-    calculate_freqs(exercise)
-    getslopes(exercise.get_details().all(),
-            exercise.user.get_profile().get_weight(exercise.date),
-            exercise.get_eq_weight())
-    populate_interval_info(exercise)
-    find_max_positions(exercise)
-    for segment in search_trip_for_possible_segments_matches(exercise):
-        slice_to_segmentdetail(exercise, segment[0], segment[1], segment[2])
-        # TODO: send notifications notification.send(friend_set_for(request.user.id), 'exercise_create', {'sender': request.user, 'exercise': new_object}, [request.user])
+def parse_and_calculate(exercise, callback=None, in_process=False):
+    ''' Parse the sensor file of an exercise and store the samples, then
+    start the analysis of them in parallel, see analyze_exercise. The
+    exercise can be shown as soon as this returns. With in_process the
+    analysis is run before returning instead, see run_analysis. '''
+
+    # The samples are kept in memory as exercise.get_series() from the
+    # parse on, so the steps below only use the database for writes
+    timer = StageTimer('Parse timings for exercise %s' %exercise.id)
+    with timer('parse'):
+        parse_sensordata(exercise)
+    with timer('merge'):
+        merge_sensordata(exercise)
+    with timer('normalize'):
+        if exercise.avg_power:
+            #exercise.normalized_power = power_30s_average(exercise.get_details().all())
+            exercise.normalized_power = normalized_attr(exercise, 'power')
+            exercise.xPower = calculate_exercise_xPower(exercise)
+            exercise.save()
+        #exercise.normalized_hr = normalized_attr(exercise, 'hr')
+        normalize_altitude(exercise)
+    with timer('series'):
+        store_series(exercise, exercise.get_series())
+        store_track_index(exercise, exercise.get_series())
+    with timer('gpx'):
+        create_gpx_from_details(exercise)
+    timer.report()
+    if in_process:
+        run_analysis(exercise)
+    else:
+        analyze_exercise(exercise)
 
 @task
-def parse_sensordata(exercise):
-    ''' The function that takes care of parsing data file from sports equipment from polar or garmin and putting values into the detail-db, and also summarized values for trip. '''
+def run_bulk_import(job_id):
+    ''' Create an item for every file in the archive of a BulkImport and
+    start BULK_IMPORT_CONCURRENCY workers parsing them '''
+
+    BulkImport = get_model('turan', 'BulkImport')
+    BulkImportItem = get_model('turan', 'BulkImportItem')
+
+    job = BulkImport.objects.get(pk=job_id)
+    zfile = zipfile.ZipFile(job.archive.file)
+    items = [BulkImportItem(job=job, filename=info.filename) for info in zfile.infolist() if not info.filename.endswith('/')]
+    zfile.close()
+    BulkImportItem.objects.bulk_create(items)
+    BulkImport.objects.filter(pk=job_id).update(state='R')
+
+    workers = min(len(items), getattr(settings, 'BULK_IMPORT_CONCURRENCY', 4))
+    for i in range(workers):
+        bulk_import_worker.delay(job_id)
+    if not workers:
+        BulkImport.objects.filter(pk=job_id).update(state='D')
+
+def claim_bulk_import_item(job_id):
+    ''' Mark the next pending item of the job as running and return it, or
+    None if there are none left. Safe to call from concurrent workers.
+
+    Items running for more than BULK_IMPORT_ITEM_TIMEOUT seconds belonged
+    to a worker that was killed or timed out, and are pending again. '''
+
+    BulkImportItem = get_model('turan', 'BulkImportItem')
+
+    now = timezone.now()
+    stale = now - timedelta(seconds=getattr(settings, 'BULK_IMPORT_ITEM_TIMEOUT', 3600))
+    running = BulkImportItem.objects.filter(job=job_id, state='R')
+    running.filter(Q(claimed__lt=stale) | Q(claimed__isnull=True)).update(state='P')
+    while True:
+        ids = list(BulkImportItem.objects.filter(job=job_id, state='P').values_list('id', flat=True)[:10])
+        if not ids:
+            return None
+        for item_id in ids:
+            if BulkImportItem.objects.filter(pk=item_id, state='P').update(state='R', claimed=now):
+                return BulkImportItem.objects.get(pk=item_id)
+
+@task
+def bulk_import_worker(job_id):
+    ''' Import, parse and analyze the next pending file of a BulkImport,
+    then queue itself again until no files are left. The number of these
+    running per job bounds the number of files being parsed and analyzed
+    at the same time.
+
+    While other workers still run files it checks back when the oldest of
+    them times out, so a file of a killed worker is picked up again. '''
+
+    BulkImport = get_model('turan', 'BulkImport')
+    BulkImportItem = get_model('turan', 'BulkImportItem')
+    Exercise = get_model('turan', 'Exercise')
+
+    item = claim_bulk_import_item(job_id)
+    if item is None:
+        claimed = BulkImportItem.objects.filter(job=job_id, state='R').aggregate(Min('claimed'))['claimed__min']
+        if claimed:
+            timeout = getattr(settings, 'BULK_IMPORT_ITEM_TIMEOUT', 3600)
+            countdown = (claimed + timedelta(seconds=timeout) - timezone.now()).total_seconds()
+            bulk_import_worker.apply_async((job_id,), countdown=max(countdown, 0) + 60)
+        elif not BulkImportItem.objects.filter(job=job_id, state__in=('P', 'R')).exists():
+            BulkImport.objects.filter(pk=job_id).update(state='D')
+        return
+
+    job = item.job
+    try:
+        # A run of the item that was killed may have created the exercise
+        exercise = item.exercise
+        if exercise is None:
+            zfile = zipfile.ZipFile(job.archive.file)
+            try:
+                # Streams the member to the storage instead of reading it into memory
+                member = File(zfile.open(item.filename))
+                member.size = zfile.getinfo(item.filename).file_size
+                exercise = Exercise()
+                exercise.user = job.user
+                exercise.sensor_file.save(os.path.join('sensor', item.filename.lower()), member)
+                exercise.save()
+            finally:
+                zfile.close()
+            item.exercise = exercise
+            BulkImportItem.objects.filter(pk=item.pk).update(exercise=exercise)
+        parse_and_calculate(exercise, in_process=True)
+        item.state = 'D'
+    except Exception, e:
+        print "Bulk import of %s failed: %s" %(item.filename, e)
+        item.state = 'F'
+        item.error = unicode(e)
+    item.save()
+
+    bulk_import_worker.delay(job_id)
 
+@task
+def store_series(exercise, series=None):
+    ''' Pack the series, or the details of the exercise, into its
+    ExerciseSeries, replacing any previous copy. Returns the Series '''
+
+    ExerciseSeries = get_model('turan', 'ExerciseSeries')
+    ExerciseSeriesLevel = get_model('turan', 'ExerciseSeriesLevel')
+
+    if series is None:
+        series = Series.from_values(exercise.get_details().values_list(*SERIES_FIELDS))
+    with transaction.atomic():
+        ExerciseSeries.objects.filter(exercise=exercise).delete()
+        ExerciseSeriesLevel.objects.filter(exercise=exercise).delete()
+        if len(series):
+            ExerciseSeries.objects.create(exercise=exercise, data=series.pack())
+        if len(series) >= SERIES_LEVEL_MIN_SAMPLES:
+            extra = {}
+            if series.has('power'):
+                extra['poweravg30s'] = numpy.array(smoothList(numpy.nan_to_num(series.power))[:len(series)])
+            for factor in SERIES_LEVELS:
+                level = series.downsample(factor)
+                data = level.pack(index=level.index, **dict((name, values[level.index]) for name, values in extra.items()))
+                ExerciseSeriesLevel.objects.create(exercise=exercise, factor=factor, length=len(level), data=data)
+    exercise._series = series
+    return series
+
+def store_track_index(exercise, series=None):
+    ''' Store the bounding box and grid cells of the track of the exercise,
+    replacing any previous ones '''
+
+    ExerciseExtent = get_model('turan', 'ExerciseExtent')
+    ExerciseCell = get_model('turan', 'ExerciseCell')
+
+    if series is None:
+        series = exercise.get_series()
+    bbox = track_bbox(series.lat, series.lon)
+    with transaction.atomic():
+        ExerciseExtent.objects.filter(exercise=exercise).delete()
+        ExerciseCell.objects.filter(exercise=exercise).delete()
+        if bbox is None:
+            return
+        min_lat, min_lon, max_lat, max_lon = bbox
+        ExerciseExtent.objects.create(exercise=exercise, min_lat=min_lat, min_lon=min_lon, max_lat=max_lat, max_lon=max_lon)
+        ExerciseCell.objects.bulk_create([ExerciseCell(exercise=exercise, cell=cell) for cell in track_cells(series.lat, series.lon)])
+
+def unindexed_exercises():
+    ''' Ids of the exercises with a sensor file and no track index, most of
+    them parsed before it existed '''
+
+    Exercise = get_model('turan', 'Exercise')
+
+    return list(Exercise.objects.filter(extent__isnull=True).exclude(sensor_file='').order_by('id').values_list('id', flat=True))
 
-    print "Parsing Exercise: %s, with file: %s" %(exercise.id, exercise.sensor_file)
+@task
+def index_tracks(exercise_ids):
+    ''' Store the track index of the exercises, see manage.py index_tracks.
+    Returns the number that failed. '''
+
+    Exercise = get_model('turan', 'Exercise')
+
+    failed = 0
+    for exercise in Exercise.objects.filter(id__in=exercise_ids):
+        try:
+            store_track_index(exercise)
+        except Exception, e:
+            print "Indexing track of exercise %s failed: %s" %(exercise.id, e)
+            failed += 1
+    return failed
+
+# Zoom levels of the stored GeoJSON of tracks, requests for other levels get
+# the nearest finer one
+GEOJSON_ZOOMS = (10, 13, 16)
+
+# Metres per pixel at zoom level 0 on the equator
+ZOOM_0_RESOLUTION = 156543.03
+
+def geojson_path(exercise_id, zoom):
+    return 'geojson/%s.%s.json.gz' %(exercise_id, zoom)
+
+def geojson_zoom(zoom=None):
+    ''' The stored zoom level to serve for zoom, the finest if None '''
+    if zoom is not None:
+        for level in GEOJSON_ZOOMS:
+            if level >= zoom:
+                return level
+    return GEOJSON_ZOOMS[-1]
+
+def track_zones(exercise, series=None):
+    ''' Sample indexes, positions and HR zones of the samples of the
+    exercise with position and HR '''
+
+    if series is None:
+        series = exercise.get_series()
+    with numpy.errstate(invalid='ignore'):
+        mask = (series.lon != 0) & (series.lat != 0) & ~numpy.isnan(series.lon) & ~numpy.isnan(series.lat) & ~numpy.isnan(series.hr)
+    max_hr = exercise.user.get_profile().max_hr
+    if not max_hr: # sigh
+        max_hr = 200
+    return {
+        'sample': numpy.flatnonzero(mask).astype(numpy.uint32),
+        'lon': series.lon[mask],
+        'lat': series.lat[mask],
+        'zone': hr2zones(series.hr[mask]*100.0/max_hr),
+    }
+
+def replace_stored_file(storage, name, data):
+    ''' Write data to the file name of the storage through a temporary file
+    renamed over it, so readers get either the old or the new content, and
+    concurrent writers do not end up with suffixed copies '''
+
+    path = storage.path(name)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Made by another writer in the meantime
+            if not os.path.isdir(directory):
+                raise
+    fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp, getattr(settings, 'FILE_UPLOAD_PERMISSIONS', None) or 0644)
+        os.rename(temp, path)
+    except:
+        os.unlink(temp)
+        raise
+
+@task
+def store_track_geojson(exercise, series=None):
+    ''' Store the track of the exercise coloured by HR zone, as the zones of
+    the samples for slices of it and as gzipped GeoJSON simplified for each
+    of GEOJSON_ZOOMS to about half a pixel. Returns the GeoJSON by zoom. '''
+
+    ExerciseTrackZones = get_model('turan', 'ExerciseTrackZones')
+
+    track = track_zones(exercise, series)
+    data = pack_arrays(**track)
+    if not ExerciseTrackZones.objects.filter(exercise=exercise).update(data=data):
+        try:
+            with transaction.atomic():
+                ExerciseTrackZones.objects.create(exercise=exercise, data=data)
+        except IntegrityError:
+            # Stored meanwhile by the analysis or another request, from the
+            # same samples
+            pass
+    if len(track['lat']):
+        scale = cos(radians(track['lat'].mean()))
+    else:
+        scale = 1
+    collections = {}
+    for zoom in GEOJSON_ZOOMS:
+        tolerance = ZOOM_0_RESOLUTION*scale/2**zoom/2
+        collections[zoom] = compress_string(str(zone_collection(track['lon'], track['lat'], track['zone'], tolerance)))
+        replace_stored_file(gpxstore, geojson_path(exercise.id, zoom), collections[zoom])
+    return collections
+
+def get_track_zones(exercise):
+    ''' The stored track_zones of the exercise, storing them if missing '''
+
+    ExerciseTrackZones = get_model('turan', 'ExerciseTrackZones')
+    try:
+        data = ExerciseTrackZones.objects.get(exercise=exercise).data
+    except ExerciseTrackZones.DoesNotExist:
+        store_track_geojson(exercise)
+        data = ExerciseTrackZones.objects.get(exercise=exercise).data
+    return unpack_arrays(data)
+
+def delete_track_geojson(exercise):
+    ExerciseTrackZones = get_model('turan', 'ExerciseTrackZones')
+    ExerciseTrackZones.objects.filter(exercise=exercise).delete()
+    for zoom in GEOJSON_ZOOMS:
+        path = geojson_path(exercise.id, zoom)
+        if gpxstore.exists(path):
+            gpxstore.delete(path)
+
+@task
+def invalidate_track_geojson(user_id):
+    ''' Drop the stored tracks of the exercises of the user, their zones
+    depend on the max HR. They are stored again when next shown. '''
+    Exercise = get_model('turan', 'Exercise')
+    for exercise in Exercise.objects.filter(user=user_id, exercisetrackzones__isnull=False).only('id'):
+        delete_track_geojson(exercise)
+
+def invalidate_series(exercise):
+    ''' Drop the packed copy of the details, must be called by anything
+    changing the details of an exercise '''
+
+    ExerciseSeries = get_model('turan', 'ExerciseSeries')
+    ExerciseSeriesLevel = get_model('turan', 'ExerciseSeriesLevel')
+    ExerciseSeries.objects.filter(exercise=exercise).delete()
+    ExerciseSeriesLevel.objects.filter(exercise=exercise).delete()
+    get_model('turan', 'ExerciseHistograms').objects.filter(exercise=exercise).delete()
+    delete_track_geojson(exercise)
+    bump_exercise(exercise.id)
+    if hasattr(exercise, '_series'):
+        del exercise._series
+
+def bulk_insert_details(details, batch_size=None):
+    ''' Insert unsaved ExerciseDetail objects with multi-row INSERTs.
+
+    Saving the samples one by one costs a round trip per sample, which
+    dominates the parse time of long exercises. The batch size can be tuned
+    with the EXERCISEDETAIL_BATCH_SIZE setting. '''
+
+    if not details:
+        return 0
 
     ExerciseDetail = get_model('turan', 'ExerciseDetail')
-    Interval = get_model('turan', 'Interval')
+    if not batch_size:
+        batch_size = getattr(settings, 'EXERCISEDETAIL_BATCH_SIZE', 1000)
 
-    # Delete any existing Intervals
-    exercise.interval_set.all().delete()
+    start = time.time()
+    ExerciseDetail.objects.bulk_create(details, batch_size=batch_size)
+    elapsed = time.time() - start
+    print "Saved %d ExerciseDetails in %.2fs (%d rows/s)" %(len(details), elapsed, len(details)/max(elapsed, 0.001))
+    return len(details)
 
+def bulk_replace(queryset, objects, batch_size=None):
+    ''' Replace the rows of queryset with the unsaved objects, of the same
+    model, in one transaction with multi-row INSERTs.
 
-    if exercise.get_details().count(): # If the exercise already has details, delete them and reparse
-        # Django is super shitty when it comes to deletion. If you want to delete 25k objects, it uses 500 queries to do so.
-        # So. We do some RAWness.
-        cursor = connection.cursor()
+    For the rows derived from an exercise or segment, which are thrown away
+    and calculated again on every reparse. Their save methods and signals
+    are not run. The batch size can be tuned with the BULK_REPLACE_BATCH_SIZE
+    setting. '''
 
-        # Data modifying operation - commit required
-        cursor.execute("DELETE FROM turan_exercisedetail WHERE exercise_id = %s", [exercise.id])
-        transaction.commit_unless_managed()
+    if not batch_size:
+        batch_size = getattr(settings, 'BULK_REPLACE_BATCH_SIZE', 1000)
+
+    with transaction.atomic():
+        queryset.delete()
+        queryset.model.objects.bulk_create(objects, batch_size=batch_size)
+    return len(objects)
 
-    if exercise.slope_set.count(): # If the exercise has slopes, delete them too
-        exercise.slope_set.all().delete()
+@task
+def parse_sensordata(exercise):
+    ''' The function that takes care of parsing data file from sports equipment from polar or garmin and putting values into the detail-db, and also summarized values for trip. '''
 
 
-    # Delete cache
-    # TODO: Fix better cache key stuffs
-    cache_keys = (
-            'json_trip_series_%s_%dtime_xaxis_%dpower_%dsmooth' %(exercise.id, 0, 0, 1),
-            'json_trip_series_%s_%dtime_xaxis_%dpower_%dsmooth' %(exercise.id, 1, 0, 1),
-            'json_trip_series_%s_%dtime_xaxis_%dpower_%dsmooth' %(exercise.id, 0, 0, 0),
-            'json_trip_series_%s_%dtime_xaxis_%dpower_%dsmooth' %(exercise.id, 1, 0, 0)
-            )
-    cache.delete_many(cache_keys)
+    print "Parsing Exercise: %s, with file: %s" %(exercise.id, exercise.sensor_file)
 
+    ExerciseDetail = get_model('turan', 'ExerciseDetail')
+    Interval = get_model('turan', 'Interval')
 
     # exercise.sensor_file.file.seek(0) 
     parser = find_parser(exercise.sensor_file)
     parser.parse_uploaded_file(exercise.sensor_file.file)
 
     sanitize_entries(parser) # Sanity will prevail
+
+    details = []
     for val in parser.entries:
         detail = ExerciseDetail()
         detail.exercise_id = exercise.id
@@ -1240,10 +1903,10 @@ def parse_sensordata(exercise):
         for v in ('distance', 'time', 'hr', 'altitude', 'speed', 'cadence', 'lon', 'lat', 'power', 'temp'):
             if hasattr(val, v):
                 setattr(detail, v, getattr(val, v))
-        detail.save()
-    #print "Saved ExerciseDetails: %s" %(exercise.id)
+        details.append(detail)
 
     # Parse laps/intervals
+    intervals = []
     for val in parser.laps:
         interval = Interval()
         interval.exercise_id = exercise.id
@@ -1257,7 +1920,37 @@ def parse_sensordata(exercise):
            ):
             if hasattr(val, v):
                 setattr(interval, v, getattr(val, v))
-        interval.save()
+        intervals.append(interval)
+
+    # Interval.save looks up the start distance in the stored details, do
+    # it in memory instead so the intervals can be inserted in one go
+    start_distances = {}
+    for detail in details:
+        start_distances.setdefault(detail.time, detail.distance)
+    for interval in intervals:
+        if not interval.start and interval.start_time in start_distances:
+            interval.start = start_distances[interval.start_time] or 0
+
+    # Swap the old rows for the new ones in one transaction, so a reparse
+    # never leaves the exercise half populated
+    with transaction.atomic():
+        if exercise.get_details().exists(): # If the exercise already has details, delete them and reparse
+            # Django is super shitty when it comes to deletion. If you want to delete 25k objects, it uses 500 queries to do so.
+            # So. We do some RAWness.
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM turan_exercisedetail WHERE exercise_id = %s", [exercise.id])
+
+        if exercise.slope_set.exists(): # If the exercise has slopes, delete them too
+            exercise.slope_set.all().delete()
+
+        invalidate_series(exercise)
+        bulk_insert_details(details)
+        # The sanitized samples, for the rest of the parse
+        exercise._series = Series.from_entries(details)
+
+        bulk_replace(exercise.interval_set.all(), intervals)
+
+    bump_exercise(exercise.id)
 
     exercise.max_hr = parser.max_hr
     exercise.max_speed = parser.max_speed
@@ -1322,7 +2015,7 @@ def parse_sensordata(exercise):
             route.save()
 
         if route.distance:
-            ascent, descent = calculate_ascent_descent_gaussian(exercise.get_details().all())
+            ascent, descent = calculate_ascent_descent_gaussian(details)
         else:
             ascent = 0
             descent = 0
@@ -1339,7 +2032,7 @@ def parse_sensordata(exercise):
 
 @task
 def populate_interval_info(exercise):
-    details = list(exercise.exercisedetail_set.all())
+    details = exercise.get_series().rows()
     #d = filldistance(details) # FIXME
     for interval in exercise.interval_set.all():
         start = 0 #= exercise.exercisedetail_set.get(time=interval.start_time)
@@ -1355,7 +2048,7 @@ def populate_interval_info(exercise):
                     break
 
         i_details = details[start:stop]
-        ret = detailslice_info(i_details)
+        ret = detailslice_info(i_details, exercise)
 
 
         def check_and_set(attr, val):
@@ -1384,58 +2077,126 @@ def populate_interval_info(exercise):
         interval.save()
 
 
+MAX_POSITION_FIELDS = ('max_speed_lat', 'max_speed_lon', 'max_power_lat', 'max_power_lon',
+        'max_hr_lat', 'max_hr_lon', 'max_cadence_lat', 'max_cadence_lon',
+        'max_altitude_lat', 'max_altitude_lon')
+
 @task
 def find_max_positions(exercise):
-    ''' Use SQL to find the different lon, lats for maximum values '''
-    try:
+    ''' Find the different lon, lats for maximum values '''
+
+    series = exercise.get_series()
+
+    def max_position(attr):
+        values = series[attr]
+        if numpy.isnan(values).all():
+            return None, None
+        i = numpy.nanargmax(values)
+        lat, lon = series.lat[i], series.lon[i]
+        return (None if lat != lat else float(lat)), (None if lon != lon else float(lon))
+
+    if len(series):
         if exercise.avg_speed:
-            max = exercise.exercisedetail_set.annotate(max=Max('speed')).values('lon','lat','max').order_by('-max')[0]
-            exercise.max_speed_lat = max['lat']
-            exercise.max_speed_lon = max['lon']
+            exercise.max_speed_lat, exercise.max_speed_lon = max_position('speed')
         else:
             exercise.max_speed_lat = 0
             exercise.max_speed_lon = 0
-    except IndexError:
-        pass
-    try:
         if exercise.avg_power:
-            max = exercise.exercisedetail_set.annotate(max=Max('power')).values('lon','lat','max').order_by('-max')[0]
-            exercise.max_power_lat = max['lat']
-            exercise.max_power_lon = max['lon']
+            exercise.max_power_lat, exercise.max_power_lon = max_position('power')
         else:
             exercise.max_power_lat = 0
             exercise.max_power_lon = 0
-    except IndexError:
-        pass
-    try:
         if exercise.avg_hr:
-            max = exercise.exercisedetail_set.annotate(max=Max('hr')).values('lon','lat','max').order_by('-max')[0]
-            exercise.max_hr_lat = max['lat']
-            exercise.max_hr_lon = max['lon']
+            exercise.max_hr_lat, exercise.max_hr_lon = max_position('hr')
         else:
             exercise.max_hr_lat = 0
             exercise.max_hr_lon = 0
-    except IndexError:
-        pass
-    try:
         if exercise.avg_cadence:
-            max = exercise.exercisedetail_set.annotate(max=Max('cadence')).values('lon','lat','max').order_by('-max')[0]
-            exercise.max_cadence_lat = max['lat']
-            exercise.max_cadence_lon = max['lon']
+            exercise.max_cadence_lat, exercise.max_cadence_lon = max_position('cadence')
         else:
             exercise.max_cadence_lat = 0
             exercise.max_cadence_lon = 0
+        if exercise.route and exercise.route.max_altitude:
+            exercise.max_altitude_lat, exercise.max_altitude_lon = max_position('altitude')
+    # Only write the positions, the other analysis stages run at the same time
+    fields = dict((name, getattr(exercise, name)) for name in MAX_POSITION_FIELDS)
+    exercise.__class__.objects.filter(pk=exercise.pk).update(**fields)
+
+def calculate_efforts(exercise):
+    calculate_best_efforts(exercise)
+    calculate_mean_max(exercise)
+
+def calculate_slopes(exercise):
+    getslopes(exercise, exercise.get_series().rows(),
+            exercise.user.get_profile().get_weight(exercise.date),
+            exercise.get_eq_weight())
+
+def find_segments(exercise):
+    ''' Add the segments passed in the exercise '''
+    for segment in search_trip_for_possible_segments_matches(exercise):
+        slice_to_segmentdetail(exercise, segment[0], segment[1], segment[2])
+        # TODO: send notifications notification.send(friend_set_for(request.user.id), 'exercise_create', {'sender': request.user, 'exercise': new_object}, [request.user])
 
-    except IndexError:
-        pass
+# Steps of the parse that only read the stored samples and do not depend on
+# each other, run in parallel by analyze_exercise
+ANALYSIS_STAGES = SortedDict((
+    ('efforts', calculate_efforts),
+    ('histograms', calculate_histograms),
+    ('gradients', calculate_gradients),
+    ('slopes', calculate_slopes),
+    ('intervals', populate_interval_info),
+    ('maxpositions', find_max_positions),
+    ('segments', find_segments),
+    ('geojson', store_track_geojson),
+))
+
+def analyze_exercise(exercise, stages=None):
+    ''' Run the analysis stages of a parsed exercise as a group of tasks,
+    and invalidate the cached views of it when they are all done '''
+    if stages is None:
+        stages = ANALYSIS_STAGES.keys()
+    return chord(analysis_stage.subtask((exercise.id, stage)) for stage in stages)(finish_analysis.subtask((exercise.id,)))
+
+def run_analysis(exercise, stages=None):
+    ''' Run the analysis stages of a parsed exercise one after the other in
+    this task, for callers bounding how many exercises are analyzed at once '''
+    if stages is None:
+        stages = ANALYSIS_STAGES.keys()
+    timer = StageTimer('Analysis timings for exercise %s' %exercise.id)
+    for stage in stages:
+        with timer(stage):
+            ANALYSIS_STAGES[stage](exercise)
+    timer.report()
+    finish_analysis(stages, exercise.id)
+
+@task(max_retries=3, default_retry_delay=60)
+def analysis_stage(exercise_id, stage):
+    ''' Run one of the ANALYSIS_STAGES, retrying only that stage if it fails '''
+    Exercise = get_model('turan', 'Exercise')
+
+    exercise = Exercise.objects.get(pk=exercise_id)
+    timer = StageTimer('Analysis timings for exercise %s' %exercise_id)
     try:
-        if exercise.route and exercise.route.max_altitude:
-            max = exercise.exercisedetail_set.annotate(max=Max('altitude')).values('lon','lat','max').order_by('-max')[0]
-            exercise.max_altitude_lat = max['lat']
-            exercise.max_altitude_lon = max['lon']
-    except IndexError:
-        pass
-    exercise.save()
+        with timer(stage):
+            ANALYSIS_STAGES[stage](exercise)
+    except Exception, e:
+        print "Analysis stage %s of exercise %s failed: %s" %(stage, exercise_id, e)
+        raise analysis_stage.retry(exc=e)
+    timer.report()
+    # Views cached while the stage ran lack its results
+    bump_exercise(exercise_id)
+    return stage
+
+@task
+def finish_analysis(stages, exercise_id):
+    ''' Callback of analyze_exercise '''
+    Exercise = get_model('turan', 'Exercise')
+
+    bump_exercise(exercise_id)
+    exercise = Exercise.objects.get(pk=exercise_id)
+    # The zones and best efforts are written without signals
+    if exercise.date:
+        schedule_day_update(exercise.user_id, exercise.date)
 
 @task
 def create_tcx_from_details(event):
@@ -1540,6 +2301,13 @@ def power_30s_average(details):
     normalized = int(round(pow((fourth/power_avg_count), (0.25))))
     return normalized
 
+# Upper HR percentage of each zone of hr2zone
+HR_ZONE_LIMITS = (60, 72, 82, 87, 92, 97)
+
+def hr2zones(hr_percents):
+    ''' hr2zone of an array of HR percentages '''
+    return numpy.searchsorted(HR_ZONE_LIMITS, numpy.nan_to_num(hr_percents)).astype(numpy.int8)
+
 def hr2zone(hr_percent):
     ''' Given a HR percentage return sport zone based on Olympiatoppen zones'''
 
@@ -1560,13 +2328,14 @@ def hr2zone(hr_percent):
 
     return zone
 
-def detailslice_info(details):
+def detailslice_info(details, exercise=None):
     ''' Given details, return as much info as possible for them '''
 
     detailcount = len(details)
     if not detailcount:
         return {}
-    exercise = details[0].exercise
+    if exercise is None:
+        exercise = details[0].exercise
     ascent, descent = calculate_ascent_descent_gaussian(details)
     val_types = ('speed', 'hr', 'cadence', 'power', 'temp')
     ret = {
@@ -1665,31 +2434,24 @@ def smoothList(list, strippedXs=False, degree=30):
        Changed into padding in front of the list so that the running average happens
     "after the fact" instead of a smooth build up to the point '''
 
-    if list == []:
+    if len(list) == 0:
         return []
 
     # Change None into 0
-    list = [x if x else 0 for x in list]
+    values = numpy.array([x if x else 0 for x in list], dtype=numpy.float64)
     # Pad list in front 
-    list = [list[0]]*((degree)) + list #+ [list[-1]]*(degree/2)
-    if strippedXs == True:
-        return Xs[0:-(len(list)-(len(list)-degree+1))]
-    smoothed = [0]*(len(list)-degree+1)
-    for i in range(len(smoothed)):
-        smoothed[i] = sum(list[i:i+degree])/float(degree)
-    return smoothed
+    values = numpy.concatenate((values[:1].repeat(degree), values))
+    return numpy.convolve(values, smoothing_weights('flat', degree), 'valid').tolist()
 
 def normalized_attr(exercise, attr, degree=30):
-    exercise_details = exercise.get_details().all()
-    count = exercise_details.count()
-    if count < 23:
+    series = exercise.get_series()
+    if len(series) < 23:
         return 0
-    exercise_details = exercise_details[21:23]
-    delta_t = (exercise_details[1].time - exercise_details[0].time).seconds
+    seconds = series.seconds()
+    delta_t = seconds[22] - seconds[21]
     if delta_t > 1: # Check smart sample
         return 0
-    attrlist = exercise.exercisedetail_set.values_list(attr, flat=1)
-    attrlist = smoothList(attrlist, degree=degree)
+    attrlist = smoothList(numpy.nan_to_num(series[attr]), degree=degree)
     fourth = sum([pow(x, 4) for x in attrlist])
     if fourth:
         normalized = int(round(pow(fourth/len(attrlist), (0.25))))
@@ -1698,8 +2460,8 @@ def normalized_attr(exercise, attr, degree=30):
 def calculate_exercise_xPower(exercise):
     ''' Adapted from  from GoldenCheetah src/BikeScore.cpp '''
 
-    attrlist = exercise.exercisedetail_set.values('time', 'power')
-    if not attrlist:
+    series = exercise.get_series()
+    if not len(series):
         return
 
     EPSILON = 0.1
@@ -1716,10 +2478,7 @@ def calculate_exercise_xPower(exercise):
     total = 0.0
     count = 0
 
-    initial = attrlist[0]['time']
-
-    for point in attrlist:
-        secs = (point['time'] - initial).seconds
+    for secs, power in zip(series.seconds().tolist(), series.power.tolist()):
         while (weighted > NEGLIGIBLE) \
                and (secs > lastSecs + secsDelta + EPSILON):
             weighted *= attenuation
@@ -1727,10 +2486,8 @@ def calculate_exercise_xPower(exercise):
             total += pow(weighted, 4.0)
             count += 1
         weighted *= attenuation
-        try:
-            weighted += sampleWeight * point['power']
-        except TypeError:
-            pass # This happens when point['power'] is none
+        if power == power: # NaN when there is no power in the sample
+            weighted += sampleWeight * power
         lastSecs = secs
         total += pow(weighted, 4.0)
         count += 1
@@ -1739,6 +2496,13 @@ def calculate_exercise_xPower(exercise):
     #secs = count * secsDelta
     return xpower
 
+# Upper percentage of FTP of each zone of watt2zone but the last
+WATT_ZONE_LIMITS = (54, 75, 90, 105, 121, 150)
+
+def watt2zones(watt_percents):
+    ''' watt2zone of an array of percentages of FTP '''
+    return numpy.searchsorted(WATT_ZONE_LIMITS, numpy.nan_to_num(watt_percents)) + 1
+
 def watt2zone(watt_percentage):
     ''' Given watt_percentage in relation to FTP, return coggan zone
 
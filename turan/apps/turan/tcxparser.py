@@ -1,11 +1,19 @@
 #!/usr/bin/python
-from xml.etree import ElementTree
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 import re
 import datetime
 import pyproj
 from math import hypot
 
 garmin_ns = '{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}'
+lap_tag = garmin_ns + "Lap"
+trackpoint_tag = garmin_ns + "Trackpoint"
+
+def parse_time(tstring):
+    return datetime.datetime(*map(int, tstring.replace("T","-").replace(":","-").replace(".","-").strip("Z").split("-")))
 
 class TCXEntry(object):
     def __init__(self, time, hr, speed, cadence, altitude, lon, lat, power, distance):
@@ -45,58 +53,54 @@ class TCXParser(object):
         self.geod = pyproj.Geod(ellps='WGS84')
 
     def parse_uploaded_file(self, f):
-        self.cur_distance = 0
-
-        t = ElementTree.parse(f)
+        ''' Parse the file incrementally, trackpoints and laps are processed
+        and dropped from the tree as soon as they are read, so memory use
+        does not grow with the size of the file '''
 
+        self.cur_distance = 0
+        self.cur_time = None
         self.laps = []
-        # warning. ugly xml crap ahead
-        lapskaus = t.getiterator(garmin_ns + "Lap")
-        for lap in lapskaus:
-            try:
-                startstring = dict(lap.items())["StartTime"]
-            except:
-                startstring = t.find(garmin_ns + "Courses").find(garmin_ns + "Course").find(garmin_ns + "Track").find(garmin_ns + "Trackpoint").find(garmin_ns + "Time").text
-            time = datetime.datetime(*map(int, startstring.replace("T","-").replace(":","-").replace(".","-").strip("Z").split("-")))
-
-            try:
-                kcal_sum = int(lap.find(garmin_ns + "Calories").text)
-            except AttributeError:
-                kcal_sum = 0
-            except ValueError:
-                kcal_sum = int(float(lap.find(garmin_ns + "Calories").text))
-
-            try:
-                avg_cadence = int(lap.find(garmin_ns + "Cadence").text)
-            except AttributeError:
-                avg_cadence = 0
-
-            try:
-                max_hr = int(float(lap.find(garmin_ns + "MaximumHeartRateBpm").find(garmin_ns + "Value").text))
-            except AttributeError:
-                max_hr = 0    # Ring 113
 
-            try:
-                avg_hr = int(float(lap.find(garmin_ns + "AverageHeartRateBpm").find(garmin_ns + "Value").text))
-            except AttributeError:
-                avg_hr = 0    # Ring 113
-
-            try:
-                distance_sum = float(lap.find(garmin_ns + "DistanceMeters").text)
-            except AttributeError:
-                distance_sum = 0.0
-
-            try:
-                duration = float(lap.find(garmin_ns + "TotalTimeSeconds").text)
-            except AttributeError:
-                duration = 1.0 # we're going to divide by this, can't set to 0
+        self.heartbeats = 0
+        self.rotations = 0
+        self.pedaling_cad = 0
+        self.pedaling_cad_seconds = 0
+        self.pedaling_power_seconds = 0
+        self.hr_seconds = 0
+        self.powersum = 0
+        self.need_initial_altitude = 0
+        self.last_lat = 0
+        self.last_lon = 0
+        self.last_alt = 0
+        first_time = None
+
+        parents = []
+        for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == lap_tag and not self.laps and self.cur_time is None:
+                    startstring = elem.get("StartTime")
+                    if startstring:
+                        self.cur_time = parse_time(startstring)
+                parents.append(elem)
+                continue
 
-            try:
-                max_speed = float(lap.find(garmin_ns + "MaximumSpeed").text)*3.6
-            except AttributeError:
-                max_speed = None
+            parents.pop()
+            if elem.tag == trackpoint_tag:
+                time = self.parse_trackpoint(elem)
+                if first_time is None:
+                    first_time = time
+            elif elem.tag == lap_tag:
+                self.laps.append(self.parse_lap(elem))
+            else:
+                continue
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
 
-            self.laps.append(LapData(time, duration, distance_sum, max_speed, avg_hr, max_hr, avg_cadence, kcal_sum))
+        # Courses have no start time in the laps, they use the first trackpoint
+        for lap in self.laps:
+            if lap.start_time is None:
+                lap.start_time = first_time
 
         self.time = self.laps[0].start_time
 
@@ -109,7 +113,6 @@ class TCXParser(object):
         else:
             self.start_time = datetime.time(self.time.hour, self.time.minute, self.time.second)
         self.date = datetime.date(self.time.year, self.time.month, self.time.day)
-        self.cur_time = self.time
 
         if self.gps_distance:
             self.distance_sum = 0.0
@@ -130,147 +133,6 @@ class TCXParser(object):
 
         self.kcal_sum = sum([self.laps[i].kcal_sum for i in xrange(0,len(self.laps))])
 
-        self.heartbeats = 0
-        self.rotations = 0
-        self.pedaling_cad = 0
-        pedaling_cad_seconds = 0
-        pedaling_power_seconds = 0
-        hr_seconds = 0
-        self.powersum = 0
-        need_initial_altitude = 0
-        last_lat = 0
-        last_lon = 0
-        last_alt = 0
-        for e in t.getiterator(tag=garmin_ns + "Trackpoint"):
-            try:
-                tstring = e.find(garmin_ns + "Time").text
-            except AttributeError:
-                continue
-
-            try:
-                hr = int(float(e.find(garmin_ns + "HeartRateBpm").find(garmin_ns + "Value").text))
-            except AttributeError:
-                hr = 0
-                if self.entries:
-                    hr = self.entries[-1].hr
-
-            try:
-                altitude = float(e.find(garmin_ns + "AltitudeMeters").text)
-                if need_initial_altitude:
-                    # We never found altitude until now. Set the same altitude on all prevfious entries
-                    for e in self.entries:
-                        e.altitude = altitude
-                    need_initial_altitude = False
-            except AttributeError:
-                # Some garmin devices just don't report altitude in all points, 
-                # so we just use the previous value
-                if self.entries:
-                    altitude = self.entries[-1].altitude
-                else: # Missing altitude in the first value
-                    altitude = 0
-                    need_initial_altitude = True
-
-
-            try:
-                distance = float(e.find(garmin_ns + "DistanceMeters").text)
-            except AttributeError:
-                ## TODO figure out why elements lack distance, make this smarter ?
-                #distance = self.cur_distance
-                # 310 XT maybe fix??
-                pass
-                distance = 0
-
-            try:
-                cadence = int(e.find(garmin_ns + "Cadence").text)
-            except AttributeError:
-                cadence = 0
-
-            try:
-                lon = float(e.find(garmin_ns + "Position").find(garmin_ns + "LongitudeDegrees").text)
-            except AttributeError:
-                lon = 0.0
-
-            try:
-                lat = float(e.find(garmin_ns + "Position").find(garmin_ns + "LatitudeDegrees").text)
-            except AttributeError:
-                lat = 0.0
-
-            try:
-                power = int(e.find(garmin_ns + "Extensions").find("{http://www.garmin.com/xmlschemas/ActivityExtension/v2}TPX").find("{http://www.garmin.com/xmlschemas/ActivityExtension/v2}Watts").text)
-            except AttributeError:
-                power = 0
-
-            try:
-                cadence = int(e.find(garmin_ns + "Extensions").find("{http://www.garmin.com/xmlschemas/ActivityExtension/v2}TPX").find("{http://www.garmin.com/xmlschemas/ActivityExtension/v2}RunCadence").text)
-            except AttributeError:
-                pass # cadence is set to 0 further up
-
-            # Quickfix to skip empty trackpoints found at least in Garmin Edge 500 tcx-files
-            #if lat == 0.0 and lon == 0.0 and distance == 0 and hr == 0:
-            #    print "watness"
-            #    continue
-            # Check for silly 310XT only pos values
-            # as in trackpoints with only lon, lat and altitude, but no other values
-            if lat and lon and altitude and not (distance or hr or power or cadence):
-                last_lon = lon
-                last_lat = lat
-                last_alt = altitude
-                continue
-
-
-            time = datetime.datetime(*map(int, tstring.replace("T","-").replace(":","-").replace(".","-").strip("Z").split("-")))
-
-            timedelta = (time - self.cur_time).seconds
-            distdelta = 0
-            if self.gps_distance or (not distance and lon and lat):
-                 # Didn't find DistanceMeterElement..but we have lon/lat, so calculate
-                #assert False, (timedelta, distance, lon, lat, altitude, power, hr, cadence)
-                if last_lon and last_lat and last_alt and lon and lat and altitude:
-                    try:
-                        hdelta = self.geod.inv(lon, lat, last_lon, last_lat)[2]
-                        distdelta = hypot(hdelta, last_alt-altitude)
-                    except ValueError:
-                        distdelta = 0
-                last_lon = lon
-                last_lat = lat
-                last_alt = altitude
-
-            if not distdelta:
-                if distance:
-                    distdelta = distance - self.cur_distance
-                    self.cur_distance = distance
-            if distdelta and not distance: # For gps_distance = True
-                distance = self.cur_distance + distdelta
-                self.cur_distance = distance
-
-            if not distdelta and not distance:
-                distance = self.cur_distance
-
-            if timedelta and distdelta:
-                speed = distdelta/timedelta * 3.6
-                if speed >= 200: #FIXME oh so naive
-                    if len(self.entries) > 1 and self.entries[-1].speed:
-                        speed = self.entries[-1].speed
-                    else:
-                        speed = 0
-            else:
-                speed = 0.0
-
-            if timedelta <= 60:
-                self.heartbeats += hr*timedelta
-                self.rotations += cadence*timedelta
-                hr_seconds += timedelta
-                if power:
-                    self.powersum += power*timedelta
-                    pedaling_power_seconds += timedelta
-                if cadence > 0:
-                    self.pedaling_cad += cadence*timedelta
-                    pedaling_cad_seconds += timedelta
-
-            t = TCXEntry(time, hr, speed, cadence, altitude, lon, lat, power, distance)
-            self.entries.append(t)
-            self.cur_time = time
-
         if self.gps_distance:
             self.max_speed = max([self.entries[i].speed for i in xrange(0,len(self.entries))])
             self.distance_sum = self.entries[-1].distance
@@ -294,14 +156,197 @@ class TCXParser(object):
             pass
         if self.rotations > 1.0:
             self.avg_cadence = self.rotations/seconds
-            self.avg_pedaling_cad = self.pedaling_cad/pedaling_cad_seconds
+            self.avg_pedaling_cad = self.pedaling_cad/self.pedaling_cad_seconds
         if self.heartbeats > 1.0:
-            self.avg_hr = self.heartbeats/hr_seconds
+            self.avg_hr = self.heartbeats/self.hr_seconds
         self.duration = '%is' % int(seconds)
         if self.powersum:
             self.avg_power = self.powersum/seconds
             self.max_power = max([self.entries[i].power for i in xrange(0,len(self.entries))])
-            self.avg_pedaling_power = self.powersum/pedaling_power_seconds
+            self.avg_pedaling_power = self.powersum/self.pedaling_power_seconds
+
+    def parse_lap(self, lap):
+        ''' Return LapData for a Lap element, start_time is None if the lap
+        has none '''
+
+        # warning. ugly xml crap ahead
+        startstring = lap.get("StartTime")
+        time = None
+        if startstring:
+            time = parse_time(startstring)
+
+        try:
+            kcal_sum = int(lap.find(garmin_ns + "Calories").text)
+        except AttributeError:
+            kcal_sum = 0
+        except ValueError:
+            kcal_sum = int(float(lap.find(garmin_ns + "Calories").text))
+
+        try:
+            avg_cadence = int(lap.find(garmin_ns + "Cadence").text)
+        except AttributeError:
+            avg_cadence = 0
+
+        try:
+            max_hr = int(float(lap.find(garmin_ns + "MaximumHeartRateBpm").find(garmin_ns + "Value").text))
+        except AttributeError:
+            max_hr = 0    # Ring 113
+
+        try:
+            avg_hr = int(float(lap.find(garmin_ns + "AverageHeartRateBpm").find(garmin_ns + "Value").text))
+        except AttributeError:
+            avg_hr = 0    # Ring 113
+
+        try:
+            distance_sum = float(lap.find(garmin_ns + "DistanceMeters").text)
+        except AttributeError:
+            distance_sum = 0.0
+
+        try:
+            duration = float(lap.find(garmin_ns + "TotalTimeSeconds").text)
+        except AttributeError:
+            duration = 1.0 # we're going to divide by this, can't set to 0
+
+        try:
+            max_speed = float(lap.find(garmin_ns + "MaximumSpeed").text)*3.6
+        except AttributeError:
+            max_speed = None
+
+        return LapData(time, duration, distance_sum, max_speed, avg_hr, max_hr, avg_cadence, kcal_sum)
+
+    def parse_trackpoint(self, e):
+        ''' Add a TCXEntry for a Trackpoint element to entries and update the
+        sums. Returns the time of the trackpoint, None if it has none. '''
+
+        try:
+            tstring = e.find(garmin_ns + "Time").text
+        except AttributeError:
+            return None
+        time = parse_time(tstring)
+
+        try:
+            hr = int(float(e.find(garmin_ns + "HeartRateBpm").find(garmin_ns + "Value").text))
+        except AttributeError:
+            hr = 0
+            if self.entries:
+                hr = self.entries[-1].hr
+
+        try:
+            altitude = float(e.find(garmin_ns + "AltitudeMeters").text)
+            if self.need_initial_altitude:
+                # We never found altitude until now. Set the same altitude on all prevfious entries
+                for entry in self.entries:
+                    entry.altitude = altitude
+                self.need_initial_altitude = False
+        except AttributeError:
+            # Some garmin devices just don't report altitude in all points, 
+            # so we just use the previous value
+            if self.entries:
+                altitude = self.entries[-1].altitude
+            else: # Missing altitude in the first value
+                altitude = 0
+                self.need_initial_altitude = True
+
+
+        try:
+            distance = float(e.find(garmin_ns + "DistanceMeters").text)
+        except AttributeError:
+            ## TODO figure out why elements lack distance, make this smarter ?
+            #distance = self.cur_distance
+            # 310 XT maybe fix??
+            pass
+            distance = 0
+
+        try:
+            cadence = int(e.find(garmin_ns + "Cadence").text)
+        except AttributeError:
+            cadence = 0
+
+        try:
+            lon = float(e.find(garmin_ns + "Position").find(garmin_ns + "LongitudeDegrees").text)
+        except AttributeError:
+            lon = 0.0
+
+        try:
+            lat = float(e.find(garmin_ns + "Position").find(garmin_ns + "LatitudeDegrees").text)
+        except AttributeError:
+            lat = 0.0
+
+        try:
+            power = int(e.find(garmin_ns + "Extensions").find("{http://www.garmin.com/xmlschemas/ActivityExtension/v2}TPX").find("{http://www.garmin.com/xmlschemas/ActivityExtension/v2}Watts").text)
+        except AttributeError:
+            power = 0
+
+        try:
+            cadence = int(e.find(garmin_ns + "Extensions").find("{http://www.garmin.com/xmlschemas/ActivityExtension/v2}TPX").find("{http://www.garmin.com/xmlschemas/ActivityExtension/v2}RunCadence").text)
+        except AttributeError:
+            pass # cadence is set to 0 further up
+
+        if self.cur_time is None:
+            self.cur_time = time
+
+        # Quickfix to skip empty trackpoints found at least in Garmin Edge 500 tcx-files
+        #if lat == 0.0 and lon == 0.0 and distance == 0 and hr == 0:
+        #    print "watness"
+        #    continue
+        # Check for silly 310XT only pos values
+        # as in trackpoints with only lon, lat and altitude, but no other values
+        if lat and lon and altitude and not (distance or hr or power or cadence):
+            self.last_lon = lon
+            self.last_lat = lat
+            self.last_alt = altitude
+            return time
+
+        timedelta = (time - self.cur_time).seconds
+        distdelta = 0
+        if self.gps_distance or (not distance and lon and lat):
+             # Didn't find DistanceMeterElement..but we have lon/lat, so calculate
+            #assert False, (timedelta, distance, lon, lat, altitude, power, hr, cadence)
+            if self.last_lon and self.last_lat and self.last_alt and lon and lat and altitude:
+                try:
+                    hdelta = self.geod.inv(lon, lat, self.last_lon, self.last_lat)[2]
+                    distdelta = hypot(hdelta, self.last_alt-altitude)
+                except ValueError:
+                    distdelta = 0
+            self.last_lon = lon
+            self.last_lat = lat
+            self.last_alt = altitude
+
+        if not distdelta:
+            if distance:
+                distdelta = distance - self.cur_distance
+                self.cur_distance = distance
+        if distdelta and not distance: # For gps_distance = True
+            distance = self.cur_distance + distdelta
+            self.cur_distance = distance
+
+        if not distdelta and not distance:
+            distance = self.cur_distance
+
+        if timedelta and distdelta:
+            speed = distdelta/timedelta * 3.6
+            if speed >= 200: #FIXME oh so naive
+                if len(self.entries) > 1 and self.entries[-1].speed:
+                    speed = self.entries[-1].speed
+                else:
+                    speed = 0
+        else:
+            speed = 0.0
+
+        if timedelta <= 60:
+            self.heartbeats += hr*timedelta
+            self.rotations += cadence*timedelta
+            self.hr_seconds += timedelta
+            if power:
+                self.powersum += power*timedelta
+                self.pedaling_power_seconds += timedelta
+            if cadence > 0:
+                self.pedaling_cad += cadence*timedelta
+                self.pedaling_cad_seconds += timedelta
+
+        self.entries.append(TCXEntry(time, hr, speed, cadence, altitude, lon, lat, power, distance))
+        self.cur_time = time
+        return time
 
 
 if __name__ == '__main__':
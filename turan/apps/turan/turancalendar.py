@@ -17,10 +17,12 @@ class WorkoutCalendar(HTMLCalendar):
                 'duration_sum': timedelta(0),
                 }
 
-    def __init__(self, workouts, locale):
+    def __init__(self, workouts, locale, loads=()):
         #super(WorkoutCalendar, self).__init__(locale=locale)
         super(WorkoutCalendar, self).__init__()
         self.current_week = 0
+        # DailyLoad by user and day
+        self.loads = dict(((load.user_id, load.date), load) for load in loads)
         self.workouts = self.group_by_day(workouts)
         self.workouts_by_week = self.group_by_week(workouts)
         self.week_sums = self.get_week_sums()
@@ -61,10 +63,6 @@ class WorkoutCalendar(HTMLCalendar):
                     body.append(esc(workout.get_name()))
                     body.append('</a>')
                     body.append('<p class="faded">')
-                    bikescore = workout.get_bikescore()
-                    if bikescore:
-                        body.append(esc(bikescore) + '&nbsp;BikeScore')
-                        body.append(', ')
                     if workout.route and workout.route.distance:
                         body.append('%.1f&nbsp;km' %workout.route.distance)
                         body.append(', ')
@@ -74,6 +72,7 @@ class WorkoutCalendar(HTMLCalendar):
                     body.append('</p>')
                     body.append('</li>')
                 body.append('</ul>')
+                body.extend(self.format_loads(workouts_by_weekday[weekday]))
 
                 dayhtml = '<div class="day">%d</div>' %day
                 if day == 0:
@@ -81,6 +80,26 @@ class WorkoutCalendar(HTMLCalendar):
                 return unicode(self.day_cell(cssclass, '%s %s' % (dayhtml, ''.join(body))))
         return self.day_cell('noday', '&nbsp;')
 
+    def format_loads(self, workouts):
+        ''' BikeScore and training stress balance of the day of the workouts
+        for each of their users '''
+        body = []
+        users = []
+        for workout in workouts:
+            if not workout.user_id in users:
+                users.append(workout.user_id)
+        for user_id in users:
+            load = self.loads.get((user_id, workouts[0].date))
+            if load is None or not load.bikescore:
+                continue
+            body.append('<p class="faded">')
+            if len(users) > 1:
+                body.append(esc(load.user) + ': ')
+            body.append(esc(load.bikescore) + '&nbsp;BikeScore')
+            body.append(', TSB&nbsp;%.0f' %load.tsb)
+            body.append('</p>')
+        return body
+
     def get_week_sums(self):
         week_sums = {}
         for week, workouts in self.workouts_by_week.items():
@@ -38,6 +38,7 @@ urlpatterns = patterns('',
     url(r'^week/(?P<week>\d+)', week, name='week-all'),
     url(r'^week/(?P<week>\d+)/(?P<user_id>)', week, name='week'),
     url(r'^import/bulk/?$$', 'turan.views.import_bulk', name='import_bulk'),
+    url(r'^import/bulk/(?P<object_id>\d+)/?$', bulk_import_progress, name='bulk_import_progress'),
     url(r'^import/$', 'turan.views.import_data', name='import_data'),
 
     url(r'^calendar/(?P<year>\d+)/(?P<month>\d+)', calendar_month, name='calendar'),
@@ -50,10 +51,12 @@ urlpatterns = patterns('',
     url(r'^json/comment/random/?$', json_serializer, { 'queryset': Comment.objects.order_by('?')[:10], 'relations': ('content_type',) }, name='json_comments'),
     url(r'^json/exercise/(?P<object_id>\d+)/?', json_trip_details),
     url(r'^json/graph/(?P<object_id>\d+)', json_trip_series, name='json_trip_series'),
+    url(r'^binary/graph/(?P<object_id>\d+)', binary_trip_series, name='binary_trip_series'),
     url(r'^json/geo/(?P<object_id>\d+)', exercise_geojson, name='exercise_geojson'),
     url(r'^json/segment/geo/(?P<object_id>\d+)', segment_geojson, name='segment_geojson'),
     url(r'^json/power/(?P<object_id>\d+)', powerjson, name='powerjson'),
     url(r'^json/gradient/(?P<object_id>\d+)', json_altitude_gradient, name='json_altitude_gradient'),
+    url(r'^json/load/(?P<username>[\w\._-]+)', json_training_load, name='json_training_load'),
     url(r'^json/wiki/(?P<slug>\w+)/?$', wikijson, name='wikijson'),
     url(r'^json/wiki/(?P<slug>\w+)/(?P<rev_id>\d+)/?', wikijson, name='wikijson'),
 
@@ -1,13 +1,18 @@
 from models import *
-from geojson import GeoJSONFeature, GeoJSONFeatureCollection
+from geojson import GeoJSONFeature, GeoJSONFeatureCollection, zone_collection
 from tasks import smoothListGaussian, power_30s_average \
         , hr2zone, detailslice_info, search_trip_for_possible_segments_matches, filldistance, \
-        create_gpx_from_details, smoothList
+        create_gpx_from_details, smoothList, invalidate_series, EFFORT_DURATIONS, \
+        run_bulk_import, start_segment_backfill, ALLTIME_START, training_load, \
+        store_track_geojson, get_track_zones, geojson_path, geojson_zoom, gpxstore, mean_max_durations
 from itertools import groupby, islice
 from forms import ExerciseForm, ImportForm, BulkImportForm
+from spatial import bbox_cells
+from cachekeys import exercise_key, segment_key, artifact_ttl
+from series import SERIES_FIELDS, SERIES_INT_FIELDS, unpack_arrays
 from turan.apps.profiles.models import Profile, UserProfileDetail
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponseRedirect, HttpResponse, HttpResponsePermanentRedirect, HttpResponseForbidden, Http404, HttpResponseServerError
+from django.http import HttpResponseRedirect, HttpResponse, StreamingHttpResponse, HttpResponsePermanentRedirect, HttpResponseForbidden, Http404, HttpResponseServerError
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
 from django.template import RequestContext, Context, loader
@@ -25,6 +30,7 @@ from threadedcomments.models import ThreadedComment
 from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.files.base import ContentFile
+from django.core.servers.basehttp import FileWrapper
 from django.utils.safestring import mark_safe
 from django.core import serializers
 from django.core.exceptions import ObjectDoesNotExist
@@ -52,6 +58,9 @@ import zipfile
 import re
 import locale
 import json
+import struct
+import heapq
+import numpy
 
 from BeautifulSoup import BeautifulSoup
 
@@ -208,11 +217,14 @@ def events(request, template='turan/event_list.html', group_slug=None, bridge=No
             object_list = object_list.filter(user=user)
 
     if latitude and longitude:
-        # A litle aprox box around your area
-        object_list = object_list.filter(route__start_lat__gt=float(latitude) - 0.5)
-        object_list = object_list.filter(route__start_lat__lt=float(latitude) + 0.5)
-        object_list = object_list.filter(route__start_lon__gt=float(longitude) - 1.0)
-        object_list = object_list.filter(route__start_lon__lt=float(longitude) + 1.0)
+        # A litle aprox box around your area, matching exercises passing
+        # through it by the grid cells of their tracks, or starting in it
+        # for those without an indexed track
+        latitude, longitude = float(latitude), float(longitude)
+        cells = bbox_cells((latitude - 0.5, longitude - 1.0, latitude + 0.5, longitude + 1.0))
+        starts = Q(route__start_lat__gt=latitude - 0.5, route__start_lat__lt=latitude + 0.5,
+                route__start_lon__gt=longitude - 1.0, route__start_lon__lt=longitude + 1.0)
+        object_list = object_list.filter(Q(cells__cell__in=cells) | starts).distinct()
 
     search_query = request.GET.get('q', '')
     if search_query:
@@ -333,7 +345,7 @@ def week(request, week, user_id='all'):
 
     return render_to_response('turan/event_list.html', locals(), context_instance=RequestContext(request))
 
-@cache_page_against_models(Exercise, Profile, User, UserProfileDetail)
+@cache_page_against_models(PeriodStatistics, Profile, User, UserProfileDetail)
 @vary_on_cookie
 def statistics(request, year=None, month=None, day=None, week=None, alltime=False):
 
@@ -379,146 +391,84 @@ def statistics(request, year=None, month=None, day=None, week=None, alltime=Fals
         previous_month = first_day.replace(month=first_day.month-1)
 
 
+    # The PeriodStatistics to show
     if year:
-        datefilter = {"user__exercise__date__year": year}
-        if month:
-            datefilter["user__exercise__date__month"] = month
-            if day:
-                datefilter["user__exercise__date__day"] = day
         if week:
             tt = strptime(year+'-1-' + str(int(week)-1), '%Y-%w-%W')
-            date = datetimedate(*tt[:3])
-            first_day = date
-            last_day = date + timedelta(days=7)
-            datefilter= {"user__exercise__date__gte":  first_day, 'user__exercise__date__lt': last_day}
+            period, start = 'W', datetimedate(*tt[:3])
+        elif month and day:
+            period, start = 'D', datetimedate(int(year), int(month), int(day))
+        elif month:
+            period, start = 'M', first_day
+        else:
+            period, start = 'Y', datetimedate(int(year), 1, 1)
     else:
         if alltime:
-            start = datetime(1970,1,1)
+            period, start = 'A', ALLTIME_START
         else:
-            start = date
+            period, start = 'M', first_day
             year = date.year
             month = date.month
-        datefilter = { "user__exercise__date__gte": start }
+
+    statistics = PeriodStatistics.objects.filter(period=period, start=start)
+    if not statistics.exists():
+        raise Http404('No trips found')
 
     teamname = request.GET.get('team')
-    statsprofiles = Profile.objects.all()
     if teamname:
         team = get_object_or_404(Tribe, slug=teamname)
-        statsusers = team.members.all()
-        statsprofiles = statsprofiles.filter(user__in=statsusers)
+        statistics = statistics.filter(user__in=team.members.all())
 
     exercisename = request.GET.get('exercise')
 
     exercisetypes = ExerciseType.objects.all()
 
-    tfilter = {}
     if exercisename:
         exercise = get_object_or_404(ExerciseType, name=exercisename)
-        exercisefilter = { "user__exercise__exercise_type": exercise }
-        datefilter["user__exercise__exercise_type"] = exercise
-        tfilter.update(exercisefilter)
-    tfilter.update(datefilter)
-    #else:
-    #    exercise = get_object_or_404(ExerciseType, name='Cycling')
-
-    stats_dict = Exercise.objects.filter(**tfilter).aggregate(
-            Max('avg_speed'),
-            Avg('avg_speed'),
-            Avg('route__distance'),
-            Max('route__distance'),
-            Sum('route__distance'),
-            Avg('duration'),
-            Max('duration'),
-            Sum('duration'))
-    total_duration = stats_dict['duration__sum']
-    total_distance = stats_dict['route__distance__sum']
-    total_avg_speed = stats_dict['avg_speed__avg']
-    longest_trip = stats_dict['route__distance__max']
-    if not total_duration:
-        raise Http404('No trips found')
+        statistics = statistics.filter(exercise_type=exercise)
+    else:
+        statistics = statistics.filter(exercise_type__isnull=True)
+
+    userstats = statistics.select_related('user')
 
-    userstats = statsprofiles.filter(**tfilter).annotate(
-            avg_avg_speed = Avg('user__exercise__avg_speed'),
-            max_avg_speed = Max('user__exercise__avg_speed'),
-            max_speed = Max('user__exercise__max_speed'),
-            num_trips = Count('user__exercise'),
-            sum_distance = Sum('user__exercise__route__distance'),
-            sum_duration = Sum('user__exercise__duration'),
-            sum_energy = Sum('user__exercise__kcal'),
-            avg_normalized_power = Avg('user__exercise__normalized_power'),
-            max_normalized_power = Max('user__exercise__normalized_power'),
-            avg_avg_pedaling_power = Avg('user__exercise__avg_pedaling_power'),
-            max_avg_pedaling_power = Max('user__exercise__avg_pedaling_power'),
-            max_max_power = Max('user__exercise__max_power'),
-            sum_ascent = Sum('user__exercise__route__ascent'),
-            avg_avg_hr = Avg('user__exercise__avg_hr'),
-            )
-
-    maxavgspeeds = userstats.filter(max_avg_speed__gt=0.0).exclude(max_avg_speed__gt=200.0).order_by('max_avg_speed').reverse()
-    maxspeeds = userstats.filter(max_speed__gt=0.0).exclude(max_speed__gt=200.0).order_by('max_speed').reverse()
+    maxavgspeeds = userstats.filter(max_avg_speed__gt=0.0).exclude(max_avg_speed__gt=200.0).order_by('-max_avg_speed')
+    maxspeeds = userstats.filter(max_speed__gt=0.0).exclude(max_speed__gt=200.0).order_by('-max_speed')
     avgspeeds = userstats.filter(avg_avg_speed__gt=0.0).exclude(avg_avg_speed__gt=200.0).order_by('-avg_avg_speed')
-    numtrips = userstats.filter(num_trips__gt=0).order_by('num_trips').reverse()
-    distsums = userstats.filter(sum_distance__gt=0).order_by('sum_distance').reverse()
-    dursums = userstats.filter(sum_duration__gt=0).order_by('sum_duration').reverse()
-    energysums = userstats.filter(sum_energy__gt=0).order_by('sum_energy').reverse()
-    ascentsums = userstats.filter(sum_ascent__gt=0).order_by('sum_ascent').reverse()
-    avgavghrs = userstats.filter(avg_avg_hr__gt=0).filter(max_hr__gt=0)
+    numtrips = userstats.filter(num_trips__gt=0).order_by('-num_trips')
+    distsums = userstats.filter(sum_distance__gt=0).order_by('-sum_distance')
+    dursums = userstats.filter(sum_duration__gt=0).order_by('-sum_duration')
+    energysums = userstats.filter(sum_energy__gt=0).order_by('-sum_energy')
+    ascentsums = userstats.filter(sum_ascent__gt=0).order_by('-sum_ascent')
+    avgavghrs = userstats.filter(avg_avg_hr__gt=0).filter(user__max_hr__gt=0)
     avgnormalizedpower =  userstats.filter(avg_normalized_power__gt=0).order_by('-avg_normalized_power')
     maxnormalizedpower =  userstats.filter(max_normalized_power__gt=0).order_by('-max_normalized_power')
     avgpedalingpower =  userstats.filter(avg_avg_pedaling_power__gt=0).order_by('-avg_avg_pedaling_power')
     maxpedalingpower =  userstats.filter(max_avg_pedaling_power__gt=0).order_by('-max_avg_pedaling_power')
     maxpowers =  userstats.filter(max_max_power__gt=0).order_by('-max_max_power')
+    climbstats = userstats.filter(avgclimb__gt=0).order_by('-avgclimb')
+    climbstatsbytime = userstats.filter(avgclimbperhour__gt=0).order_by('-avgclimbperhour')
+    lengthstats = userstats.filter(avglen__gt=0).order_by('-avglen')
 
     for u in avgavghrs:
-        u_avg_avg_hr = u.avg_avg_hr
-        if u_avg_avg_hr:
-            u.avgavghrpercent = float(u_avg_avg_hr)/u.max_hr*100
-        else:
-            u.avgavghrpercent = 0
+        u.avgavghrpercent = u.avg_avg_hr/u.max_hr*100
     avgavghrs = sorted(avgavghrs, key=lambda x:-x.avgavghrpercent)
 
-    routefilter = {"ascent__gt" : 0, "distance__gt" : 0 }
-    validroutes = Route.objects.filter(**routefilter)
-
-    tfilter["user__exercise__route__in"] = validroutes
-    climbstats = statsprofiles.filter(**tfilter).annotate(
-            distance = Sum('user__exercise__route__distance'),
-            height_sum = Sum('user__exercise__route__ascent'),
-            duration = Sum('user__exercise__duration'),
-            trips = Count('user__exercise')
-            ).filter(duration__gt=0).filter(distance__gt=0).filter(height_sum__gt=0).filter(trips__gt=0)
-
-    for u in climbstats:
-        u.avgclimb = u.height_sum/u.distance
-        u.avgclimbperhour = u.height_sum/(float(u.duration)/10**6/3600)
-        u.avglen = float(u.distance)/u.trips
-    climbstats = sorted(climbstats, key=lambda x: -x.avgclimb)
-    climbstatsbytime = sorted(climbstats, key=lambda x:-x.avgclimbperhour)
-    lengthstats = sorted(climbstats, key=lambda x: -x.avglen)
-
     hrzonestats = []
     hrzones = range(0,7)
+    zones = PeriodZone.objects.filter(statistics__in=statistics).select_related('statistics__user')
     for i in hrzones:
-        hrzonestats.append(statsprofiles.filter(**tfilter)\
-        .extra(where=['turan_hrzonesummary.zone = %s' %i])\
-        .annotate(
-            duration = Sum('user__exercise__hrzonesummary__duration')
-            )\
-        .order_by('-duration'))
+        hrzonestats.append(zones.filter(zone=i, duration__gt=0).order_by('-duration')[:10])
     hrzonestats = zip(hrzones, hrzonestats)
 
-
     bestest_power = []
-    intervals = [5, 10, 30, 60, 240, 300, 600, 1200, 1800, 3600]
+    intervals = EFFORT_DURATIONS
+    best_powers = PeriodBestPower.objects.filter(statistics__in=statistics).select_related('statistics__user')
     for i in intervals:
         userweight_tmp = []
-        best_power_tmp = statsprofiles.filter(**tfilter)\
-        .extra(where=['turan_bestpowereffort.duration = %s' %i])\
-        .annotate( max_power = Max('user__exercise__bestpowereffort__power'))\
-        .order_by('-max_power')
+        best_power_tmp = best_powers.filter(duration=i).order_by('-power')
         for a in best_power_tmp:
-            if a.get_weight():
-                userweight_tmp.append(a.max_power/a.get_weight())
+            if a.statistics.user.get_weight():
+                userweight_tmp.append(a.power/a.statistics.user.get_weight())
             else:
                 userweight_tmp.append(0)
         best_power_tmp = zip(best_power_tmp, userweight_tmp)
@@ -552,20 +502,65 @@ def statistics(request, year=None, month=None, day=None, week=None, alltime=Fals
 
     return render_to_response('turan/statistics.html', locals(), context_instance=RequestContext(request))
 
+def mean_max_bests(seconds, count=10):
+    ''' The count best speed and power efforts of seconds in cycling
+    exercises, read from their mean maximal curves, as unsaved
+    BestSpeedEffort and BestPowerEffort. Reading every curve takes a while,
+    so the rankings are cached for BESTEST_CACHE_TTL seconds. '''
+
+    cache_key = 'mean_max_bests_%d_%d' %(seconds, count)
+    bests = cache.get(cache_key)
+    if bests is None:
+        speeds = []
+        powers = []
+        curves = MeanMaxCurve.objects.filter(exercise__exercise_type__name="Cycling").values_list('exercise', 'data')
+        for exercise_id, data in curves.iterator():
+            curve = unpack_arrays(data)
+            index = numpy.searchsorted(curve['durations'], seconds)
+            if index == len(curve['durations']) or curve['durations'][index] != seconds:
+                continue
+            speeds.append((float(curve['speed'][index]), exercise_id))
+            if 'power' in curve:
+                powers.append((int(curve['power'][index]), exercise_id))
+        bests = heapq.nlargest(count, speeds), heapq.nlargest(count, powers)
+        cache.set(cache_key, bests, getattr(settings, 'BESTEST_CACHE_TTL', 3600))
+    speeds, powers = bests
+    # Exercises deleted since the rankings were cached are left out
+    exercises = Exercise.objects.select_related('user', 'route').in_bulk([e for value, e in speeds + powers])
+    return ([BestSpeedEffort(exercise=exercises[e], duration=seconds, speed=speed) for speed, e in speeds if e in exercises],
+            [BestPowerEffort(exercise=exercises[e], duration=seconds, power=power) for power, e in powers if e in exercises])
+
 def bestest(request):
+    ''' The best cycling efforts, of the effort durations or of any
+    duration given as seconds, which is read from the mean maximal curves
+    and rounded down to a duration they have '''
+
+    intervals = [5, 30, 60, 240, 300, 600, 1200, 1800, 3600]
+    seconds = request.GET.get('seconds')
+    if seconds:
+        try:
+            durations = mean_max_durations(int(seconds))
+        except ValueError:
+            raise Http404
+        if not len(durations):
+            raise Http404
+        intervals = [int(durations[-1])]
 
     bestest_speed = []
     bestest_power = []
-    intervals = [5, 30, 60, 240, 300, 600, 1200, 1800, 3600]
     for i in intervals:
+        if i in EFFORT_DURATIONS:
+            best_speed_tmp = BestSpeedEffort.objects.filter(exercise__exercise_type__name="Cycling", duration=i).order_by('-speed')[:10]
+            best_power_tmp = BestPowerEffort.objects.filter(exercise__exercise_type__name="Cycling", duration=i).order_by('-power')[:10]
+        else:
+            best_speed_tmp, best_power_tmp = mean_max_bests(i)
+
         userweight_tmp = []
-        best_speed_tmp = BestSpeedEffort.objects.filter(exercise__exercise_type__name="Cycling", duration=i).order_by('-speed')[:10]
         for a in best_speed_tmp:
             userweight_tmp.append(a.exercise.user.get_profile().get_weight(a.exercise.date))
         bestest_speed.append(zip(best_speed_tmp, userweight_tmp))
 
         userweight_tmp = []
-        best_power_tmp = BestPowerEffort.objects.filter(exercise__exercise_type__name="Cycling", duration=i).order_by('-power')[:10]
         for a in best_power_tmp:
             userweight_tmp.append(a.exercise.user.get_profile().get_weight(a.exercise.date))
         bestest_power.append(zip(best_power_tmp, userweight_tmp))
@@ -775,7 +770,12 @@ def calendar_month(request, year, month):
     # FIXME django locale
     # stupid calendar needs int
     year, month = int(year), int(month)
-    cal = WorkoutCalendar(exercises, locale.getdefaultlocale()).formatmonth(year, month)
+    loads = DailyLoad.objects.select_related('user').filter(date__gte=week_start, date__lt=week_end)
+    if other_user:
+        loads = loads.filter(user=other_user)
+    else:
+        loads = loads.filter(user__in=exercises.values('user'))
+    cal = WorkoutCalendar(exercises, locale.getdefaultlocale(), loads).formatmonth(year, month)
 
     e_by_week = [(week, list(items)) for week, items in groupby(exercises, lambda workout: int(workout.date.strftime('%W')))]
 
@@ -860,74 +860,46 @@ def wikijson(request, slug, rev_id=None):
 #@profile("geojson")
 def exercise_geojson(request, object_id):
     ''' Return GeoJSON with coords as linestring for use in openlayers stylemap,
-    give each line a zone property so it can be styled differently'''
-
-    qs = ExerciseDetail.objects.filter(exercise=object_id).exclude(lon=0).exclude(lat=0).filter(lon__isnull=False,lat__isnull=False,hr__isnull=False).values('hr','lon','lat')
-
-    start, stop = request.GET.get('start', ''), request.GET.get('stop', '')
-    if start and stop:
-        start, stop = int(start), int(stop)
-        if start and stop:
-            qs = qs[start:stop+1]
-
-    if not len(qs) > 1:
-        return HttpResponse('{}')
-
-    cache_key = 'exercise_geojson_%s' %object_id
-    # Try and get the most common value from cache
-    if not start and not stop:
-        gjstr = cache.get(cache_key)
-        if gjstr:
-            response = HttpResponse(gjstr, mimetype='application/json')
-            response['Content-Encoding'] = 'gzip'
-            response['Content-Length'] = len(gjstr)
-            return response
-
-
-    max_hr = Exercise.objects.get(pk=object_id).user.get_profile().max_hr
-    if not max_hr: # sigh
-        max_hr = 200
-
-
-    features = []
-    previous_lon, previous_lat, previous_zone = 0, 0, -1
-    previous_feature = False
-    for d in qs:
-        if previous_lon and previous_lat:
-            hr_percent = 0
-            if d['hr']: # To prevent zerodivision
-                hr_percent = float(d['hr'])*100/max_hr
-            zone = hr2zone(hr_percent)
-            #if zone == 0: # Stylemap does not support zone 0. FIXME
-            #    zone = 1
-
-            if previous_zone == zone:
-                previous_feature.addLine(previous_lon, previous_lat, d['lon'], d['lat'])
-            else:
-                if previous_feature:
-                    features.append(previous_feature)
-                previous_feature = GeoJSONFeature(zone)
-
-            previous_zone = zone
-        previous_lon = d['lon']
-        previous_lat = d['lat']
-
-    # add last segment
-    if previous_zone == zone:
-        previous_feature.addLine(previous_lon, previous_lat, d['lon'], d['lat'])
-    if previous_feature:
-        features.append(previous_feature)
-
+    give each line a zone property so it can be styled differently.
 
-    gjstr = compress_string(str(GeoJSONFeatureCollection(features)))
+    The whole track is served from the files stored by store_track_geojson
+    for the zoom level in the zoom parameter, slices between the sample
+    indexes start and stop are cut from its stored zones. '''
 
-    # save to cache if no start and stop
-    if not start and not stop:
-        cache.set(cache_key, gjstr, 86400)
+    exercise = get_object_or_404(Exercise, pk=object_id)
+    try:
+        start = int(request.GET.get('start') or 0)
+        stop = int(request.GET.get('stop') or 0)
+    except ValueError:
+        raise Http404
+    # The map asks for 0 to 0 when the selection is cleared
+    if start or stop:
+        track = get_track_zones(exercise)
+        first = numpy.searchsorted(track['sample'], start, 'left')
+        last = len(track['sample'])
+        if stop:
+            last = numpy.searchsorted(track['sample'], stop, 'right')
+        gjstr = compress_string(str(zone_collection(track['lon'][first:last], track['lat'][first:last], track['zone'][first:last])))
+        response = HttpResponse(gjstr, mimetype='application/json')
+        response['Content-Encoding'] = 'gzip'
+        response['Content-Length'] = len(gjstr)
+        return response
 
-    response = HttpResponse(gjstr, mimetype='application/json')
+    zoom = request.GET.get('zoom', '')
+    zoom = geojson_zoom(int(zoom) if zoom.isdigit() else None)
+    try:
+        geojson = gpxstore.open(geojson_path(object_id, zoom))
+    except (IOError, OSError):
+        # Parsed before the files were stored, the analysis is not done or
+        # the max HR of the user has changed
+        gjstr = store_track_geojson(exercise)[zoom]
+        response = HttpResponse(gjstr, mimetype='application/json')
+        response['Content-Length'] = len(gjstr)
+    else:
+        # The size of the opened file, it may be replaced meanwhile
+        response = StreamingHttpResponse(FileWrapper(geojson), content_type='application/json')
+        response['Content-Length'] = os.fstat(geojson.file.fileno()).st_size
     response['Content-Encoding'] = 'gzip'
-    response['Content-Length'] = len(gjstr)
     return response
 
 def segment_geojson(request, object_id):
@@ -938,7 +910,7 @@ def segment_geojson(request, object_id):
     object = get_object_or_404(Segment, pk=object_id)
 
     # Check for cache and return
-    cache_key = 'segment_geojson_%s' %object_id
+    cache_key = segment_key(object_id, 'segment_geojson')
     gjstr = cache.get(cache_key)
     if gjstr:
         response = HttpResponse(gjstr, mimetype='application/json')
@@ -1023,7 +995,7 @@ def segment_geojson(request, object_id):
 
     # save to cache if no start and stop
     if not start and not stop:
-        cache.set(cache_key, gjstr, 86400)
+        cache.set(cache_key, gjstr, artifact_ttl())
 
     response = HttpResponse(gjstr, mimetype='application/json')
     response['Content-Encoding'] = 'gzip'
@@ -1087,6 +1059,15 @@ def json_trip_series(request, object_id, start=False):
             start = int(start)
         except:
             start = False
+    # Graphs get a downsampled level of long exercises, slices every sample
+    points = getattr(settings, 'GRAPH_POINTS', 3000)
+    req_p = request.GET.get('points', '')
+    if req_p:
+        try:
+            points = int(req_p)
+        except ValueError:
+            pass
+    exact = 'start' in request.GET or exercise.live_state == 'L'
 
     if not exercise.user == request.user:  # Allow self
         is_friend = False
@@ -1099,16 +1080,23 @@ def json_trip_series(request, object_id, start=False):
                 raise Http403()
     power_show = exercise_permission_checks(request, exercise)
 
-    cache_key = 'json_trip_series_%s_%dtime_xaxis_%dpower_%dsmooth' %(object_id, time_xaxis, smooth, power_show)
+    cache_key = exercise_key(object_id, 'json_trip_series', time_xaxis, power_show, smooth)
     js = None
-    if not start and not exercise.live_state == 'L': # Caching not involved in slices or live exercises
+    cacheable = not exact and not req_p # Caching not involved in slices, live exercises or custom point budgets
+    if cacheable:
         js = cache.get(cache_key)
     if not js:
-        details = exercise.exercisedetail_set.all().values('altitude', 'cadence', 'distance', 'hr', 'lat', 'lon', 'power', 'speed', 'temp', 'time')
-
-        if start:
-            details = details[start:]
-        if exercise.avg_power:
+        index = None
+        if exact:
+            details = exercise.exercisedetail_set.all().values('altitude', 'cadence', 'distance', 'hr', 'lat', 'lon', 'power', 'speed', 'temp', 'time')
+            if start:
+                details = details[start:]
+        else:
+            series = exercise.get_graph_series(points)
+            details = series_details(series)
+            if 'index' in getattr(series, 'extra', {}):
+                index = series.extra['index'].tolist()
+        if exercise.avg_power and details and not 'poweravg30s' in details[0]:
             #generate_30s_power = power_30s_average(details)
             vals = smoothList( [e['power'] for e in details])
             for e, v in zip(details, vals):
@@ -1118,22 +1106,151 @@ def json_trip_series(request, object_id, start=False):
             has_distance = 1
         if not has_distance:
             time_xaxis = True
-        js = js_trip_series(request, exercise, details, start=start, time_xaxis=time_xaxis, smooth=smooth, use_constraints = False)
+        js = js_trip_series(request, exercise, details, start=start, time_xaxis=time_xaxis, smooth=smooth, use_constraints = False, index=index)
         if not js: # if start and no elements returner, we get None
             return HttpResponse('{}', mimetype='application/javascript')
         js = js.encode('UTF-8')
         js = compress_string(js)
-        if not start and not exercise.live_state == 'L': # Do not cache slices or live exercises
-            cache.set(cache_key, js, 86400)
+        if cacheable:
+            cache.set(cache_key, js, artifact_ttl())
     response = HttpResponse(js, mimetype='application/javascript')
     response['Content-Encoding'] = 'gzip'
     response['Content-Length'] = len(js)
     return response
 
-def js_trip_series(request, exercise, details,  start=False, stop=False, time_xaxis=True, use_constraints=True, smooth=0):
+def hidden_series_fields(request, exercise):
+    ''' The fields of the samples the ExercisePermission of the exercise
+    hides from the user of the request '''
+
+    hidden = []
+    # User always has permission for their own shit
+    if exercise.user == request.user:
+        return hidden
+
+    is_friend = False
+    if request.user.is_authenticated():
+        is_friend = Friendship.objects.are_friends(request.user, exercise.user)
+    try:
+        # Try to find permission object for this exercise
+        permission = exercise.exercisepermission
+    except ExercisePermission.DoesNotExist:
+        # No permissionojbect found
+        return hidden
+    for val in ('speed', 'power', 'cadence', 'hr'):
+        permission_val = getattr(permission, val)
+        if permission_val == 'A':
+            continue
+        elif permission_val == 'F' and is_friend:
+            continue
+        else: #'N' or not friends
+            hidden.append(val)
+            if val == 'power':
+                # we don't store poweravg30s in db, but if you cant see power you shouldn't see that
+                hidden.append('poweravg30s')
+    return hidden
+
+def binary_trip_series(request, object_id):
+    ''' The samples of an exercise for graphs as little endian arrays.
+
+    The response is a uint32 giving the length of a JSON header, the header
+    and then the arrays, each starting at a multiple of 8 bytes from the
+    start of the response so they can be viewed as typed arrays directly.
+    The header has the start time and length of the series and the name,
+    dtype and byte offset of each array. Long exercises get a downsampled
+    level like json_trip_series, with the sample index of every point in
+    the index array. '''
+    exercise = get_object_or_404(Exercise, pk=object_id)
+
+    points = getattr(settings, 'GRAPH_POINTS', 3000)
+    req_p = request.GET.get('points', '')
+    if req_p:
+        try:
+            points = int(req_p)
+        except ValueError:
+            pass
+
+    if not exercise.user == request.user:  # Allow self
+        is_friend = False
+        if request.user.is_authenticated():
+            is_friend = Friendship.objects.are_friends(request.user, exercise.user)
+        if exercise.exercise_permission == 'N':
+            raise Http403()
+        elif exercise.exercise_permission == 'F':
+            if not is_friend:
+                raise Http403()
+    hidden = hidden_series_fields(request, exercise)
+
+    series = exercise.get_graph_series(points)
+    extra = getattr(series, 'extra', {})
+    arrays = []
+    for name in SERIES_FIELDS[1:]:
+        if name not in hidden and series.has(name):
+            arrays.append((name, series[name]))
+    if 'poweravg30s' not in hidden and series.has('power'):
+        if 'poweravg30s' in extra:
+            arrays.append(('poweravg30s', extra['poweravg30s']))
+        else:
+            arrays.append(('poweravg30s', numpy.array(smoothList(numpy.nan_to_num(series.power))[:len(series)])))
+    arrays.insert(0, ('time', series.time))
+    if 'index' in extra:
+        arrays.append(('index', extra['index']))
+
+    # Positions need double precision, the rest does fine with single
+    blocks = []
+    for name, values in arrays:
+        if name in ('lat', 'lon'):
+            blocks.append((name, 'float64', values.astype('<f8').tostring()))
+        elif name == 'index':
+            blocks.append((name, 'uint32', values.astype('<u4').tostring()))
+        else:
+            blocks.append((name, 'float32', values.astype('<f4').tostring()))
+
+    def header_for(offset):
+        columns = []
+        for name, dtype, data in blocks:
+            columns.append({'name': name, 'dtype': dtype, 'offset': offset})
+            offset += (len(data) + 7) & ~7
+        start = None
+        if series.start:
+            start = series.start.isoformat()
+        return json.dumps({'start': start, 'length': len(series), 'columns': columns}, separators=(',',':'))
+
+    # The offsets are part of the header, so grow it until they fit
+    header = header_for(0)
+    offset = (4 + len(header) + 7) & ~7
+    while True:
+        header = header_for(offset)
+        if (4 + len(header) + 7) & ~7 <= offset:
+            break
+        offset = (4 + len(header) + 7) & ~7
+
+    parts = [struct.pack('<I', len(header)), header, '\0' * (offset - 4 - len(header))]
+    for name, dtype, data in blocks:
+        parts.append(data)
+        parts.append('\0' * (-len(data) % 8))
+    data = compress_string(''.join(parts))
+    response = HttpResponse(data, mimetype='application/octet-stream')
+    response['Content-Encoding'] = 'gzip'
+    response['Content-Length'] = len(data)
+    return response
+
+def series_details(series):
+    ''' The samples of a Series as dicts like the values() of ExerciseDetails,
+    with any extra arrays of a downsampled level except index '''
+
+    names = list(SERIES_FIELDS) + [name for name in getattr(series, 'extra', {}) if name != 'index']
+    columns = [series.datetimes()]
+    for name in names[1:]:
+        values = series[name] if name in SERIES_FIELDS else series.extra[name]
+        cast = name in SERIES_INT_FIELDS and int or float
+        columns.append([None if v != v else cast(v) for v in values.tolist()])
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+def js_trip_series(request, exercise, details,  start=False, stop=False, time_xaxis=True, use_constraints=True, smooth=0, index=None):
     ''' Generate javascript to be used directly in flot code
     Argument use_constraints can be used to disable flot constraints for HR, used for compare feature
-    Argument smooth to reduce number of elements by averaging by the number given in smooth'''
+    Argument smooth to reduce number of elements by averaging by the number given in smooth
+    Argument index is the sample index of each of the details when they are downsampled'''
 
     if not details:
         return
@@ -1151,34 +1268,8 @@ def js_trip_series(request, exercise, details,  start=False, stop=False, time_xa
             'lat': [],
         }
 
-    # User always has permission for their own shit
-    if not exercise.user == request.user:
-
-        is_friend = False
-        if request.user.is_authenticated():
-            is_friend = Friendship.objects.are_friends(request.user, exercise.user)
-        # Check for permission to display attributes
-        try:
-            # Try to find permission object for this exercise
-            permission = exercise.exercisepermission
-
-            for val in js_strings.keys():
-                # Can't remove altitude for example 
-                if hasattr(permission, val):
-                    permission_val = getattr(permission, val)
-                    if permission_val == 'A':
-                        continue
-                    elif permission_val == 'F' and is_friend:
-                        continue
-                    else: #'N' or not friends
-                        del js_strings[val]
-                        if val == 'power':
-                            # we don't store poweravg30s in db, but if you cant see power you shouldn't see that
-                            del js_strings['poweravg30s']
-
-        except ExercisePermission.DoesNotExist:
-            # No permissionojbect found
-            pass
+    for val in hidden_series_fields(request, exercise):
+        del js_strings[val]
 
     # Check if we should export altitude to graph
     has_altitude = exercise.exercise_type.altitude
@@ -1312,11 +1403,54 @@ def js_trip_series(request, exercise, details,  start=False, stop=False, time_xa
     if 'lon' in js_strings:
         res['lon'] = js_strings['lon']
         res['lat'] = js_strings['lat']
+    if index is not None and not smooth:
+        res['index'] = index
 
     res = json.dumps(res, separators=(',',':'))
         #    js_strings[val] =  json.dumps(thevals, separators=(',',':'))
     return res
 
+def histogram_bars(histogram, min=0, max=0, val_cutoff=0):
+    ''' [value, seconds] pairs of a time histogram for display in flot '''
+
+    values = numpy.arange(len(histogram))
+    keep = (histogram > 0) & (values >= min) & (histogram >= val_cutoff)
+    if max:
+        keep &= values <= max
+    return [[int(value), int(seconds)] for value, seconds in zip(values[keep], histogram[keep])]
+
+def histogram_charts(exercise):
+    ''' The frequency charts of the exercise by type, heart rate as a list
+    of flot series, one per HR zone, and the others as JSON '''
+
+    histograms = exercise.get_histograms()
+    charts = {}
+    if 'cadence' in histograms:
+        charts['C'] = json.dumps(histogram_bars(histograms['cadence'], min=1))
+    if 'speed' in histograms:
+        charts['S'] = json.dumps(histogram_bars(histograms['speed'], min=1, max=150)) # FIXME why is this 150 ?
+    if 'power' in histograms:
+        charts['P'] = json.dumps(histogram_bars(histograms['power'], min=1, val_cutoff=5))
+    if 'hr_percent' in histograms:
+        zones = [[] for i in range(7)]
+        if exercise.duration:
+            total_seconds = exercise.duration.total_seconds()
+            for hr, seconds in histogram_bars(histograms['hr_percent'], min=41, max=100):
+                percentage = float(seconds)*100/total_seconds
+                if percentage > 0.5:
+                    zones[hr2zone(hr)].append([hr, percentage])
+        # tis is a bit ugly, maybe fork out in a template?
+        js = '['
+        for i, zone in enumerate(zones):
+            if zone:
+                js += '''{
+                data: %s,
+                bars: { show: true},
+                color: colors[%s]
+             },''' %(json.dumps(zone), i)
+        charts['H'] = js.rstrip(',') + ']'
+    return charts
+
 def getzones_with_legend(exercise):
 
     zones = exercise.hrzonesummary_set.all()
@@ -1486,6 +1620,11 @@ def exercise_permission_checks(request, exercise):
     return power_show
 
 
+def get_power_records(user, season=0):
+    ''' The power records of user, see manage.py rebuild_power_records for
+    efforts from before the records were kept '''
+    return PowerRecord.objects.filter(user=user, season=season)
+
 #@profile("exercise_detail")
 def exercise(request, object_id):
     ''' View for exercise detail '''
@@ -1551,20 +1690,29 @@ def exercise(request, object_id):
     bestpowerefforts = object.bestpowereffort_set.all()
     userbestbestpowerefforts = []
     # fetch the all time best for comparison
-    bestbestpowerefforts = BestPowerEffort.objects.filter(exercise__user=object.user).values('duration').annotate(power=Max('power'))
+    bestbestpowerefforts = get_power_records(object.user)
     if request.user.is_authenticated() and request.user != object.user:
-        userbestbestpowerefforts = BestPowerEffort.objects.filter(exercise__user=request.user).values('duration').annotate(power=Max('power'))
-    def freqobj_to_json(freq_type):
-        f = Freq.objects.get_or_none(exercise=object.id,freq_type=freq_type)
-        if f:
-            return f.json
-
-    hrhzones = freqobj_to_json('H')
-    cadfreqs = freqobj_to_json('C')
-    speedfreqs = freqobj_to_json('S')
+        userbestbestpowerefforts = get_power_records(request.user)
+    # The full curve of this exercise, at log spaced durations for the log axis
+    meanmax_power = []
+    if power_show:
+        curves = object.get_mean_max()
+        if 'power' in curves and len(curves['durations']):
+            durations = curves['durations']
+            points = numpy.searchsorted(durations, numpy.logspace(0, numpy.log10(durations[-1]), 100))
+            meanmax_power = [(int(durations[i]), int(curves['power'][i])) for i in numpy.unique(points.clip(0, len(durations) - 1))]
+    cache_key = exercise_key(object.id, 'freqs')
+    freqs = cache.get(cache_key)
+    if freqs is None:
+        freqs = histogram_charts(object)
+        cache.set(cache_key, freqs, artifact_ttl())
+
+    hrhzones = freqs.get('H')
+    cadfreqs = freqs.get('C')
+    speedfreqs = freqs.get('S')
     powerfreqs = []
     if power_show:
-        powerfreqs = freqobj_to_json('P')
+        powerfreqs = freqs.get('P')
 
     return render_to_response('turan/exercise_detail.html', locals(), context_instance=RequestContext(request))
 
@@ -1846,33 +1994,28 @@ def import_bulk(request):
     if request.method == 'POST':
         bulkform = BulkImportForm(request.POST, request.FILES)
         if bulkform.is_valid():
-            exercises = []
-            zfile = zipfile.ZipFile( request.FILES['zip_file'])
-            for info in zfile.infolist():
-                fname = info.filename
-                content = zfile.read(fname)
-                content = ContentFile(content)
-                fname = fname.lower()
-                exercise_filename = os.path.join('sensor', fname)
-
-                exercise = Exercise()
-                exercise.user = request.user
-                exercise.sensor_file.save(exercise_filename, content)
-                exercise.save()
-                exercises.append(exercise)
-            # Done saving, now parse them all
-            for e in exercises:
-                task = e.parse()
-            if task: # Display progress for last task
-                return HttpResponseRedirect(\
-                reverse('exercise_parse_progress', kwargs = {
-                    'object_id': e.id,
-                    'task_id': task.task_id}))
+            # The files are imported and parsed by workers, see run_bulk_import
+            job = BulkImport(user=request.user)
+            job.archive.save(request.FILES['zip_file'].name, request.FILES['zip_file'])
+            job.save()
+            run_bulk_import.delay(job.id)
+            return HttpResponseRedirect(job.get_absolute_url())
     else:
         bulkform = BulkImportForm()
 
     return render_to_response("turan/import.html", {'form': form, 'bulkform': bulkform}, context_instance=RequestContext(request))
 
+@login_required
+def bulk_import_progress(request, object_id):
+    ''' View to display progress of a bulk import, as JSON for ajax requests '''
+
+    job = get_object_or_404(BulkImport, id=object_id, user=request.user)
+    progress = job.get_progress()
+    if request.is_ajax():
+        return HttpResponse(json.dumps(progress), mimetype='application/json')
+    items = job.items.select_related('exercise')
+
+    return render_to_response('turan/bulk_import.html', locals(), context_instance=RequestContext(request))
 
 @login_required
 def import_data(request):
@@ -2187,23 +2330,27 @@ def exercise_segment_search(request, object_id):
 
 @login_required
 def segment_exercise_search(request, object_id):
-    ''' View to display exercises found for a segment and make user able to
-    add '''
+    ''' View to display progress of the search for exercises passing a
+    segment, as JSON for ajax requests. Superusers can start a new search. '''
 
-    if request.user.is_superuser:
-
-        segment = get_object_or_404(Segment, id=object_id)
-        segments = {}
-        for e in Exercise.objects.all():
-            if len(segments) > 19:
-                break
-            if e.route and e.route.gpx_file:
-                found_segments = search_trip_for_possible_segments_matches(e, search_in_segments=[segment])
-                if found_segments:
-                    segments[e] = found_segments
-
-        return render_to_response('turan/segment_exercise_finder.html', locals(), context_instance=RequestContext(request))
-    return HttpResponseForbidden()
+    segment = get_object_or_404(Segment, id=object_id)
+    if request.method == 'POST':
+        if not request.user.is_superuser:
+            return HttpResponseForbidden()
+        start_segment_backfill(segment)
+        return HttpResponseRedirect(reverse('segment_exercise_search', kwargs={'object_id': segment.id}))
+
+    backfill = None
+    progress = {}
+    backfills = segment.segmentbackfill_set.all()[:1]
+    if backfills:
+        backfill = backfills[0]
+        progress = backfill.get_progress()
+    if request.is_ajax():
+        return HttpResponse(json.dumps(progress), mimetype='application/json')
+    segmentdetails = segment.segmentdetail_set.select_related('exercise', 'exercise__user').order_by('-exercise__date')
+
+    return render_to_response('turan/segment_exercise_finder.html', locals(), context_instance=RequestContext(request))
 
 @login_required
 def exercise_parse_progress(request, object_id, task_id):
@@ -2283,6 +2430,7 @@ def exercise_update_live(request, object_id):
                 new_object.time = datetime.fromtimestamp(float(new_object.time))
                 new_object.exercise = exercise
                 new_object.save()
+                invalidate_series(exercise)
                 new_time = datetimetime(new_object.time.hour, \
                         new_object.time.minute, new_object.time.second)
                 if not exercise.time:
@@ -2476,16 +2624,44 @@ def search(request, template='turan/search.html', extra_context=None):
 
 
 
+def json_training_load(request, username):
+    ''' Daily TSS, BikeScore and chronic and acute training load of a user
+    with their balance, for performance management charts. The days are
+    the 365 before today, or from the start to the stop GET parameters. '''
+
+    other_user = get_object_or_404(User, username=username)
+    stop = datetimedate.today()
+    start = stop - timedelta(days=365)
+    try:
+        if request.GET.get('start'):
+            start = datetime.strptime(request.GET['start'], '%Y-%m-%d').date()
+        if request.GET.get('stop'):
+            stop = datetime.strptime(request.GET['stop'], '%Y-%m-%d').date()
+    except ValueError:
+        raise Http404('Invalid date')
+
+    days = training_load(other_user.id, start, stop)
+    for day in days:
+        day['date'] = day['date'].isoformat()
+        for name in ('ctl', 'atl', 'tsb'):
+            day[name] = round(day[name], 1)
+    js = json.dumps(days)
+    response = HttpResponse(js, mimetype='application/json')
+    response['Content-Length'] = len(js)
+    return response
+
 def json_altitude_gradient(request, object_id):
     ''' Fetch common altitude gradient from db, and serve to javascript
     clients that renders the graph. Used in exercise detail incline sum tab. '''
 
-    # TODO this function can be heavily cached
     # TODO should be class based view
-    object = get_object_or_404(Exercise, pk=object_id)
-    gradients = json.dumps(list(object.exercisealtitudegradient_set.values_list('xaxis', 'gradient')))
-    #js = compress_string(gradients)
-    js = gradients
+    cache_key = exercise_key(object_id, 'altitude_gradient')
+    js = cache.get(cache_key)
+    if js is None:
+        object = get_object_or_404(Exercise, pk=object_id)
+        js = json.dumps(list(object.exercisealtitudegradient_set.values_list('xaxis', 'gradient')))
+        #js = compress_string(gradients)
+        cache.set(cache_key, js, artifact_ttl())
     response = HttpResponse(js, mimetype='application/json')
     #response['Content-Encoding'] = 'gzip'
     response['Content-Length'] = len(js)
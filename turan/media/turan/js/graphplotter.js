@@ -102,6 +102,12 @@ var GraphPlotter = {
 
         if (minIndex != null && maxIndex != null) { // Means ranges were set (a selection)
 
+            // Downsampled graphs point to the samples they were picked from
+            if (this.sampleIndex) {
+                minIndex = this.sampleIndex[minIndex];
+                maxIndex = this.sampleIndex[maxIndex];
+            }
+
             // Show the progress bar for loading selection info
             $('.progressbarcontainer').removeClass('hide');
             $('.progress .bar').attr('style', 'width: 70%;');
@@ -210,6 +216,11 @@ var GraphPlotter = {
     },
     init: function(args) {
         this.datasets = args.datasets;
+        this.sampleIndex = null;
+        if (this.datasets.index != undefined) {
+            this.sampleIndex = this.datasets.index;
+            delete this.datasets.index;
+        }
         var backendUrl = args.backendUrl;
         this.max_hr = args.max_hr;
         this.markings = args.markings;
@@ -4,6 +4,11 @@
 var Mapper = {
     map: null,
     projection: new OpenLayers.Projection("EPSG:4326"),
+    // The zoom levels the whole track is stored simplified for, see
+    // GEOJSON_ZOOMS in tasks.py
+    geojsonZooms: [10, 13, 16],
+    geojsonRange: null,
+    geojsonZoom: null,
 
     resizeMapToLayerExtents: function (evt) {
         this.map.zoomToExtent(evt.object.getDataExtent());
@@ -169,6 +174,7 @@ var Mapper = {
         }
         
         this.map.render("map");
+        this.map.events.register("zoomend", this, this.zoomGeoJSON);
         if (gpx_file) {
             this.map.addLayer(lgpx);
             this.lgpx.setVisibility(true); // Dunno why this was needed after openlayers 2.8
@@ -179,25 +185,63 @@ var Mapper = {
         lonlat =new OpenLayers.LonLat(x1,y1 ).transform(new OpenLayers.Projection("EPSG:4326"), this.map.getProjectionObject());;
         this.map.panTo(lonlat);
     }, 
-    loadGeoJSON: function(minIndex, maxIndex) {
+    // The stored zoom level the whole track is served at for zoom, like
+    // geojson_zoom in tasks.py
+    geojsonLevel: function(zoom) {
+        for (var i = 0; i < this.geojsonZooms.length; i++) {
+            if (this.geojsonZooms[i] >= zoom) {
+                return this.geojsonZooms[i];
+            }
+        }
+        return this.geojsonZooms[this.geojsonZooms.length - 1];
+    },
+    // The zoom the track will be shown at, the one fitting the route before
+    // the map has been zoomed
+    trackZoom: function() {
+        if (this.map.getCenter()) {
+            return this.map.getZoom();
+        }
+        if (this.lgpx && this.lgpx.getDataExtent()) {
+            return this.map.getZoomForExtent(this.lgpx.getDataExtent());
+        }
+        return null;
+    },
+    // Load the whole track again when zooming past one of its levels
+    zoomGeoJSON: function() {
+        if (this.geojsonRange && !this.geojsonRange[0] && !this.geojsonRange[1]
+                && this.geojsonZoom != this.geojsonLevel(this.map.getZoom())) {
+            this.loadGeoJSON(0, 0, true);
+        }
+    },
+    loadGeoJSON: function(minIndex, maxIndex, keepExtent) {
         if (this.map != null) {
         if (this.geojson_url) {
             oldlayer = this.map.getLayersByName('HR Line');
             if (oldlayer.length) {
                 this.map.removeLayer(oldlayer[0]);
             }
+            var url = this.geojson_url + '?start=' + minIndex + '&stop=' + maxIndex;
+            var zoom = this.trackZoom();
+            this.geojsonRange = [minIndex, maxIndex];
+            this.geojsonZoom = null;
+            if (zoom != null) {
+                this.geojsonZoom = this.geojsonLevel(zoom);
+                url += '&zoom=' + this.geojsonZoom;
+            }
             var selection_vectors = new OpenLayers.Layer.Vector("HR Line", {
                     strategies: [new OpenLayers.Strategy.Fixed()],                
                     rendererOptions: { zIndexing: true},
                     protocol: new OpenLayers.Protocol.HTTP({
-                        url: this.geojson_url + '?start=' + minIndex + '&stop=' + maxIndex,
+                        url: url,
                         format: new OpenLayers.Format.GeoJSON({ 'internalProjection': this.projection })
                     }),
                     projection: this.projection,
                     styleMap: this.styles
                 });
                 this.map.addLayer(selection_vectors);
-                selection_vectors.events.register("loadend", this, this.resizeMapToLayerExtents);
+                if (!keepExtent) {
+                    selection_vectors.events.register("loadend", this, this.resizeMapToLayerExtents);
+                }
         }
         if (!this.map.center) {
             this.map.zoomToExtent(this.lgpx.getDataExtent());
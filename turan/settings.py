@@ -229,6 +229,22 @@ INSTALLED_APPS = (
 )
 
 GPX_STORAGE = '/home/turan.no/turansite/site_media/turan'
+# Rows per INSERT when storing parsed exercise samples
+EXERCISEDETAIL_BATCH_SIZE = 1000
+# Number of files of a bulk import parsed at the same time
+BULK_IMPORT_CONCURRENCY = 4
+# Seconds a file of a bulk import can be running before it is parsed again by another worker
+BULK_IMPORT_ITEM_TIMEOUT = 3600
+# Exercises per task when searching the history for a new segment
+SEGMENT_BACKFILL_CHUNK = 50
+# Name new autogenerated routes outside Norway with a geonames lookup in the background
+GEONAMES_ROUTE_NAMES = True
+# Points in the graph of an exercise, longer exercises get a downsampled graph
+GRAPH_POINTS = 3000
+# Seconds to keep cached graphs and maps of exercises and segments, see cachekeys
+CACHE_ARTIFACT_TTL = 86400*30
+# Seconds to keep the bestest rankings of durations read from the mean maximal curves
+BESTEST_CACHE_TTL = 3600
 
 ABSOLUTE_URL_OVERRIDES = {
     "auth.user": lambda o: "/profiles/%s/" % o.username,
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+''' Compare segment matching over every segment with matching over the
+segments the spatial index finds near the track, for 1000 segments and a
+20k sample ride. The full scan makes a geodesic call per sample for every
+segment within 300 km and takes minutes. Run from a django shell:
+
+    ./manage.py shell < turan/tests/bench_segment_index.py
+'''
+
+import math
+import random
+import time
+from datetime import datetime
+
+import numpy
+
+from turan.apps.turan.models import Segment
+from turan.apps.turan.series import Series
+from turan.apps.turan.spatial import SegmentIndex, track_bbox
+from turan.apps.turan.tasks import search_trip_for_possible_segments_matches
+
+random.seed(42)
+
+# A 20k sample ride wandering north east from Trondheim, about 7 m per second
+n = 20000
+heading = numpy.cumsum(numpy.random.RandomState(42).normal(0, 0.05, n)) + math.pi/4
+step = 7.0
+lat = 63.43 + numpy.cumsum(step*numpy.cos(heading))/111320.0
+lon = 10.39 + numpy.cumsum(step*numpy.sin(heading))/(111320.0*math.cos(math.radians(63.43)))
+distance = numpy.arange(n)*step
+series = Series(datetime(2012, 6, 1, 10, 0, 0), {'time': numpy.arange(n), 'distance': distance, 'lat': lat, 'lon': lon})
+
+class EmptySet(object):
+    def all(self):
+        return []
+
+class Ride(object):
+    id = None
+    segmentdetail_set = EmptySet()
+    def get_series(self):
+        return series
+ride = Ride()
+
+segments = []
+# 10 segments along the ride
+for i in range(10):
+    start = random.randint(0, n - 3000)
+    stop = start + random.randint(500, 2500)
+    segments.append(Segment(id=len(segments)+1, name='On track %s' %i, distance=(distance[stop]-distance[start])/1000.,
+        start_lat=lat[start], start_lon=lon[start], end_lat=lat[stop], end_lon=lon[stop]))
+# The rest spread within 100 km
+while len(segments) < 1000:
+    s_lat = 63.43 + random.uniform(-0.9, 0.9)
+    s_lon = 10.39 + random.uniform(-2.0, 2.0)
+    segments.append(Segment(id=len(segments)+1, name='Elsewhere', distance=2.0,
+        start_lat=s_lat, start_lon=s_lon, end_lat=s_lat+0.01, end_lon=s_lon+0.01))
+
+start_time = time.time()
+index = SegmentIndex([(s.id, s.start_lat, s.start_lon, s.end_lat, s.end_lon) for s in segments])
+build_time = time.time() - start_time
+
+start_time = time.time()
+candidate_ids = index.query(track_bbox(series.lat, series.lon), margin=90)
+candidates = [s for s in segments if s.id in candidate_ids]
+indexed = search_trip_for_possible_segments_matches(ride, search_in_segments=candidates)
+indexed_time = time.time() - start_time
+
+start_time = time.time()
+scanned = search_trip_for_possible_segments_matches(ride, search_in_segments=segments)
+scan_time = time.time() - start_time
+
+assert [m[0].id for m in indexed] == [m[0].id for m in scanned]
+print "index build: %.4fs, %d of %d segments near the track" %(build_time, len(candidates), len(segments))
+print "full scan: %.2fs -> indexed: %.2fs (%.0fx), %d matches" %(scan_time, indexed_time, scan_time/indexed_time, len(indexed))
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+''' Compare the convolution smoothing kernels in tasks with the old per
+sample loops on a 20k sample series. Run from a django shell:
+
+    ./manage.py shell < turan/tests/bench_smoothing.py
+'''
+
+import random
+import timeit
+import numpy
+
+from turan.apps.turan.tasks import smoothListGaussian, smoothList
+
+def old_smoothListGaussian(list, degree=5):
+    list = [x if x else 0 for x in list]
+    if not list:
+        return list
+    list = [list[0]]*(degree-1) + list + [list[-1]]*degree
+    window = degree*2-1
+    weight = numpy.array([1.0]*window)
+    weightGauss = []
+    for i in range(window):
+        i = i-degree+1
+        frac = i/float(window)
+        gauss = 1/(numpy.exp((4*(frac))**2))
+        weightGauss.append(gauss)
+    weight = numpy.array(weightGauss)*weight
+    smoothed = [0.0]*(len(list)-window)
+    for i in range(len(smoothed)):
+        smoothed[i] = sum(numpy.array(list[i:i+window])*weight)/sum(weight)
+    return smoothed
+
+def old_smoothList(list, degree=30):
+    list = [x if x else 0 for x in list]
+    list = [list[0]]*((degree)) + list
+    smoothed = [0]*(len(list)-degree+1)
+    for i in range(len(smoothed)):
+        smoothed[i] = sum(list[i:i+degree])/float(degree)
+    return smoothed
+
+samples = [random.randint(0, 600) for i in xrange(20000)]
+
+assert numpy.allclose(old_smoothListGaussian(samples, 10), smoothListGaussian(samples, 10))
+assert numpy.allclose(old_smoothList(samples), smoothList(samples))
+
+for name, old, new in (
+        ('smoothListGaussian', lambda: old_smoothListGaussian(samples, 10), lambda: smoothListGaussian(samples, 10)),
+        ('smoothList', lambda: old_smoothList(samples), lambda: smoothList(samples)),
+        ):
+    old_time = min(timeit.repeat(old, number=1, repeat=3))
+    new_time = min(timeit.repeat(new, number=1, repeat=3))
+    print "%s: %.4fs -> %.4fs (%.0fx)" %(name, old_time, new_time, old_time/new_time)
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+''' Check best_efforts against the best_x_sec deque walk it replaced, on the
+GPX fixture and on a synthetic two hour 1 Hz ride with a pause and power.
+Run from a django shell:
+
+    ./manage.py shell < turan/tests/check_best_efforts.py
+
+The intended differences, which are asserted as such:
+
+ o On 1 Hz samples both find the same best speed and power for every
+   duration. best_x_sec reported the distance at the second sample of the
+   window as its position, best_efforts the distance at its start, one
+   sample earlier.
+ o On smart sampled files best_x_sec only tried windows between samples
+   exactly the duration apart, best_efforts tries every second, so it finds
+   the same or a better effort.
+ o Neither finds an effort longer than the longest stretch without a
+   pause of a minute or more.
+'''
+
+from collections import deque
+from datetime import datetime
+
+import numpy
+
+from turan.apps.turan.gpxparser import GPXParser
+from turan.apps.turan.series import Series, SERIES_FIELDS
+from turan.apps.turan.tasks import best_efforts, altvals_to_ascent_descent, smoothListGaussian, EFFORT_DURATIONS
+
+def old_best_x_sec(details, length, altvals, speed=True, power=False):
+
+    best_speed = 0.0
+    best_power = 0.0
+    best_power = 0.0
+    sum_q_power = 0.0
+    sum_q_speed = 0.0
+    best_start_km_speed = 0.0
+    best_start_km_power = 0.0
+    best_speed_start_end = 0
+    best_power_start_end = 0
+    q_speed = deque()
+    q_power = deque()
+    best_length_speed = 0.0
+    best_length_power = 0.0
+
+    if speed:
+        q_speed.appendleft(details[0].speed)
+    j = 1
+    if power and details[j].power:
+        q_power.appendleft(details[j].power)
+    j = 2
+    len_i = len(details)
+    for i in xrange(2, len_i):
+        #try:
+        delta_t = (details[i].time - details[i-1].time).seconds
+        if speed:
+            # Break if exerciser is on a break as well
+            if delta_t < 60:
+                q_speed.appendleft(details[i].speed * delta_t)
+            else:
+                q_speed = deque()
+                q_speed.appendleft(details[i].speed)
+            delta_t_total = (details[i].time - details[i-len(q_speed)].time).seconds
+        if power:
+            if delta_t < 60 and details[i].power:
+                q_power.appendleft(details[i].power * delta_t)
+            elif delta_t < 60 and not details[i].power:
+                q_power.appendleft(0)
+            else:
+                q_power = deque()
+                if details[i].power:
+                    q_power.appendleft(details[i].power)
+            if not speed:
+                delta_t_total = (details[i].time - details[i-len(q_power)].time).seconds
+        if delta_t_total >= length:
+            break
+        j += 1
+        #except Exception as e:
+        #    #print "%s %s %s %s %s" % (e, i, j, delta_t, len(q_speed))
+        #    #j += 1
+        #    continue
+    j += 1
+
+    for i in xrange(j, len(details)):
+
+        try:
+            if len(q_speed):
+                if speed:
+                    sum_q_speed_tmp = sum(q_speed)
+                    delta_t_total = (details[i].time - details[i-len(q_speed)].time).seconds
+
+                    if delta_t_total != 0 and delta_t_total == length:
+                        sum_q_speed = sum_q_speed_tmp / (details[i].time - details[i-len(q_speed)].time).seconds
+                    else:
+                        # What can one do?
+                        sum_q_speed = 0
+            if len(q_power):
+                if power:
+                    sum_q_power_tmp = sum(q_power)
+                    delta_t_total_power = (details[i].time - details[i-len(q_power)].time).seconds
+                    if delta_t_total_power != 0 and delta_t_total_power == length:
+                        sum_q_power = sum_q_power_tmp / delta_t_total_power
+                    else:
+                        sum_q_power = 0
+            if sum_q_speed > best_speed:
+                best_speed = sum_q_speed
+                best_start_km_speed = details[i-len(q_speed)].distance / 1000
+                best_speed_start_end = (i, i-len(q_speed))
+                best_length_speed = (details[i].distance) - best_start_km_speed * 1000
+            if sum_q_power > best_power:
+                best_power = sum_q_power
+                best_start_km_power = details[i-len(q_power)].distance / 1000
+                best_power_start_end = (i, i-len(q_speed))
+                best_length_power = (details[i].distance) - best_start_km_power * 1000
+
+            delta_t = (details[i].time - details[i-1].time).seconds
+            if speed:
+                if delta_t < 60:
+                    q_speed.appendleft(details[i].speed*delta_t)
+                else:
+                    q_speed = deque()
+            if power:
+                if delta_t < 60 and details[i].power:
+                    q_power.appendleft(details[i].power*delta_t)
+                elif delta_t < 60 and not details[i].power:
+                    q_power.appendleft(0)
+                else:
+                    q_power = deque()
+            while ((details[i].time - details[i-len(q_speed)].time).seconds) > length:
+                q_speed.pop()
+            while (power and (details[i].time - details[i-len(q_power)].time).seconds > length):
+                q_power.pop()
+        except Exception as e:
+            print "something wrong %s, %s, %s, %s" % (e, len(q_speed), i, j)
+            #raise
+            continue
+
+    if power and speed:
+        best_speed_ascent = 0
+        best_speed_descent = 0
+        best_power_ascent = 0
+        best_power_descent = 0
+        if best_speed_start_end:
+            c, d = best_speed_start_end
+            best_speed_ascent, best_speed_descent = altvals_to_ascent_descent(altvals[d:c])
+        if best_power_start_end:
+            a, b = best_power_start_end
+            best_power_ascent, best_power_descent = altvals_to_ascent_descent(altvals[b:a])
+
+        return best_speed, best_start_km_speed, best_length_speed, best_speed_ascent, best_speed_descent, best_power, best_start_km_power, best_length_power, best_power_ascent, best_power_descent
+    elif speed and not power:
+        best_speed_ascent = 0
+        best_speed_descent = 0
+        if best_speed_start_end:
+            a, b = best_speed_start_end
+            best_speed_ascent, best_speed_descent = altvals_to_ascent_descent(altvals[b:a])
+        return best_speed, best_start_km_speed, best_length_speed, best_speed_ascent, best_speed_descent
+    elif power and not speed:
+        best_power_ascent = 0
+        best_power_descent = 0
+        if best_power_start_end:
+            a, b = best_power_start_end
+            best_power_ascent, best_power_descent = altvals_to_ascent_descent(altvals[b:a])
+
+        return best_power, best_start_km_power, best_length_power, best_power_ascent, best_power_descent
+
+def old_efforts(rows, seconds, altvals, power):
+    ''' best_x_sec as (best, pos) by field, as calculate_best_efforts called it '''
+    try:
+        found = old_best_x_sec(rows, seconds, altvals, power=power)
+    except IndexError: # Exercises of less than three samples
+        return {}
+    efforts = {'speed': (found[0], found[1])}
+    if power:
+        efforts['power'] = (found[5], found[6])
+    return efforts
+
+def compare(name, series, one_hz):
+    rows = series.rows()
+    altvals = smoothListGaussian(numpy.nan_to_num(series.altitude).tolist())
+    distances = numpy.nan_to_num(series.distance)
+    power = series.has('power')
+    new = best_efforts(series, EFFORT_DURATIONS, altvals, power and ('speed', 'power') or ('speed',))
+    print name
+    for seconds in EFFORT_DURATIONS:
+        old = old_efforts(rows, seconds, altvals, power)
+        for field in sorted(new):
+            n_best, n_pos = new[field].get(seconds, (0, None))[:2]
+            o_best, o_pos = old.get(field, (0, None))
+            print "  %5ss %-5s old %10.3f at %7.3f km, new %10.3f at %s km" %(seconds, field, o_best, o_pos or 0, n_best, n_pos is not None and '%7.3f' %n_pos or '-')
+            if not o_best:
+                continue
+            if one_hz:
+                assert abs(n_best - o_best) < 1e-6*max(1, o_best), (name, field, seconds)
+                # The sample before the one best_x_sec reported
+                o_index = int(numpy.flatnonzero(numpy.isclose(distances/1000, o_pos))[0])
+                assert abs(n_pos - distances[o_index - 1]/1000) < 1e-9, (name, field, seconds)
+            else:
+                assert n_best >= o_best - 1e-6*max(1, o_best), (name, field, seconds)
+
+def fixture():
+    parser = GPXParser()
+    parser.parse_uploaded_file(open('turan/tests/gpx_test_file.gpx'))
+    return Series.from_entries(parser.entries)
+
+def synthetic():
+    random = numpy.random.RandomState(42)
+    n = 7200
+    time = numpy.arange(n, dtype=float)
+    time[n/2:] += 300 # A pause
+    speed = 30 + 8*numpy.sin(numpy.arange(n)/700.0) + random.normal(0, 2, n).cumsum()/20
+    power = (220 + 60*numpy.sin(numpy.arange(n)/450.0) + random.normal(0, 30, n)).clip(0).astype(int)
+    columns = dict((name, numpy.zeros(n) + numpy.nan) for name in SERIES_FIELDS)
+    columns.update({
+        'time': time,
+        'speed': speed,
+        'power': power,
+        'distance': numpy.concatenate(([0], numpy.cumsum(speed[1:]/3.6))),
+        'altitude': 100 + 20*numpy.sin(numpy.arange(n)/300.0),
+    })
+    return Series(datetime(2012, 6, 1, 10, 0, 0), columns)
+
+compare('gpx_test_file.gpx', fixture(), one_hz=False)
+ride = synthetic()
+compare('synthetic 1 Hz', ride, one_hz=True)
+# Every 1 to 30 seconds, like smart recording
+keep = numpy.unique(numpy.concatenate(([0], numpy.random.RandomState(7).randint(1, 31, 600).cumsum(), [len(ride) - 1])))
+keep = keep[keep < len(ride)]
+compare('synthetic smart sampled', Series(ride.start, dict((name, ride.columns[name][keep]) for name in SERIES_FIELDS)), one_hz=False)
+print "OK"